@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures the latency of parameter filters in `Mapper.find` for a growing
+number of entities, with and without the (name, value) indexes on the
+typed parameter tables.
+
+Usage::
+
+    python benchmarks/bench_filter.py [largest number of trials] [repetitions]
+
+The benchmark uses an in-memory sqlite database unless a ``bench``
+profile is configured in ``~/.xdapy/engine.ini``.
+"""
+
+import sys
+import time
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.errors import ConfigurationError
+from xdapy.operators import between
+from xdapy.parameters import _parameter_classes
+
+
+class Trial(Entity):
+    declared_params = {
+        'count': 'integer',
+        'note': 'string',
+        'rotation': 'float',
+        'learning': 'boolean'
+    }
+
+
+def make_connection():
+    try:
+        return Connection.profile("bench")
+    except ConfigurationError:
+        return Connection.memory()
+
+def make_trials(start, stop):
+    for i in xrange(start, stop):
+        yield Trial(count=i, note="trial %d" % i, rotation=i * 0.5, learning=bool(i % 2))
+
+def drop_value_indexes(connection):
+    for pc in _parameter_classes:
+        for index in pc.__table__.indexes:
+            index.drop(bind=connection.engine)
+
+def measure(mapper, n, repetitions):
+    filters = [
+        ("count == n/2", {"count": n // 2}),
+        ("note == 'trial n/3'", {"note": "trial %d" % (n // 3)}),
+        ("rotation in range", {"rotation": between(n * 0.1, n * 0.1 + 5)}),
+    ]
+    timings = []
+    for name, the_filter in filters:
+        start = time.time()
+        for _ in range(repetitions):
+            mapper.find_all(Trial, the_filter)
+        timings.append((name, (time.time() - start) / repetitions))
+    return timings
+
+def run(sizes, repetitions, indexed):
+    connection = make_connection()
+    connection.drop_tables()
+    connection.create_tables()
+    if not indexed:
+        drop_value_indexes(connection)
+    mapper = Mapper(connection)
+    mapper.register(Trial)
+
+    results = []
+    saved = 0
+    for n in sizes:
+        mapper.save_bulk(make_trials(saved, n))
+        saved = n
+        results.append((n, measure(mapper, n, repetitions)))
+
+    connection.drop_tables()
+    connection.engine.dispose()
+    return results
+
+def main(largest=50000, repetitions=5):
+    sizes = [size for size in (1000, 5000, 10000, 50000, 100000, 500000) if size < largest] + [largest]
+
+    for indexed in (False, True):
+        print "(name, value) indexes" if indexed else "without (name, value) indexes"
+        for n, timings in run(sizes, repetitions, indexed):
+            for name, duration in timings:
+                print "  %8d entities, %-22s %8.2f ms" % (n, name, duration * 1000)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures wide scans over the parameters of all entities of a type
+(`Mapper.aggregate`, `Mapper.get_data_array` and `Mapper.iter_find` with
+``records=True``), with and without a materialized table.
+
+Usage::
+
+    python benchmarks/bench_materialize.py [number of trials] [repetitions]
+
+The benchmark uses an in-memory sqlite database unless a ``bench``
+profile is configured in ``~/.xdapy/engine.ini``.
+"""
+
+import sys
+import time
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.errors import ConfigurationError
+
+
+class Block(Entity):
+    declared_params = {
+        'number': 'integer'
+    }
+
+class Trial(Entity):
+    declared_params = {
+        'count': 'integer',
+        'note': 'string',
+        'rotation': 'float',
+        'learning': 'boolean'
+    }
+
+
+def make_connection():
+    try:
+        return Connection.profile("bench")
+    except ConfigurationError:
+        return Connection.memory()
+
+def make_trials(block, n):
+    for i in xrange(n):
+        trial = Trial(count=i, note="trial %d" % (i % 10), rotation=i * 0.5, learning=bool(i % 2))
+        trial.parent = block
+        yield trial
+
+def measure(mapper, block, repetitions):
+    scans = [
+        ("aggregate", lambda: mapper.aggregate(Trial, group_by=["note"],
+                                               metrics={"n": "count", "rotation": "mean", "count": "max"})),
+        ("get_data_array", lambda: mapper.get_data_array(block, {"Trial": ["count", "rotation", "learning"]},
+                                                         include=["CHILDREN"])),
+        ("iter_find records", lambda: list(mapper.iter_find(Trial, records=True))),
+    ]
+    timings = []
+    for name, scan in scans:
+        start = time.time()
+        for _ in range(repetitions):
+            scan()
+        timings.append((name, (time.time() - start) / repetitions))
+    return timings
+
+def main(n=20000, repetitions=3):
+    connection = make_connection()
+    connection.drop_tables()
+    connection.create_tables()
+    mapper = Mapper(connection)
+    mapper.register(Block, Trial)
+
+    block = Block(number=1)
+    mapper.save(block)
+    mapper.save_bulk(make_trials(block, n))
+
+    for materialized in (False, True):
+        if materialized:
+            start = time.time()
+            mapper.materialize(Trial)
+            print "materialized %d trials in %.2f s" % (n, time.time() - start)
+        print "materialized table" if materialized else "parameter tables"
+        for name, duration in measure(mapper, block, repetitions):
+            print "  %8d entities, %-20s %8.2f ms" % (n, name, duration * 1000)
+
+    connection.drop_tables()
+    connection.engine.dispose()
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
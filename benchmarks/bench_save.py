@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares the throughput of `Mapper.save` (one flush per object) with
+`Mapper.save_bulk` (one flush per batch).
+
+Usage::
+
+    python benchmarks/bench_save.py [number of trials] [batch size]
+
+The benchmark uses an in-memory sqlite database unless a ``bench``
+profile is configured in ``~/.xdapy/engine.ini``.
+"""
+
+import sys
+import time
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.errors import ConfigurationError
+
+
+class Trial(Entity):
+    declared_params = {
+        'count': 'integer',
+        'note': 'string',
+        'rotation': 'float',
+        'learning': 'boolean'
+    }
+
+
+def make_connection():
+    try:
+        return Connection.profile("bench")
+    except ConfigurationError:
+        return Connection.memory()
+
+def make_trials(n):
+    for i in xrange(n):
+        yield Trial(count=i, note="trial %d" % i, rotation=i * 0.5, learning=bool(i % 2))
+
+def run(n, save):
+    connection = make_connection()
+    connection.drop_tables()
+    connection.create_tables()
+    mapper = Mapper(connection)
+    mapper.register(Trial)
+
+    start = time.time()
+    save(mapper, make_trials(n))
+    duration = time.time() - start
+
+    assert mapper.find(Trial).count() == n
+
+    connection.drop_tables()
+    connection.engine.dispose()
+    return duration
+
+def main(n=5000, batch_size=1000):
+    modes = [
+        ("save (flush per object)", lambda mapper, trials: mapper.save(*trials)),
+        ("save_bulk (batch_size=%d)" % batch_size, lambda mapper, trials: mapper.save_bulk(trials, batch_size=batch_size)),
+    ]
+
+    for name, save in modes:
+        duration = run(n, save)
+        # every trial stores one entity row and four parameter rows
+        rows = n * (1 + len(Trial.declared_params))
+        print "%-30s %8d entities in %7.2fs: %9.0f rows/s" % (name, n, duration, rows / duration)
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic datasets for the benchmarks.
+
+The entity types are those of ``demo/objects.py``. A dataset of size `n`
+consists of `n` trials, which are distributed over sessions (ten per
+experiment, one experiment per 10000 trials). Every experiment and every
+session is attached to one of the observers as ``"Observer"``::
+
+    Experiment ─┬─ Session ─┬─ Trial
+                │           └─ Trial ...
+                └─ Session ...
+
+The observers are alternately left- and right-handed. All other parameter
+values are derived from a seeded random generator, so that the same size
+always yields the same dataset.
+"""
+
+import datetime
+import os
+import random
+import sys
+
+from xdapy import Connection
+from xdapy.errors import ConfigurationError
+
+# the entity types are those of the demos
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "demo"))
+from objects import Experiment, Observer, Session, Trial
+
+#: The entity types of the datasets.
+ENTITY_TYPES = [Experiment, Observer, Session, Trial]
+
+#: The number of trials per experiment.
+TRIALS_PER_EXPERIMENT = 10000
+
+#: The number of sessions per experiment.
+SESSIONS_PER_EXPERIMENT = 10
+
+#: The number of trials per observer.
+TRIALS_PER_OBSERVER = 5000
+
+
+class Dataset(object):
+    """ The description of a dataset which has been saved by `make_dataset`.
+
+    Attributes
+    ----------
+    size
+        The number of trials.
+    experiments
+        The number of experiments.
+    sessions
+        The number of sessions.
+    observers
+        The number of observers.
+    """
+    def __init__(self, size, experiments, sessions, observers):
+        self.size = size
+        self.experiments = experiments
+        self.sessions = sessions
+        self.observers = observers
+
+    @property
+    def entities(self):
+        """ The total number of entities."""
+        return self.size + self.experiments + self.sessions + self.observers
+
+    def __repr__(self):
+        return "Dataset(size={0}, experiments={1}, sessions={2}, observers={3})".format(
+               self.size, self.experiments, self.sessions, self.observers)
+
+
+def make_connection():
+    """ Returns a connection to the ``bench`` profile in ``~/.xdapy/engine.ini``
+    or, if there is none, to an in-memory sqlite database."""
+    try:
+        return Connection.profile("bench")
+    except ConfigurationError:
+        return Connection.memory()
+
+def make_trials(sessions, n, rng):
+    """ Yields `n` trials, which are distributed evenly over the `sessions`."""
+    for i in xrange(n):
+        trial = Trial(count=i, note="trial %d" % (i % 100), rotation=rng.uniform(0, 360),
+                      learning=rng.random() < 0.5)
+        trial.parent = sessions[i * len(sessions) // n]
+        yield trial
+
+def make_dataset(mapper, n, seed=0, batch_size=1000):
+    """ Saves a dataset with `n` trials with the `mapper`
+    (whose types must include `ENTITY_TYPES`).
+
+    Returns
+    -------
+    dataset: `Dataset`
+    """
+    rng = random.Random(seed)
+
+    observers = []
+    for i in range(max(2, n // TRIALS_PER_OBSERVER)):
+        observers.append(Observer(name="observer %d" % i, initials="O%d" % i,
+                                  birthyear=rng.randint(1950, 2000),
+                                  handedness="left" if i % 2 else "right",
+                                  glasses=rng.random() < 0.3))
+
+    experiments = []
+    sessions = []
+    for i in range(max(1, n // TRIALS_PER_EXPERIMENT)):
+        experiment = Experiment(project="project %d" % i, experimenter="experimenter %d" % (i % 3))
+        experiment.attach("Observer", observers[i % len(observers)])
+        experiments.append(experiment)
+        for j in range(SESSIONS_PER_EXPERIMENT):
+            session = Session(count=j, date=datetime.date(2012, 1, 1) + datetime.timedelta(days=j),
+                              category1=j % 2, category2=j % 3)
+            session.parent = experiment
+            session.attach("Observer", observers[rng.randrange(len(observers))])
+            sessions.append(session)
+
+    mapper.save(*(observers + experiments + sessions))
+    mapper.save_bulk(make_trials(sessions, n, rng), batch_size=batch_size)
+    return Dataset(n, len(experiments), len(sessions), len(observers))
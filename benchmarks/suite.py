@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+"""
+Performance baselines for the mapper, the searches, the IO classes and
+the data storage.
+
+For each size, a synthetic dataset (see ``benchmarks/datasets.py``) is
+saved to a new database and all benchmarks are run on it. The best
+duration of all repetitions is reported, together with the number of
+items (entities, rows or bytes) which one run processed.
+
+Usage::
+
+    python benchmarks/suite.py run [--sizes 1000,10000] [--repetitions 3]
+                                   [--only find_equal,json_roundtrip]
+                                   [--output results.json]
+                                   [--baseline baseline.json] [--tolerance 0.25]
+    python benchmarks/suite.py compare baseline.json results.json [--tolerance 0.25]
+    python benchmarks/suite.py list
+
+The results are written as JSON. In the comparison, every benchmark which
+is slower than the baseline by more than the tolerance (a fraction, e.g.
+``0.25`` for 25 %) is reported as a regression, and the exit status is 1.
+
+Some benchmarks load the whole dataset into memory or scale badly and are
+skipped above their maximal size unless ``--no-limits`` is given; the
+round trips are run only once per size. Sizes up to 10^6 work
+with sqlite, but saving the dataset alone takes several minutes.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+from StringIO import StringIO
+from xml.etree import ElementTree as ET
+
+import sqlalchemy
+
+from xdapy import Connection, Mapper
+from xdapy.io import JsonIO, XmlIO
+from xdapy.operators import between, lt
+from xdapy.structures import BaseEntity
+
+from datasets import ENTITY_TYPES, Observer, Session, Trial, make_connection, make_dataset
+
+#: The default sizes of the datasets.
+DEFAULT_SIZES = [1000, 10000]
+
+#: The default number of repetitions of each benchmark.
+DEFAULT_REPETITIONS = 3
+
+#: The default tolerance of the comparison.
+DEFAULT_TOLERANCE = 0.25
+
+#: The number of entities saved by the ``save`` benchmark.
+SAVE_COUNT = 1000
+
+#: The number of bytes per trial which are written by the data benchmarks.
+DATA_BYTES_PER_TRIAL = 100
+
+
+class Benchmark(object):
+    """ A single benchmark.
+
+    Parameters
+    ----------
+    name: string
+        The name of the benchmark in the results.
+    func: callable
+        Called as ``func(mapper, dataset)`` for every repetition.
+        Returns the number of processed items.
+    max_size: int, optional
+        The largest dataset size at which the benchmark is run.
+    repetitions: int, optional
+        Overrides the number of repetitions.
+    """
+    def __init__(self, name, func, max_size=None, repetitions=None):
+        self.name = name
+        self.func = func
+        self.max_size = max_size
+        self.repetitions = repetitions
+
+    def run(self, mapper, dataset, repetitions):
+        """ Returns the result of the best of `repetitions` runs as a dict."""
+        durations = []
+        items = 0
+        for _ in range(self.repetitions or repetitions):
+            start = time.time()
+            items = self.func(mapper, dataset)
+            durations.append(time.time() - start)
+        best = min(durations)
+        return {"benchmark": self.name,
+                "size": dataset.size,
+                "seconds": best,
+                "mean_seconds": sum(durations) / len(durations),
+                "repetitions": len(durations),
+                "items": items,
+                "items_per_second": items / best if best > 0 else None}
+
+#: All benchmarks in the order in which they are run. Benchmarks which
+#: change the database come last.
+BENCHMARKS = []
+
+def benchmark(name, max_size=None, repetitions=None):
+    """ Adds the decorated function to `BENCHMARKS`."""
+    def register(func):
+        BENCHMARKS.append(Benchmark(name, func, max_size, repetitions))
+        return func
+    return register
+
+
+@benchmark("find_equal")
+def find_equal(mapper, dataset):
+    return len(mapper.find_all(Trial, {"count": dataset.size // 2}))
+
+@benchmark("find_string")
+def find_string(mapper, dataset):
+    return len(mapper.find_all(Trial, {"note": "trial 17", "learning": True}))
+
+@benchmark("find_range")
+def find_range(mapper, dataset):
+    return len(mapper.find_all(Trial, {"count": between(dataset.size // 3, dataset.size // 3 + 100)}))
+
+@benchmark("find_complex")
+def find_complex(mapper, dataset):
+    return len(mapper.find_complex("Session", {"_parent": ("Experiment", {"project": "project 0"}),
+                                               "count": lt(5)}))
+
+@benchmark("find_related")
+def find_related(mapper, dataset):
+    return len(mapper.find_related("Session", ("Observer", {"handedness": "left"})))
+
+@benchmark("get_data_matrix")
+def get_data_matrix(mapper, dataset):
+    return len(mapper.get_data_matrix(Session, {"Observer": ["name", "birthyear"], "Experiment": ["project"]},
+                                      include=["PARENT", "ATTACHMENTS"]))
+
+def _new_mapper(connection):
+    mapper = Mapper(connection)
+    mapper.connection.drop_tables()
+    mapper.connection.create_tables()
+    mapper.register(*ENTITY_TYPES)
+    return mapper
+
+def _target_mapper():
+    """ Returns a mapper for the target of a round trip, which must not
+    share the database with the dataset."""
+    return _new_mapper(Connection.memory())
+
+def _close(mapper):
+    mapper.connection.drop_tables()
+    mapper.connection.engine.dispose()
+
+@benchmark("json_roundtrip", max_size=10000, repetitions=1)
+def json_roundtrip(mapper, dataset):
+    json_string = JsonIO(mapper).write_string(mapper.find_roots())
+    target = _target_mapper()
+    try:
+        return len(JsonIO(target).read_string(json_string))
+    finally:
+        _close(target)
+
+@benchmark("json_stream_roundtrip", max_size=100000, repetitions=1)
+def json_stream_roundtrip(mapper, dataset):
+    json_string = JsonIO(mapper).write_string(mapper.find_roots())
+    target = _target_mapper()
+    try:
+        JsonIO(target).read_stream(StringIO(json_string))
+        return target.find(BaseEntity).count()
+    finally:
+        _close(target)
+
+@benchmark("xml_roundtrip", max_size=1000, repetitions=1)
+def xml_roundtrip(mapper, dataset):
+    xml_string = ET.tostring(XmlIO(mapper, ENTITY_TYPES).write())
+    target = _target_mapper()
+    try:
+        XmlIO(target, ENTITY_TYPES).read(xml_string)
+        return target.find(BaseEntity).count()
+    finally:
+        _close(target)
+
+@benchmark("xml_stream_roundtrip", max_size=100000, repetitions=1)
+def xml_stream_roundtrip(mapper, dataset):
+    xml_string = ET.tostring(XmlIO(mapper, ENTITY_TYPES).write())
+    target = _target_mapper()
+    try:
+        XmlIO(target, ENTITY_TYPES).read_file_streaming(StringIO(xml_string))
+        return target.find(BaseEntity).count()
+    finally:
+        _close(target)
+
+@benchmark("data_put")
+def data_put(mapper, dataset):
+    data = "0123456789" * (DATA_BYTES_PER_TRIAL * dataset.size // 10)
+    observer = mapper.find_first(Observer)
+    with mapper.auto_session:
+        observer.data["benchmark"].put(data)
+    return len(data)
+
+@benchmark("data_get")
+def data_get(mapper, dataset):
+    observer = mapper.find_first(Observer)
+    return len(observer.data["benchmark"].get_string())
+
+@benchmark("save")
+def save(mapper, dataset):
+    session = mapper.find_first(Session)
+    trials = [Trial(count=i, note="saved", rotation=0.0, learning=False) for i in range(SAVE_COUNT)]
+    for trial in trials:
+        trial.parent = session
+    mapper.save(*trials)
+    return len(trials)
+
+
+def run(sizes, repetitions, names=None, limits=True, log=sys.stdout):
+    """ Runs the benchmarks (or only those in `names`) for all `sizes`
+    and returns the results as a dict."""
+    benchmarks = [b for b in BENCHMARKS if names is None or b.name in names]
+    results = []
+    for size in sizes:
+        mapper = _new_mapper(make_connection())
+        start = time.time()
+        dataset = make_dataset(mapper, size)
+        duration = time.time() - start
+        results.append({"benchmark": "save_bulk", "size": size, "seconds": duration, "mean_seconds": duration,
+                        "repetitions": 1, "items": dataset.entities, "items_per_second": dataset.entities / duration})
+        log.write(format_result(results[-1]) + "\n")
+
+        for bench in benchmarks:
+            if limits and bench.max_size is not None and size > bench.max_size:
+                log.write("{0:<22} {1:>9} skipped (larger than {2})\n".format(bench.name, size, bench.max_size))
+                continue
+            results.append(bench.run(mapper, dataset, repetitions))
+            log.write(format_result(results[-1]) + "\n")
+        _close(mapper)
+
+    return {"date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "results": results}
+
+def format_result(result):
+    rate = result["items_per_second"]
+    return "{0:<22} {1:>9} {2:>10.2f} ms {3:>14}".format(
+           result["benchmark"], result["size"], result["seconds"] * 1000,
+           "{0:.0f} items/s".format(rate) if rate else "")
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE, log=sys.stdout):
+    """ Compares the best durations of `results` with those of `baseline`.
+
+    Returns
+    -------
+    regressions: list of dicts
+        The results which are slower than the baseline by more than `tolerance`.
+    """
+    old = dict(((r["benchmark"], r["size"]), r) for r in baseline["results"])
+    regressions = []
+    log.write("{0:<22} {1:>9} {2:>12} {3:>12} {4:>8}\n".format("benchmark", "size", "baseline ms", "current ms", "ratio"))
+    for result in results["results"]:
+        key = (result["benchmark"], result["size"])
+        if key not in old:
+            continue
+        ratio = result["seconds"] / old[key]["seconds"] if old[key]["seconds"] > 0 else 1.0
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(result)
+        log.write("{0:<22} {1:>9} {2:>12.2f} {3:>12.2f} {4:>8.2f}{5}\n".format(
+                  key[0], key[1], old[key]["seconds"] * 1000, result["seconds"] * 1000, ratio,
+                  "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def _load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the xdapy benchmarks.")
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                            help="comma-separated numbers of trials (default: %(default)s)")
+    run_parser.add_argument("--repetitions", type=int, default=DEFAULT_REPETITIONS)
+    run_parser.add_argument("--only", help="comma-separated names of the benchmarks to run")
+    run_parser.add_argument("--no-limits", action="store_true",
+                            help="also run benchmarks above their maximal size")
+    run_parser.add_argument("--output", help="the file for the JSON results")
+    run_parser.add_argument("--baseline", help="compare with the results in this file")
+    run_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    commands.add_parser("list", help="list the benchmarks")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for bench in BENCHMARKS:
+            print bench.name
+        return 0
+
+    if args.command == "run":
+        names = args.only.split(",") if args.only else None
+        results = run([int(size) for size in args.sizes.split(",")], args.repetitions, names,
+                      limits=not args.no_limits)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if not args.baseline:
+            return 0
+        baseline = _load(args.baseline)
+    else:
+        baseline, results = _load(args.baseline), _load(args.results)
+
+    regressions = compare(baseline, results, args.tolerance)
+    if regressions:
+        print "%d regression(s) above %.0f %%." % (len(regressions), args.tolerance * 100)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
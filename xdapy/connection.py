@@ -15,11 +15,13 @@ from os import path
 from contextlib import contextmanager
 import ConfigParser
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.schema import CreateColumn, CreateIndex
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from xdapy import Base
 from xdapy.errors import ConfigurationError, DatabaseError
+from xdapy.instrumentation import Instrumentation, SlowQueryLog
 
 ALLOWED_ENGINES = ["sqlite", "postgresql"]
 
@@ -66,6 +68,22 @@ def _options_from_config(filename, section):
     except ConfigParser.NoOptionError:
         pass
 
+    try:
+        options["slow_query_threshold"] = config.getfloat(section, "slow_query_threshold")
+    except ConfigParser.NoOptionError:
+        pass
+
+    try:
+        options["slow_query_log"] = config.get(section, "slow_query_log")
+    except ConfigParser.NoOptionError:
+        pass
+
+    try:
+        from xdapy.storage import FileSystemStore
+        options["data_store"] = FileSystemStore(config.get(section, "data_store"))
+    except ConfigParser.NoOptionError:
+        pass
+
     return options
 
 class Connection(object):
@@ -82,6 +100,14 @@ class Connection(object):
         Print all SQL queries to stdout. (Defaults to ``False``.)
     check_empty: bool
         If true, this the method `create_tables` raises an `DatabaseError` if the database is not empty.
+    data_store: `xdapy.storage.DataStore`, optional
+        A store which keeps the binary data outside of the database.
+        (Defaults to ``None``, in which case data is stored in the database.)
+    slow_query_threshold: float, optional
+        Log all statements which take longer than this many seconds
+        (see `log_slow_queries`). (Defaults to ``None``, no logging.)
+    slow_query_log: string, optional
+        The file to which the slow statements are written.
     session_opts: dict, optional
         Key–value options to pass to the `sessionmaker()` function.
     engine_opts: dict, optional
@@ -93,11 +119,21 @@ class Connection(object):
         The constructed database URL.
     Session
         The SQLAlchemy session.
+    data_store
+        The store for binary data or None.
 
     """
 
-    def __init__(self, url=None, echo=False, check_empty=False, session_opts=None, engine_opts=None):
+    def __init__(self, url=None, echo=False, check_empty=False, data_store=None, session_opts=None, engine_opts=None,
+                 slow_query_threshold=None, slow_query_log=None):
         self.url = url
+        self.data_store = data_store
+        #: The `xdapy.materialize.Materializer` of this connection, if any
+        #: entity types are materialized. (See `xdapy.mapper.Mapper.materialize`.)
+        self.materializer = None
+        #: The `xdapy.instrumentation.Instrumentation` of this connection,
+        #: if it has been switched on with `instrument`.
+        self.instrumentation = None
 
         if session_opts is None:
             session_opts = {}
@@ -121,6 +157,9 @@ class Connection(object):
 
         _check_engine(self.engine)
 
+        if slow_query_threshold is not None:
+            self.log_slow_queries(slow_query_threshold, slow_query_log)
+
 
     #: Path of the configuration file.
     DEFAULT_CONFIG_PATH = "~/.xdapy/engine.ini"
@@ -140,6 +179,9 @@ class Connection(object):
             # url syntax: {dialect}://{user}:{password}@{host}/{dbname}
             [default]
             url = postgresql://hannah@localhost/xdapy
+            # log statements slower than 0.5 s
+            slow_query_threshold = 0.5
+            slow_query_log = ~/.xdapy/slow_queries.log
             [test]
             # url syntax for sqlite
             url = sqlite:///test.db
@@ -263,6 +305,8 @@ class Connection(object):
         """
         if not self._session:
             self._session = self.Session(bind=self.engine)
+            # make the store available to the data objects in this session
+            self._session.data_store = self.data_store
         return self._session
 
     @property
@@ -275,6 +319,50 @@ class Connection(object):
     def engine_name(self):
         return self.engine.name
 
+    def instrument(self):
+        """ Switches on the recording of statement counts, timings and
+        fetched rows for the calls of the mappers on this connection.
+
+        Returns
+        -------
+        instrumentation: `xdapy.instrumentation.Instrumentation`
+            The instrumentation, whose `stats` hold the recorded values.
+        """
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation(self)
+        self.instrumentation.enabled = True
+        return self.instrumentation
+
+    def log_slow_queries(self, threshold, filename=None, **kwargs):
+        """ Logs all statements which take longer than `threshold` seconds,
+        together with their parameters, the `xdapy.mapper.Mapper` method
+        which executed them and the query plan, to the logger
+        ``xdapy.slow_queries`` and, if given, to the rotating file `filename`.
+
+        The logger is shared by all connections of the process; the file
+        only receives the statements of this connection.
+        A `threshold` of ``None`` switches the logging off.
+
+        Parameters
+        ----------
+        threshold: float or None
+            The duration in seconds from which on statements are logged.
+        filename: string, optional
+            The log file.
+        **kwargs
+            All other arguments are passed to `xdapy.instrumentation.SlowQueryLog`.
+        """
+        if self.instrumentation is None:
+            # only the calls are tracked; statistics need `instrument`
+            self.instrumentation = Instrumentation(self)
+            self.instrumentation.enabled = False
+        if self.instrumentation.slow_query_log is not None:
+            self.instrumentation.slow_query_log.close()
+            self.instrumentation.slow_query_log = None
+        if threshold is not None:
+            self.instrumentation.slow_query_log = SlowQueryLog(threshold, filename, **kwargs)
+        return self.instrumentation.slow_query_log
+
     def _table_names(self):
         return self.engine.table_names()
 
@@ -298,12 +386,104 @@ class Connection(object):
 
         Base.metadata.create_all(bind=self.engine, checkfirst=True)
 
+    def upgrade_tables(self, concurrently=False):
+        """
+        Adds all columns and indexes which are missing in the existing xdapy tables
+        (e.g. after an update of xdapy) and creates missing tables.
+
+        Parameters
+        ----------
+        concurrently: bool, optional
+            If true, indexes on PostgreSQL are built with ``CREATE INDEX CONCURRENTLY``,
+            which does not lock the tables against writes.
+
+        Returns
+        -------
+        added: list
+            The names (``table.column``) of the added columns
+            and the names of the created indexes.
+        """
+        from xdapy.parameters import copy_parameter_names, _parameter_classes
+
+        inspector = inspect(self.engine)
+        existing_tables = inspector.get_table_names()
+
+        added = []
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                if table.name not in existing_tables:
+                    continue
+                existing_columns = set(column["name"] for column in inspector.get_columns(table.name))
+                for column in table.columns:
+                    if column.name in existing_columns:
+                        continue
+                    column_sql = CreateColumn(column).compile(dialect=self.engine.dialect)
+                    connection.execute("ALTER TABLE {0} ADD COLUMN {1}".format(
+                        self.engine.dialect.identifier_preparer.format_table(table), column_sql))
+                    added.append(table.name + "." + column.name)
+
+            # the typed parameter tables have a copy of the parameter name
+            copy_parameter_names(connection, [pc for pc in _parameter_classes
+                                              if pc.__tablename__ + ".name" in added])
+
+        # create missing tables and indexes of new tables
+        Base.metadata.create_all(bind=self.engine, checkfirst=True)
+
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = set(index["name"] for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    self._create_index(index, concurrently)
+                    added.append(index.name)
+        return added
+
+    def _create_index(self, index, concurrently=False):
+        """ Creates `index`, if requested without locking the table (PostgreSQL only)."""
+        if not (concurrently and self.engine_name == "postgresql"):
+            index.create(bind=self.engine)
+            return
+
+        ddl = str(CreateIndex(index).compile(dialect=self.engine.dialect))
+        ddl = ddl.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        connection = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            connection.execute(ddl)
+        finally:
+            connection.close()
+
     def drop_tables(self):
         """
         Drops all xdapy tables.
         """
+        if self.materializer is not None:
+            self.materializer.drop()
         Base.metadata.drop_all(bind=self.engine)
 
     def __repr__(self):
         return "Connection(url=%r)" % self.url
 
+
+
+def main(argv=None):
+    """ Command line interface for `Connection.upgrade_tables`::
+
+        python -m xdapy.connection [--profile PROFILE] [--config FILE] [--concurrently]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Adds missing columns, tables and indexes to an xdapy database.")
+    parser.add_argument("--profile", default=Connection.DEFAULT_PROFILE, help="the connection profile to use")
+    parser.add_argument("--config", default=None, help="the configuration file of the profiles")
+    parser.add_argument("--concurrently", action="store_true",
+                        help="build indexes without locking the tables (PostgreSQL only)")
+    args = parser.parse_args(argv)
+
+    connection = Connection.profile(args.profile, filename=args.config)
+    for name in connection.upgrade_tables(concurrently=args.concurrently):
+        print "added", name
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,17 @@
 Classes for binary data storage.
 """
 
+# xdapy.io would otherwise shadow the io module of the standard library
+from __future__ import absolute_import
+
 __docformat__ = "restructuredtext"
 
 __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 
+import bisect
 import collections
-import tempfile
+import io
 
 try:
     # check, if the faster version of StringIO is available
@@ -18,8 +22,8 @@ try:
 except ImportError:
     from StringIO import StringIO
 
-from sqlalchemy import Column, ForeignKey, String, Integer
-from sqlalchemy import func
+from sqlalchemy import Column, ForeignKey, String, Integer, BigInteger
+from sqlalchemy import func, literal, select
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.orm import relationship, validates, synonym
 from sqlalchemy.ext.declarative import synonym_for
@@ -37,6 +41,9 @@ DATA_CHUNK_SIZE = 5 * 1000 * 1000 # Byte
 #: This must be greater or equal than `DATA_CHUNK_SIZE`.
 DATA_COLUMN_LENGTH = DATA_CHUNK_SIZE
 
+#: The number of chunks which a `_ChunkReader` keeps in memory.
+CHUNK_CACHE_SIZE = 2
+
 class DataChunks(Base):
     """Data are divided into smaller chunks of size `DATA_CHUNK_SIZE` to avoid
     that everything is loaded all at once when accessing the data.
@@ -106,6 +113,12 @@ class Data(Base):
     key = Column('key', String(40))
     mimetype = Column('mimetype', String(40))
 
+    #: The digest of the content, if it is kept in a `xdapy.storage.DataStore`.
+    #: If this is ``None``, the content is stored in the data chunks.
+    digest = Column('digest', String(128), index=True)
+    #: The size of the content in bytes.
+    size = Column('size', BigInteger)
+
     _chunks = relationship(DataChunks, cascade="all, delete-orphan")
 
     __tablename__ = 'data'
@@ -151,6 +164,21 @@ class _DataProxy(object):
         # makes code more readable
         return self.assoc.owning._session()
 
+    @property
+    def __store(self):
+        """Returns the `DataStore` of the session or None."""
+        return getattr(self.__session, "data_store", None)
+
+    def _store_for(self, data):
+        """Returns the store which holds the content of `data`
+        or None, if the content is stored in data chunks."""
+        if data.digest is None:
+            return None
+        store = self.__store
+        if store is None:
+            raise DataInconsistencyError("Data {0!r} is kept in a data store but the connection has none.".format(data))
+        return store
+
     @property
     def __data(self):
         """Returns the data relation object of the associated entity.
@@ -220,9 +248,11 @@ class _DataProxy(object):
         """ Clears all data chunks for `self.key`. (But keeps the data reference intact.)
         """
         data = self.get_data()
-        for ch in data._chunks:
-            self.__session.delete(ch)
-            self.__session.flush()
+        # delete without loading the chunks
+        self.__session.query(DataChunks).filter(DataChunks.data_id == data.id).delete()
+        self.__session.expire(data, ['_chunks'])
+        data.digest = None
+        data.size = 0
 
     def put(self, file_or_str, mimetype=None):
         """ Store data from a file or a string object.
@@ -271,6 +301,15 @@ class _DataProxy(object):
         data = self.get_or_create_data()
         self.clear_data()
 
+        store = self.__store
+        if store is not None:
+            data.digest, data.size = store.put_file(fileish)
+            self.__session.flush()
+            return
+
+        data.digest = None
+        data.size = 0
+
         buffer_size = DATA_CHUNK_SIZE
         idx = 0
 
@@ -278,6 +317,7 @@ class _DataProxy(object):
 
         while chunk:
             idx += 1
+            data.size += len(chunk)
             chunk = DataChunks(idx, chunk)
             data._chunks.append(chunk)
 
@@ -288,6 +328,52 @@ class _DataProxy(object):
 
         self.__session.flush()
 
+    def copy_from(self, other):
+        """ Replaces the data with a copy of the data and mimetype of `other`.
+
+        If both proxies belong to the same database, the copy is done inside
+        the database (or, for data in a `xdapy.storage.DataStore`, by sharing
+        the stored content), without moving the data through Python.
+        Otherwise, the chunks are streamed from one database to the other.
+
+        Parameters
+        ----------
+        other: _DataProxy
+            The data to copy.
+        """
+        source = other.get_data()
+        mimetype = source.mimetype
+
+        same_database = self.__session.bind is other.__session.bind
+        same_store = source.digest is None or other._store_for(source) is self.__store
+        if not (same_database and same_store):
+            # stream the data, one chunk at a time
+            with other.open(cache_size=1) as f:
+                self.put_file(f)
+            self.get_data().mimetype = mimetype
+            return
+
+        data = self.get_or_create_data()
+        if data.id == source.id:
+            return
+        self.clear_data()
+
+        if source.digest is not None:
+            # the content is shared in the store
+            data.digest, data.size = source.digest, source.size
+        else:
+            chunks = DataChunks.__table__
+            copy = chunks.insert().from_select(
+                [chunks.c.data_id, chunks.c.index, chunks.c.data, chunks.c.length],
+                select([literal(data.id), chunks.c.index, chunks.c.data, chunks.c.length]).\
+                       where(chunks.c.data_id == source.id))
+            self.__session.execute(copy)
+            self.__session.expire(data, ['_chunks'])
+            data.digest = None
+            data.size = source.size
+        data.mimetype = mimetype
+        self.__session.flush()
+
     def _chunk_query(self, *entities, **kwargs):
         """ Returns a query which is restricted to data chunks with the
         `data_id` of this `_DataProxy`.
@@ -315,9 +401,44 @@ class _DataProxy(object):
         fileish: file-like object
             The file to hold the data.
         """
+        data = self.get_data()
+        store = self._store_for(data)
+        if store is not None:
+            store.get(data.digest, fileish)
+            return
+
         for chunk in self._chunk_query(DataChunks.chunk).order_by(DataChunks.index):
             fileish.write(chunk.chunk) # self._data[gen_key].data)
 
+    def open(self, cache_size=CHUNK_CACHE_SIZE):
+        """ Returns a seekable, read-only file object for the data.
+
+        Only those data chunks which are needed to serve a read are
+        fetched from the database, so that small windows of large data
+        may be accessed cheaply::
+
+            with entity.data["recording"].open() as f:
+                f.seek(4 * start)
+                window = numpy.frombuffer(f.read(4 * count), dtype=numpy.float32)
+
+        For data in a `xdapy.storage.FileSystemStore`, the stored file
+        is opened directly (and may thus also be used with ``numpy.fromfile``).
+
+        Parameters
+        ----------
+        cache_size: int, optional
+            The number of recently read chunks which are kept in memory.
+
+        Returns
+        -------
+        fileish: file-like object
+        """
+        data = self.get_data()
+        store = self._store_for(data)
+        if store is not None:
+            return store.open(data.digest)
+        return _ChunkReader(self.__session, data.id, cache_size)
+
     def get_string(self):
         """ Explicitly return the data as a string.
 
@@ -334,8 +455,11 @@ class _DataProxy(object):
             string_io.close()
 
     def size(self):
-        """ Returns the size of all data chunks.
+        """ Returns the size of the data.
         """
+        data = self.get_data()
+        if data.digest is not None:
+            return data.size
         return self._chunk_query(func.sum(DataChunks.length)).scalar()
 
     def chunks(self):
@@ -344,7 +468,15 @@ class _DataProxy(object):
         return self._chunk_query(DataChunks.id).count()
 
     def check_consistency(self):
-        """Checks that data chunks are indexed in order without gaps."""
+        """Checks that data chunks are indexed in order without gaps
+        or, for data in a store, that the stored content has the correct size."""
+        data = self.get_data()
+        store = self._store_for(data)
+        if store is not None:
+            if not store.exists(data.digest) or store.size(data.digest) != data.size:
+                raise DataInconsistencyError("Stored data is inconsistent.")
+            return True
+
         check = 1
         for idx in self._chunk_query(DataChunks.index).order_by(DataChunks.index):
             if check != idx.index:
@@ -356,6 +488,110 @@ class _DataProxy(object):
         return "DataProxy(mimetype={0}, chunks={1}, size={2})".format(self.mimetype, self.chunks(), self.size())
 
 
+class _ChunkReader(io.RawIOBase):
+    """ A seekable, read-only file object over the data chunks of a `Data` object.
+
+    The offsets of the chunks are computed from their stored lengths once,
+    chunk contents are fetched lazily and the most recently used
+    `cache_size` chunks are kept in memory.
+
+    Usually, this class is not instantiated directly but through `_DataProxy.open`.
+
+    Parameters
+    ----------
+    session: Session
+        The session to query the chunks with.
+    data_id: int
+        The id of the `Data` object.
+    cache_size: int, optional
+        The number of chunks to keep in memory.
+    """
+    def __init__(self, session, data_id, cache_size=CHUNK_CACHE_SIZE):
+        super(_ChunkReader, self).__init__()
+        self._session = session
+        self._cache_size = max(cache_size, 1)
+        self._cache = collections.OrderedDict()
+
+        chunks = session.query(DataChunks.id, DataChunks.length).\
+                            filter(DataChunks.data_id == data_id).\
+                            order_by(DataChunks.index).all()
+        self._chunk_ids = [chunk.id for chunk in chunks]
+        # _offsets[i] is the position of the first byte of chunk i
+        self._offsets = [0]
+        for chunk in chunks:
+            self._offsets.append(self._offsets[-1] + chunk.length)
+        self._position = 0
+
+    @property
+    def size(self):
+        """ The size of the data in bytes."""
+        return self._offsets[-1]
+
+    def _chunk(self, i):
+        """ Returns the content of the chunk at position `i`."""
+        try:
+            chunk = self._cache.pop(i)
+        except KeyError:
+            chunk = self._session.query(DataChunks.chunk).\
+                                  filter(DataChunks.id == self._chunk_ids[i]).scalar()
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+        self._cache[i] = chunk
+        return chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({0}).".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {0}.".format(position))
+        self._position = position
+        return position
+
+    def read(self, size=-1):
+        """ Reads at most `size` bytes (or everything up to the end of the data,
+        if `size` is negative) from the current position."""
+        self._checkClosed()
+        end = self.size if size is None or size < 0 else min(self._position + size, self.size)
+
+        pieces = []
+        while self._position < end:
+            i = bisect.bisect_right(self._offsets, self._position) - 1
+            start = self._position - self._offsets[i]
+            stop = min(end, self._offsets[i + 1]) - self._offsets[i]
+            pieces.append(self._chunk(i)[start:stop])
+            self._position = self._offsets[i] + stop
+        return "".join(pieces)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        content = self.read(len(b))
+        b[:len(content)] = content
+        return len(content)
+
+    def close(self):
+        self._cache.clear()
+        super(_ChunkReader, self).close()
+
+
 class _DataAssoc(collections.MutableMapping):
     """ Association dict for data.
 
@@ -384,14 +620,7 @@ class _DataAssoc(collections.MutableMapping):
         if not isinstance(value, _DataProxy):
             raise ValueError("value needs to be instance of DataProxy")
         # """Note that this is only expected to work if value *really* has the same semantics."""
-
-        # We use a tempfile as long as chunk based copying is not established
-        with tempfile.TemporaryFile() as f:
-            value.get(f)
-            f.seek(0) # Reset the file pointer, otherwise we'll only see EOF
-            self[key].put(f)
-
-        self[key].mimetype = value.mimetype
+        self[key].copy_from(value)
 
     def __len__(self):
         return len(self.owning._data)
@@ -9,8 +9,13 @@ __docformat__ = "restructuredtext"
 
 __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
+from sqlalchemy.sql import and_, or_, exists
+from sqlalchemy.sql.expression import ClauseElement
+
 from xdapy.errors import SearchError
-from xdapy.structures import Entity
+from xdapy.parameters import parameter_for_type, parameter_exists
+from xdapy.operators import Missing, is_sql_operator
+from xdapy.structures import BaseEntity, Entity, Context
 
 class SearchProxy(object):
     """ Builds a representation of a search tree.
@@ -28,6 +33,11 @@ class SearchProxy(object):
     {k1: v1, k2: v2} -> ("_all": [(k1, v1), (k2, v2)])
 
     [it1, it2, it3] -> [it1, it2, it3]
+
+    Before anything is loaded from the database, the tree is compiled
+    into an SQL clause (see `sql_clause`). Only those parts which cannot
+    be expressed in SQL (most notably ``_with`` functions) need to be
+    checked in Python afterwards.
     """
     def __init__(self, inner, stack=None, parent=None):
         self.inner = inner
@@ -83,13 +93,36 @@ class SearchProxy(object):
             #print self.inner[0]
             self.inner = self.inner[1]
 
-    def find(self, mapper):
-        return self.inner.find(mapper)
+    def find(self, mapper, load=None):
+        return self.inner.find(mapper, load)
 
     def is_valid(self, item):
         #print type(self)
         return self.inner.is_valid(item)
 
+    def sql_clause(self, mapper, entities, klass):
+        """ Compiles the search tree into an SQL clause.
+
+        Parameters
+        ----------
+        mapper: Mapper
+            The mapper which is used to look up entity classes.
+        entities: table
+            The (possibly aliased) `entities` table which the clause refers to.
+        klass: subclass of Entity or None
+            The entity class of the rows in `entities`, if known.
+
+        Returns
+        -------
+        (clause, exact): tuple
+            `clause` is a necessary condition for `is_valid` or ``None``
+            if there is no restriction. If `exact` is true, the clause
+            is also sufficient and `is_valid` need not be called anymore.
+        """
+        if isinstance(self.inner, SearchProxy):
+            return self.inner.sql_clause(mapper, entities, klass)
+        return None, False
+
     def all_parents(self):
         """ Traverses all parents
         """
@@ -110,21 +143,43 @@ class BooleanProxy(SearchProxy):
         if not isinstance(self.inner, list):
             raise ValueError("Boolean search can only work on a list.")
 
+    def _inner_clauses(self, mapper, entities, klass):
+        return [i.sql_clause(mapper, entities, klass) for i in self.inner]
+
 class _any(BooleanProxy):
     """Returns True, if the search succeeds for one or more inner items."""
     def is_valid(self, item):
         return any(i.is_valid(item) for i in self.inner)
 
+    def sql_clause(self, mapper, entities, klass):
+        inner = self._inner_clauses(mapper, entities, klass)
+        # a single unrestricted alternative lifts the restriction altogether
+        if not inner or any(clause is None for clause, exact in inner):
+            return None, False
+        return or_(*[clause for clause, exact in inner]), all(exact for clause, exact in inner)
+
 class _all(BooleanProxy):
     """Returns True, if the search succeeds for all inner items."""
     def is_valid(self, item):
         return all(i.is_valid(item) for i in self.inner)
 
+    def sql_clause(self, mapper, entities, klass):
+        inner = self._inner_clauses(mapper, entities, klass)
+        clauses = [clause for clause, exact in inner if clause is not None]
+        exact = all(exact for clause, exact in inner)
+        if not clauses:
+            return None, exact
+        return and_(*clauses), exact
+
 class _with(SearchProxy):
     """Applies the inner value as function to an item."""
     def is_valid(self, item):
         return self.inner(item)
 
+    def sql_clause(self, mapper, entities, klass):
+        # arbitrary Python functions can only be checked in Python
+        return None, False
+
 class _param(SearchProxy):
     def __init__(self, key, value, stack, parent):
         super(_param, self).__init__(value, stack, parent)
@@ -133,14 +188,48 @@ class _param(SearchProxy):
     def is_valid(self, item):
         if self.key == "_id":
             return self.test_param(item.id, self.inner)
+        if isinstance(self.inner, Missing):
+            return self.key not in item.params
 
         return self.test_param(item.params[self.key], self.inner)
 
     def test_param(self, param, test):
-        if isinstance(test, basestring):
+        if not callable(test):
             return param == test
         return test(param)
 
+    def sql_test(self, column, test):
+        """ Returns the SQL equivalent of `test_param` or ``None``.
+
+        Only the operators from `xdapy.operators` are translated. Other
+        callables are checked in Python, since ``and`` or ``or`` in their
+        body would yield a wrong clause.
+        """
+        if not callable(test):
+            return column == test
+        if not is_sql_operator(test):
+            return None
+        clause = test(column)
+        if isinstance(clause, ClauseElement):
+            return clause
+        return None
+
+    def sql_clause(self, mapper, entities, klass):
+        if self.key == "_id":
+            clause = self.sql_test(entities.c.id, self.inner)
+            return clause, clause is not None
+
+        if klass is None or self.key not in klass.declared_params:
+            return None, False
+        parameter_class = parameter_for_type(klass.declared_params[self.key])
+        if isinstance(self.inner, Missing):
+            return ~parameter_exists(entities.c.id, self.key, parameter_class), True
+
+        clause = self.sql_test(parameter_class.value, self.inner)
+        if clause is None:
+            return None, False
+        return parameter_exists(entities.c.id, self.key, parameter_class, clause), True
+
     @property
     def _type_repr(self):
         return "param:" + self.key
@@ -155,11 +244,45 @@ class _entity(SearchProxy):
         # FIXME: Is this the correct solution?
         return (item == self.key or item.type == self.key) and self.inner.is_valid(item)
 
-    def find(self, mapper):
-        # TODO: This retrieves everything. Should do some filtering before, if possible.
-        items = mapper.find_all(self.key)
-        #print items
-        return [item for item in items if self.is_valid(item)]
+    def _entity_classes(self, mapper):
+        """ Returns all registered classes whose `type` matches the key."""
+        if isinstance(self.key, basestring):
+            return mapper.registry.by_original_name(self.key)
+        return []
+
+    def sql_clause(self, mapper, entities, klass):
+        if isinstance(self.key, Entity):
+            if self.key.id is None:
+                return None, False
+            clause, exact = self.inner.sql_clause(mapper, entities, self.key.__class__)
+            return and_(entities.c.id == self.key.id, *([clause] if clause is not None else [])), exact
+
+        classes = self._entity_classes(mapper)
+        if not classes:
+            return None, False
+        klass = classes[0] if len(classes) == 1 else None
+
+        type_clause = entities.c.type.in_([cls.__name__ for cls in classes])
+        clause, exact = self.inner.sql_clause(mapper, entities, klass)
+        if clause is None:
+            return type_clause, exact
+        return and_(type_clause, clause), exact
+
+    def find(self, mapper, load=None):
+        if isinstance(self.key, Entity):
+            items = mapper.find_all(self.key, load=load)
+            return [item for item in items if self.is_valid(item)]
+
+        klass = mapper.entity_by_name(self.key)
+        clause, exact = self.inner.sql_clause(mapper, BaseEntity.__table__, klass)
+
+        items = mapper.find(klass, load=load)
+        if clause is not None:
+            items = items.filter(clause)
+        if exact:
+            return items.all()
+        # the type has already been checked by the query
+        return [item for item in items if self.inner.is_valid(item)]
 
     @property
     def _type_repr(self):
@@ -169,12 +292,40 @@ class _parent(SearchProxy):
     def is_valid(self, item):
         return self.inner.is_valid(item.parent)
 
+    def sql_clause(self, mapper, entities, klass):
+        parent = BaseEntity.__table__.alias()
+        clause, exact = super(_parent, self).sql_clause(mapper, parent, None)
+        clauses = [parent.c.id == entities.c.parent_id]
+        if clause is not None:
+            clauses.append(clause)
+        return exists().where(and_(*clauses)), exact
+
 class _child(SearchProxy):
     def is_valid(self, item):
         return any(self.inner.is_valid(child) for child in item.children)
 
+    def sql_clause(self, mapper, entities, klass):
+        child = BaseEntity.__table__.alias()
+        clause, exact = super(_child, self).sql_clause(mapper, child, None)
+        clauses = [child.c.parent_id == entities.c.id]
+        if clause is not None:
+            clauses.append(clause)
+        return exists().where(and_(*clauses)), exact
+
 class _context(SearchProxy):
     def is_valid(self, item):
         key = self.stack[-1]
         connection_type = key[1]
         return any(self.inner.is_valid(connected) for connected in item.context[connection_type])
+
+    def sql_clause(self, mapper, entities, klass):
+        connection_type = self.stack[-1][1]
+        contexts = Context.__table__.alias()
+        attachment = BaseEntity.__table__.alias()
+        clause, exact = super(_context, self).sql_clause(mapper, attachment, None)
+        clauses = [contexts.c.entity_id == entities.c.id,
+                   contexts.c.connection_type == connection_type,
+                   attachment.c.id == contexts.c.connected_id]
+        if clause is not None:
+            clauses.append(clause)
+        return exists().where(and_(*clauses)), exact
@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in instrumentation of the database access.
+
+An `Instrumentation` listens to the statements which are sent to the engine
+of a connection and attributes them to the `Mapper` call (or the `JoinQuery`
+and IO call) during which they were executed. For every call, it records the
+number of calls, the number of SQL statements, the wall time, the time spent
+in the database, the number of rows fetched and the number of bytes of data
+chunks which were read or written::
+
+    instrumentation = connection.instrument()
+    mapper.find_all(Trial, {"rt": gt(0.5)})
+    print instrumentation.stats.report()
+
+    with mapper.measure() as stats:
+        for trial in mapper.find_all(Trial):
+            trial.parent
+    assert stats.total.statements < 10
+
+Statements are attributed to the outermost instrumented call only, so that
+the statements of `Mapper.find_all` are not counted again for `Mapper.find`.
+Statements which are executed outside of any instrumented call – for example,
+lazy loads of relations or the iteration of a query returned by
+`Mapper.find` – are attributed to `OUTSIDE`. A large number of statements
+there usually means that a relation should be loaded eagerly.
+
+Statements which take longer than a threshold may additionally be logged
+together with their parameters, the call and the query plan of the database
+(see `SlowQueryLog` and `xdapy.connection.Connection.log_slow_queries`).
+
+.. note::
+
+    Only data chunks which are stored in the database are counted.
+    Data in an external `xdapy.storage.DataStore` are not seen.
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+import functools
+import inspect
+import logging
+import logging.handlers
+import threading
+import time
+from contextlib import contextmanager
+from os import path
+
+from sqlalchemy import event
+
+#: The name under which statements outside of instrumented calls are recorded.
+OUTSIDE = "(outside)"
+
+#: The table whose binary content is counted in `CallStats.bytes`.
+CHUNK_TABLE = "data_chunks"
+
+#: The logger of `SlowQueryLog`.
+slow_query_logger = logging.getLogger("xdapy.slow_queries")
+
+#: The size in Byte after which a slow query log file is rotated.
+SLOW_QUERY_LOG_SIZE = 10 * 1000 * 1000
+
+#: The number of rotated slow query log files which are kept.
+SLOW_QUERY_LOG_BACKUPS = 5
+
+#: The prefixes which ask the database for the plan of a statement.
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+}
+
+#: The kinds of statements whose plan is requested. Others (e.g. DDL) may
+#: not be explained and a failing EXPLAIN could break the transaction.
+EXPLAINED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+#: The name of the savepoint around an EXPLAIN.
+EXPLAIN_SAVEPOINT = "xdapy_explain"
+
+#: The maximal length of the parameters in a log message.
+MAX_PARAMETERS_LENGTH = 1000
+
+
+def _binary_size(values):
+    """ Returns the summed length of all binary strings in `values`."""
+    size = 0
+    for value in values:
+        if isinstance(value, (str, buffer, bytearray)):
+            size += len(value)
+    return size
+
+def _parameter_size(parameters, executemany):
+    """ Returns the number of bytes of binary data in the bound parameters."""
+    if not executemany:
+        parameters = [parameters]
+    size = 0
+    for params in parameters:
+        size += _binary_size(params.values() if isinstance(params, dict) else params)
+    return size
+
+
+class CallStats(object):
+    """ The accumulated costs of the calls to a single method.
+
+    Attributes
+    ----------
+    calls
+        The number of calls.
+    statements
+        The number of SQL statements which were executed. An ``executemany``
+        counts as a single statement.
+    time
+        The wall time of the calls in seconds.
+    sql_time
+        The time spent executing the statements in seconds.
+    rows
+        The number of rows fetched from the database.
+    bytes
+        The number of bytes of data chunks which were read or written.
+    """
+    FIELDS = ("calls", "statements", "time", "sql_time", "rows", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.statements = 0
+        self.time = 0.0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, other):
+        """ Adds the values of the `CallStats` `other`."""
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __repr__(self):
+        return "CallStats({0})".format(", ".join("{0}={1!r}".format(field, getattr(self, field))
+                                                 for field in self.FIELDS))
+
+
+class QueryStats(object):
+    """ The `CallStats` of all instrumented methods.
+
+    Values may be read with ``stats["Mapper.find_all"]``, which returns
+    an empty `CallStats` for methods which have not been called.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def record(self, name, **values):
+        """ Adds the `values` (keyword arguments named like the
+        fields of `CallStats`) to the stats of `name`."""
+        with self._lock:
+            stats = self._calls.get(name)
+            if stats is None:
+                stats = self._calls[name] = CallStats()
+            for field, value in values.iteritems():
+                setattr(stats, field, getattr(stats, field) + value)
+
+    def reset(self):
+        """ Removes all recorded values."""
+        with self._lock:
+            self._calls.clear()
+
+    @property
+    def names(self):
+        """ The sorted names of all recorded methods."""
+        return sorted(self._calls)
+
+    @property
+    def total(self):
+        """ The sum of the `CallStats` of all methods."""
+        total = CallStats()
+        with self._lock:
+            for stats in self._calls.itervalues():
+                total.add(stats)
+        return total
+
+    def __getitem__(self, name):
+        with self._lock:
+            stats = CallStats()
+            if name in self._calls:
+                stats.add(self._calls[name])
+            return stats
+
+    def __contains__(self, name):
+        return name in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+    def report(self):
+        """ Returns a table of all recorded methods, sorted by wall time."""
+        rows = sorted(((name, self[name]) for name in self.names), key=lambda row: -row[1].time)
+        lines = ["{0:<32} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>12}".format(
+                 "call", "calls", "statements", "time [ms]", "sql [ms]", "rows", "bytes")]
+        for name, stats in rows + [("total", self.total)]:
+            lines.append("{0:<32} {1:>8} {2:>10} {3:>10.1f} {4:>10.1f} {5:>10} {6:>12}".format(
+                         name, stats.calls, stats.statements, stats.time * 1000,
+                         stats.sql_time * 1000, stats.rows, stats.bytes))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return "QueryStats({0})".format(", ".join(self.names))
+
+
+def _short_repr(value, length=MAX_PARAMETERS_LENGTH):
+    text = repr(value)
+    if len(text) > length:
+        return text[:length] + "..."
+    return text
+
+
+class SlowQueryLog(object):
+    """ Logs the statements which take longer than `threshold` seconds.
+
+    Each message is logged at level ``WARNING`` to `slow_query_logger`
+    (``xdapy.slow_queries``) and contains the duration, the instrumented
+    call during which the statement was executed, the statement, its
+    bound parameters and the plan which the database reports for it.
+    The values are also attached to the log record as the attributes
+    ``duration``, ``call``, ``statement``, ``parameters`` and ``plan``
+    (and the `SlowQueryLog` itself as ``slow_query_log``).
+
+    `slow_query_logger` is shared by all connections in the process and
+    receives the slow queries of all of them. The file given as `filename`,
+    however, only receives the slow queries of this `SlowQueryLog`.
+
+    Only ``SELECT``, ``INSERT``, ``UPDATE`` and ``DELETE`` statements are
+    explained. On PostgreSQL, the ``EXPLAIN`` runs inside a savepoint, so
+    that an error does not abort the caller’s transaction. On SQLite, the
+    DB-API module commits any open transaction before an ``EXPLAIN``;
+    statements inside a transaction are therefore logged without a plan.
+
+    Parameters
+    ----------
+    threshold: float
+        The duration in seconds from which on statements are logged.
+    filename: string, optional
+        If given, the messages are additionally written to this file,
+        which is rotated after `max_bytes`.
+    explain: bool, optional
+        Whether the plan of the statements is requested from the database.
+        (Defaults to ``True``.)
+    max_bytes: int, optional
+        The size of the file after which it is rotated.
+    backup_count: int, optional
+        The number of rotated files which are kept.
+    """
+    def __init__(self, threshold, filename=None, explain=True,
+                 max_bytes=SLOW_QUERY_LOG_SIZE, backup_count=SLOW_QUERY_LOG_BACKUPS):
+        if threshold < 0:
+            raise ValueError("The threshold must not be negative.")
+        self.threshold = threshold
+        self.explain = explain
+        self.handler = None
+        if filename:
+            self.handler = logging.handlers.RotatingFileHandler(path.expanduser(filename),
+                                                                maxBytes=max_bytes, backupCount=backup_count)
+            self.handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.handler.addFilter(self)
+            slow_query_logger.addHandler(self.handler)
+
+    def filter(self, record):
+        """ Lets only the records of this `SlowQueryLog` pass to its file."""
+        return getattr(record, "slow_query_log", None) is self
+
+    def close(self):
+        """ Closes the log file."""
+        if self.handler is not None:
+            slow_query_logger.removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+
+    def check(self, conn, statement, parameters, executemany, duration, call):
+        """ Logs the statement, if `duration` exceeds the threshold."""
+        if duration < self.threshold:
+            return
+        if executemany:
+            # explain the first set of parameters
+            parameters = parameters[0] if parameters else ()
+        plan = self.query_plan(conn, statement, parameters) if self.explain else None
+        slow_query_logger.warning("Slow query (%.1f ms) in %s%s:\n%s\nParameters: %s\nPlan:\n%s",
+                                  duration * 1000, call, " (executemany)" if executemany else "",
+                                  statement, _short_repr(parameters), plan,
+                                  extra={"duration": duration, "call": call, "statement": statement,
+                                         "parameters": parameters, "plan": plan, "slow_query_log": self})
+
+    def query_plan(self, conn, statement, parameters):
+        """ Returns the plan of the `statement` as a string, or None if the
+        database does not support this or the statement is not explained.
+        The statement is explained directly on the DB-API connection, so
+        that no events are fired.
+        """
+        prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+        words = statement.lstrip(" \t\r\n(").split(None, 1)
+        if prefix is None or not words or words[0].upper() not in EXPLAINED_STATEMENTS:
+            return None
+        sqlite = conn.dialect.name == "sqlite"
+        if sqlite and conn.in_transaction():
+            return None
+
+        cursor = conn.connection.cursor()
+        try:
+            if not sqlite:
+                cursor.execute("SAVEPOINT " + EXPLAIN_SAVEPOINT)
+            try:
+                cursor.execute(prefix + statement, parameters)
+                # the description of the plan is in the last column
+                plan = "\n".join(unicode(row[-1]) for row in cursor.fetchall())
+            except Exception as err:
+                if not sqlite:
+                    cursor.execute("ROLLBACK TO SAVEPOINT " + EXPLAIN_SAVEPOINT)
+                plan = "(EXPLAIN failed: {0})".format(err)
+            if not sqlite:
+                cursor.execute("RELEASE SAVEPOINT " + EXPLAIN_SAVEPOINT)
+            return plan
+        finally:
+            cursor.close()
+
+    def __repr__(self):
+        return "SlowQueryLog(threshold={0!r})".format(self.threshold)
+
+
+class Instrumentation(object):
+    """ Records the costs of the instrumented calls on a connection.
+
+    Instances are created with `xdapy.connection.Connection.instrument`.
+
+    Parameters
+    ----------
+    connection: Connection
+        The connection whose engine is observed.
+
+    Attributes
+    ----------
+    stats
+        The `QueryStats` of everything which has been recorded.
+    enabled
+        Whether anything is recorded. (Event listeners cannot be removed
+        from the engine, so this is the way to switch the recording off.)
+    slow_query_log
+        The `SlowQueryLog` which is checked after each statement, if any.
+        It is independent of `enabled`.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.stats = QueryStats()
+        self.enabled = True
+        self.slow_query_log = None
+        self._local = threading.local()
+        self._scopes = []
+        self._scopes_lock = threading.Lock()
+
+        engine = connection.engine
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @property
+    def _calls(self):
+        """ The stack of the names of the running calls in this thread."""
+        try:
+            return self._local.calls
+        except AttributeError:
+            self._local.calls = []
+            return self._local.calls
+
+    @property
+    def current(self):
+        """ The name to which statements are currently attributed."""
+        calls = self._calls
+        return calls[0] if calls else OUTSIDE
+
+    def _record(self, name, **values):
+        if not self.enabled:
+            return
+        self.stats.record(name, **values)
+        for scope in self._scopes:
+            scope.record(name, **values)
+
+    @contextmanager
+    def call(self, name, new_call=True):
+        """ Attributes all statements inside the ``with`` block to `name`,
+        unless an outer call is already running. The wall time is added
+        to `name` as well.
+
+        With `new_call` set to ``False``, the calls of `name` are not counted
+        (for the continuation of a call, like the iteration of a generator).
+        """
+        calls = self._calls
+        outermost = not calls
+        calls.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            calls.pop()
+            if outermost:
+                self._record(name, calls=1 if new_call else 0, time=time.time() - start)
+
+    @contextmanager
+    def measure(self):
+        """ Returns a new `QueryStats` which records everything during the
+        ``with`` block (in all threads), in addition to `stats`::
+
+            with instrumentation.measure() as stats:
+                mapper.find_all(Trial)
+            print stats.report()
+        """
+        scope = QueryStats()
+        with self._scopes_lock:
+            self._scopes = self._scopes + [scope]
+        try:
+            yield scope
+        finally:
+            with self._scopes_lock:
+                self._scopes = [s for s in self._scopes if s is not scope]
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._instrumentation_start = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is None:
+            return
+        name = self.current
+        duration = time.time() - getattr(context, "_instrumentation_start", time.time())
+        if self.slow_query_log is not None:
+            self.slow_query_log.check(conn, statement, parameters, executemany, duration, name)
+        if not self.enabled:
+            return
+
+        chunks = CHUNK_TABLE in statement
+        values = {"statements": 1, "sql_time": duration}
+        if chunks and not statement.lstrip().upper().startswith("SELECT"):
+            values["bytes"] = _parameter_size(parameters, executemany)
+        self._record(name, **values)
+
+        # the result proxy is created right after this event;
+        # wrap it so that the fetched rows are counted
+        get_result_proxy = context.get_result_proxy
+
+        def counting_result_proxy():
+            result = get_result_proxy()
+            self._count_rows(result, name, chunks)
+            return result
+        context.get_result_proxy = counting_result_proxy
+
+    def _count_rows(self, result, name, chunks):
+        """ Wraps the fetch methods of the `result` so that they record
+        the number of rows (and bytes of data chunks) under `name`."""
+        def count(rows):
+            if rows:
+                values = {"rows": len(rows)}
+                if chunks:
+                    values["bytes"] = sum(_binary_size(row) for row in rows)
+                self._record(name, **values)
+            return rows
+
+        fetchone, fetchmany, fetchall = result._fetchone_impl, result._fetchmany_impl, result._fetchall_impl
+
+        def fetchone_impl():
+            row = fetchone()
+            if row is not None:
+                count([row])
+            return row
+        result._fetchone_impl = fetchone_impl
+        result._fetchmany_impl = lambda *args: count(fetchmany(*args))
+        result._fetchall_impl = lambda: count(fetchall())
+
+    def __repr__(self):
+        return "Instrumentation({0!r})".format(self.connection)
+
+
+def _instrumentation_of(obj):
+    """ Returns the `Instrumentation` of the connection of a `Mapper`,
+    or of an object with a `mapper` attribute, if any."""
+    connection = getattr(obj, "connection", None)
+    if connection is None:
+        mapper = getattr(obj, "mapper", None)
+        connection = getattr(mapper, "connection", None)
+    return getattr(connection, "instrumentation", None)
+
+def instrumented(func):
+    """ Decorates a method so that its calls are recorded by the
+    `Instrumentation` of the connection, if there is one.
+
+    The name of the call is ``ClassName.method``. Generator methods are
+    measured while they are iterated.
+    """
+    def call_name(self):
+        return "{0}.{1}".format(type(self).__name__, func.__name__)
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            instrumentation = _instrumentation_of(self)
+            if instrumentation is None:
+                for item in func(self, *args, **kwargs):
+                    yield item
+                return
+
+            name = call_name(self)
+            with instrumentation.call(name):
+                iterator = iter(func(self, *args, **kwargs))
+            while True:
+                with instrumentation.call(name, new_call=False):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+    else:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            instrumentation = _instrumentation_of(self)
+            if instrumentation is None:
+                return func(self, *args, **kwargs)
+            with instrumentation.call(call_name(self)):
+                return func(self, *args, **kwargs)
+    return wrapper
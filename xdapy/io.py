@@ -5,6 +5,10 @@ This module wraps the input and output functionality.
 """
 import os
 import errno
+import gzip
+import multiprocessing
+from contextlib import contextmanager
+from StringIO import StringIO
 
 __docformat__ = "restructuredtext"
 
@@ -21,9 +25,15 @@ logger = logging.getLogger(__name__)
 
 from xml.etree import ElementTree as ET
 
-from xdapy.structures import Context, Data, calculate_polymorphic_name
-from xdapy.errors import AmbiguousObjectError, InvalidInputError
-from xdapy.utils.algorithms import check_superfluous_keys
+from xdapy.structures import BaseEntity, Context, Data, calculate_polymorphic_name
+from xdapy.data import DataChunks
+from xdapy.parameters import select_parameter_values, json_value
+from xdapy.errors import AmbiguousObjectError, InvalidInputError, DataInconsistencyError
+from xdapy.utils.algorithms import check_superfluous_keys, batches
+from xdapy.operators import in_
+from xdapy.instrumentation import instrumented
+
+from sqlalchemy.sql import and_, bindparam, select, union
 
 
 class BinaryEncoder(object):
@@ -70,6 +80,77 @@ def gen_rnd_key():
     return "ref:" + random.randint(1, 10000000)
 
 
+class _RelationBatch(object):
+    """ Collects relations between saved entities by their ids and writes
+    them with bulk statements, bypassing the relationship bookkeeping of
+    the ORM.
+
+    Conflicting parents and duplicate contexts in the input are detected
+    when the relations are added; parents which are already set in the
+    database are checked with a single query in `write`.
+    """
+    def __init__(self):
+        #: parent ids by child id
+        self.parents = {}
+        #: (holder id, attachment id, connection type)
+        self.contexts = set()
+
+    def __len__(self):
+        return len(self.parents) + len(self.contexts)
+
+    def add_parent(self, child_id, parent_id, key=None):
+        if child_id in self.parents:
+            raise InvalidInputError("Multiple parents defined for object {0}.".format(key or child_id))
+        self.parents[child_id] = parent_id
+
+    def add_context(self, holder_id, attachment_id, connection_type, key=None):
+        context = (holder_id, attachment_id, connection_type)
+        if context in self.contexts:
+            raise InvalidInputError("Duplicate '{0}' connection for object {1}.".format(connection_type, key or holder_id))
+        self.contexts.add(context)
+
+    def entity_ids(self):
+        """ Returns the set of ids of all entities which take part in a relation."""
+        ids = set(self.parents)
+        ids.update(self.parents.itervalues())
+        for holder_id, attachment_id, _ in self.contexts:
+            ids.add(holder_id)
+            ids.add(attachment_id)
+        return ids
+
+    def write(self, session):
+        """ Writes the relations inside the transaction of `session`."""
+        entities = BaseEntity.__table__
+        contexts = Context.__table__
+
+        if self.parents:
+            has_parent = select([entities.c.id]).where(and_(in_(self.parents.keys())(entities.c.id),
+                                                            entities.c.parent_id != None))
+            conflicts = sorted(id for id, in session.execute(has_parent))
+            if conflicts:
+                raise InvalidInputError("Multiple parents defined for the objects with ids {0}.".format(conflicts))
+
+            set_parent = entities.update().\
+                where(entities.c.id == bindparam("child")).\
+                values(parent_id=bindparam("parent"))
+            session.execute(set_parent, [{"child": child_id, "parent": parent_id}
+                                         for child_id, parent_id in self.parents.iteritems()])
+
+        if self.contexts:
+            session.execute(contexts.insert(), [{"entity_id": holder_id,
+                                                 "connected_id": attachment_id,
+                                                 "connection_type": connection_type}
+                                                for holder_id, attachment_id, connection_type in self.contexts])
+
+
+def _expire_relations(session, entities, entity_ids):
+    """ Expires the relations of those `entities` whose ids are in `entity_ids`,
+    after they have been changed with bulk statements."""
+    for entity in entities:
+        if isinstance(entity, BaseEntity) and entity.id in entity_ids and entity in session:
+            session.expire(entity, ["parent", "parent_id", "children", "holds_context", "attached_by"])
+
+
 class IO(object):
     def __init__(self, mapper, known_objects=None, add_new_types=False):
         """ If known_objects is None (or left empty), it defaults to mapper.registered_entities.
@@ -95,23 +176,573 @@ class IO(object):
     @property
     def known_objects(self):
         if self._known_objects is None:
-            return dict((obj.__name__, obj) for obj in self.mapper.registered_entities)
+            return self.mapper.registry.names()
         return self._known_objects
 
 import json
 
+#: The number of objects or relations which are committed at once
+#: by the streaming readers.
+DEFAULT_BATCH_SIZE = 1000
+
+class _JsonStreamReader(object):
+    """ Reads a JSON document from a file incrementally.
+
+    The reader only understands the structure of the outer JSON object
+    and of the arrays stored therein. Each array element is decoded on its
+    own, so only a single element needs to be held in memory at a time.
+
+    Parameters
+    ----------
+    fileobj: file
+        The file to read from.
+    chunk_size: int, optional
+        The number of bytes to read at once.
+    """
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        """ Appends the next chunk of the file to the buffer.
+        Returns False at the end of the file."""
+        if self.eof:
+            return False
+        # drop everything which has already been consumed
+        if self.pos:
+            self.offset += self.pos
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.fileobj.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def tell(self):
+        """ Returns the position in the file of the next character to read."""
+        return self.offset + self.pos
+
+    def seek(self, position):
+        """ Continues reading at `position`."""
+        self.fileobj.seek(position)
+        self.buffer = ""
+        self.pos = 0
+        self.offset = position
+        self.eof = False
+
+    def peek(self):
+        """ Returns the next non-whitespace character (or an empty string
+        at the end of the file) without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        """ Consumes the next non-whitespace character, which must be one of `chars`."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise InvalidInputError("Expected {0!r} at position {1} but found {2!r}.".format(chars, self.tell(), char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """ Decodes and consumes the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # the value may be incomplete; read more of the file
+                # (doubling the buffer, in case the value is large)
+                if not self._fill(max(self.chunk_size, len(self.buffer))):
+                    raise InvalidInputError("Invalid JSON value at position {0}.".format(self.tell()))
+                continue
+            if end == len(self.buffer) and self._fill():
+                # numbers could continue in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self):
+        """ Iterates over the keys of a JSON object.
+
+        After each key, the caller must consume the corresponding value,
+        using `decode`, `iter_array` or `skip`.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def iter_array(self):
+        """ Iterates over the elements of a JSON array."""
+        if self.peek() == "n":
+            # treat null as an empty array
+            self.decode()
+            return
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(",]") == "]":
+                return
+
+    def skip(self):
+        """ Consumes the next value without keeping it in memory."""
+        if self.peek() == "[":
+            for _ in self.iter_array():
+                pass
+        else:
+            self.decode()
+
+
+#: The number of entities which are exported with one set of queries
+#: (or by one task of a worker process).
+EXPORT_BATCH_SIZE = 500
+
+def _export_closure(session, entity_ids):
+    """ Returns the sorted ids of the entities `entity_ids` and of all entities
+    which are reachable from them through parents, children and attachments.
+
+    Each level of the graph is fetched with a single statement.
+    """
+    entities = BaseEntity.__table__
+    contexts = Context.__table__
+
+    seen = set(entity_ids)
+    frontier = seen
+    while frontier:
+        ids = list(frontier)
+        neighbours = union(
+            select([entities.c.parent_id]).where(and_(in_(ids)(entities.c.id), entities.c.parent_id != None)),
+            select([entities.c.id]).where(in_(ids)(entities.c.parent_id)),
+            select([contexts.c.connected_id]).where(in_(ids)(contexts.c.entity_id)))
+        frontier = set(id for id, in session.execute(neighbours)) - seen
+        seen |= frontier
+    return sorted(seen)
+
+def _export_relations(session, entity_ids):
+    """ Yields the parent and context relations of the entities `entity_ids`
+    as lists, one for each batch of `EXPORT_BATCH_SIZE` entities.
+
+    All parent relations come before the context relations.
+    """
+    entities = BaseEntity.__table__
+    contexts = Context.__table__
+    parents = entities.alias("parents")
+    attachments = entities.alias("attachments")
+
+    for ids in batches(entity_ids, EXPORT_BATCH_SIZE):
+        children = select([entities.c.uniqueid, parents.c.uniqueid]).\
+            where(and_(in_(ids)(entities.c.id), parents.c.id == entities.c.parent_id)).\
+            order_by(entities.c.id)
+        yield [{
+            "relation": "child",
+            "from": "unique_id:" + unique_id,
+            "to": "unique_id:" + parent_unique_id
+        } for unique_id, parent_unique_id in session.execute(children)]
+
+    for ids in batches(entity_ids, EXPORT_BATCH_SIZE):
+        holders = select([entities.c.uniqueid, contexts.c.connection_type, attachments.c.uniqueid]).\
+            where(and_(in_(ids)(contexts.c.entity_id),
+                       entities.c.id == contexts.c.entity_id,
+                       attachments.c.id == contexts.c.connected_id)).\
+            order_by(contexts.c.entity_id, contexts.c.connected_id, contexts.c.connection_type)
+        yield [{
+            "relation": "context",
+            "name": connection_type,
+            "from": "unique_id:" + unique_id,
+            "to": "unique_id:" + attachment_unique_id
+        } for unique_id, connection_type, attachment_unique_id in session.execute(holders)]
+
+def _export_objects(session, data_store, entity_ids, data_folder):
+    """ Returns the JSON objects of the entities `entity_ids` and writes
+    their data to files in `data_folder`.
+    """
+    entities = BaseEntity.__table__
+    data = Data.__table__
+
+    params = dict((id, {}) for id in entity_ids)
+    for row in session.execute(select_parameter_values(entity_ids)):
+        params[row.entity_id][row.name] = json_value(row.type, row["value_" + row.type])
+
+    rows = session.execute(select([entities.c.id, entities.c.type, entities.c.uniqueid]).\
+                           where(in_(entity_ids)(entities.c.id)).order_by(entities.c.id)).fetchall()
+    unique_ids = dict((id, unique_id) for id, _, unique_id in rows)
+
+    data_dicts = dict((id, {}) for id in entity_ids)
+    data_rows = session.execute(select([data.c.id, data.c.entity_id, data.c.key, data.c.mimetype, data.c.digest]).\
+                                where(in_(entity_ids)(data.c.entity_id))).fetchall()
+    if data_rows and data_folder is None:
+        raise ValueError("A data folder is needed to export data.")
+    for data_id, entity_id, key, mimetype, digest in data_rows:
+        file_name = _export_data(session, data_store, data_folder, unique_ids[entity_id], key, data_id, digest)
+        data_dicts[entity_id][key] = {
+            "file": file_name
+        }
+        if mimetype is not None:
+            data_dicts[entity_id][key]["mimetype"] = mimetype
+
+    objects = []
+    for id, type, unique_id in rows:
+        json_obj = {"type": type.split("_")[0], "id": id, "unique_id": unique_id, "parameters": params[id]}
+        if data_dicts[id]:
+            json_obj["data"] = data_dicts[id]
+        objects.append(json_obj)
+    return objects
+
+def _export_data(session, data_store, data_folder, object_ident, key, data_id, digest):
+    """ Writes the content of the data `data_id` to a file in `data_folder`
+    and returns the name of the file relative to `data_folder`."""
+    folder = os.path.join(data_folder, object_ident)
+    try:
+        os.makedirs(folder)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    filename = os.path.join(folder, key)
+    with open(filename, mode="wx") as f:
+        if digest is not None:
+            if data_store is None:
+                raise DataInconsistencyError("Data {0} is kept in a data store but the connection has none.".format(data_id))
+            data_store.get(digest, f)
+        else:
+            chunks = DataChunks.__table__
+            for chunk, in session.execute(select([chunks.c.data]).where(chunks.c.data_id == data_id).\
+                                          order_by(chunks.c.index)):
+                f.write(chunk)
+
+    return os.path.relpath(filename, data_folder)
+
+def _indent(json_string, indentation="  "):
+    """ Indents all but the first line of `json_string`."""
+    return json_string.replace("\n", "\n" + indentation)
+
+def _dumps(obj, compact=False, indentation=""):
+    """ Serialises `obj` either indented (with all but the first line
+    prefixed by `indentation`) or, if `compact` is set, without any
+    whitespace."""
+    if compact:
+        return json.dumps(obj, separators=(",", ":"))
+    return _indent(json.dumps(obj, indent=2), indentation)
+
+def _elements_fragment(elements, compact=False):
+    """ Serialises the `elements` as a part of a JSON array in the document."""
+    if compact:
+        return ",".join(_dumps(element, compact=True) for element in elements)
+    return ",\n".join("    " + _dumps(element, indentation="    ") for element in elements)
+
+def _write_array(fileobj, fragments, compact=False):
+    """ Writes a JSON array with the elements from `fragments` (as returned
+    by `_elements_fragment`) to `fileobj` as soon as they are produced."""
+    separator = "" if compact else "\n"
+    fileobj.write("[")
+    for fragment in fragments:
+        if fragment:
+            fileobj.write(separator)
+            fileobj.write(fragment)
+            separator = "," if compact else ",\n"
+    fileobj.write("]" if compact else "\n  ]")
+
+#: The file suffixes which select a compression for `JsonIO.write_file`.
+COMPRESSION_SUFFIXES = {
+    ".gz": "gzip",
+    ".xz": "xz"
+}
+
+#: The leading bytes of compressed files.
+_COMPRESSION_MAGIC = [
+    ("\x1f\x8b", "gzip"),
+    ("\xfd7zXZ\x00", "xz")
+]
+
+def _import_lzma():
+    """ Returns the lzma module (or its backport for Python 2)."""
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ImportError("xz compression needs the lzma module (pip install backports.lzma).")
+    return lzma
+
+def _compressed_file(fileobj, compression, mode):
+    """ Wraps `fileobj` for reading or writing (depending on `mode`)
+    with the given `compression`."""
+    if compression is None:
+        return fileobj
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode=mode)
+    if compression == "xz":
+        return _import_lzma().LZMAFile(fileobj, mode=mode)
+    raise ValueError("Unknown compression: {0}.".format(compression))
+
+@contextmanager
+def _open_output(file_name, compression=None):
+    """ Creates the file `file_name` (which must not exist) for writing with
+    the given `compression` or, if there is none, the one belonging to the
+    suffix of `file_name`."""
+    if compression is None:
+        compression = COMPRESSION_SUFFIXES.get(os.path.splitext(file_name)[1])
+    if compression == "xz":
+        # fail before the file is created
+        _import_lzma()
+    elif compression not in (None, "gzip"):
+        raise ValueError("Unknown compression: {0}.".format(compression))
+
+    with open(file_name, mode="wx") as raw:
+        fileobj = _compressed_file(raw, compression, "wb")
+        try:
+            yield fileobj
+        finally:
+            if fileobj is not raw:
+                fileobj.close()
+
+@contextmanager
+def _open_input(file_name):
+    """ Opens the file `file_name` for reading and decompresses it
+    if it starts with the signature of a gzip or xz file."""
+    with open(file_name, mode="rb") as raw:
+        head = raw.read(6)
+        raw.seek(0)
+        compression = None
+        for magic, name in _COMPRESSION_MAGIC:
+            if head.startswith(magic):
+                compression = name
+        fileobj = _compressed_file(raw, compression, "rb")
+        try:
+            yield fileobj
+        finally:
+            if fileobj is not raw:
+                fileobj.close()
+
+#: The connection of an export worker process.
+_worker_connection = None
+
+def _init_export_worker(url, data_store):
+    """ Opens the connection of an export worker process."""
+    global _worker_connection
+    from xdapy.connection import Connection
+    _worker_connection = Connection(url=url, data_store=data_store)
+
+def _export_worker(task):
+    """ Exports a batch of entities in a worker process and
+    returns the serialised objects."""
+    entity_ids, data_folder, compact = task
+    with _worker_connection.auto_session as session:
+        objects = _export_objects(session, _worker_connection.data_store, entity_ids, data_folder)
+        return _elements_fragment(objects, compact)
+
+
 class JsonIO(IO):
+    @instrumented
     def read_string(self, jsonstr):
         json_data = json.loads(jsonstr)
         return self.read_json(json_data)
 
+    @instrumented
     def read_file(self, file_name, data_folder=None):
         data_folder = data_folder or file_name + ".data"
 
-        with open(file_name, mode="r") as fileobj:
+        with _open_input(file_name) as fileobj:
             json_data = json.load(fileobj)
         return self.read_json(json_data, data_folder=data_folder)
 
+    @instrumented
+    def read_file_streaming(self, file_name, data_folder=None, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """ Imports a JSON file without loading it into memory as a whole.
+        Files compressed with gzip or xz are decompressed on the fly.
+
+        See `read_stream`.
+        """
+        data_folder = data_folder or file_name + ".data"
+
+        with _open_input(file_name) as fileobj:
+            return self.read_stream(fileobj, data_folder=data_folder,
+                                    batch_size=batch_size, progress=progress)
+
+    @instrumented
+    def read_stream(self, fileobj, data_folder=None, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """ Imports JSON data from a file object with bounded memory.
+
+        Unlike `read_json`, the ``types``, ``objects`` and ``relations``
+        sections are parsed one element at a time. The objects and relations
+        are committed in batches of `batch_size` and the created entities
+        are removed from the session after each batch. Only a mapping
+        from the keys of the objects to the ids of the created entities
+        is kept in memory to resolve the relations.
+
+        If the sections do not appear in the order ``types``, ``objects``,
+        ``relations``, the file object must be seekable.
+
+        .. note::
+
+            Each batch is committed on its own. If an error occurs, the
+            entities of earlier batches stay in the database.
+
+        Parameters
+        ----------
+        fileobj: file
+            The file to read from.
+        data_folder: string, optional
+            The folder in which to look for data files.
+        batch_size: int, optional
+            The number of objects or relations to commit at once.
+        progress: callable, optional
+            Called as ``progress(section, count)`` after each batch with
+            the name of the section and the number of its elements
+            which have been imported so far.
+
+        Returns
+        -------
+        mapping: dict
+            Maps the keys (``"unique_id:..."`` and ``"id:..."``) of the
+            imported objects to the ids of the created entities.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        reader = _JsonStreamReader(fileobj)
+        mapping = {}
+        sections = ["types", "objects", "relations"]
+        handlers = {
+            "types": lambda elements: self._stream_types(elements, progress),
+            "objects": lambda elements: self._stream_objects(elements, mapping, data_folder, batch_size, progress),
+            "relations": lambda elements: self._stream_relations(elements, mapping, batch_size, progress),
+        }
+
+        done = set()
+        deferred = {}
+        for key in reader.iter_object():
+            if key not in handlers:
+                reader.skip()
+                continue
+            earlier = sections[:sections.index(key)]
+            if all(section in done for section in earlier):
+                handlers[key](reader.iter_array())
+                done.add(key)
+            else:
+                # must be read again, once the earlier sections are done
+                deferred[key] = reader.tell()
+                reader.skip()
+
+        for key in sections:
+            if key in deferred:
+                reader.seek(deferred[key])
+                handlers[key](reader.iter_array())
+
+        return mapping
+
+    def _stream_types(self, types, progress):
+        # there are only few types; they may be read at once
+        types = list(types)
+        self.add_types(types)
+        if progress:
+            progress("types", len(types))
+
+    def _stream_objects(self, objects, mapping, data_folder, batch_size, progress):
+        count = 0
+        for batch in batches(objects, batch_size):
+            self._add_objects_batch(batch, mapping, data_folder)
+            count += len(batch)
+            if progress:
+                progress("objects", count)
+
+    def _add_objects_batch(self, objects, mapping, data_folder):
+        """ Creates and commits the entities for `objects` and
+        records their ids in `mapping`."""
+        batch_mapping = {}
+        entities = []
+        with_data = []
+
+        def create(objects, parent=None):
+            for obj in self._iter_objects(objects):
+                entity_obj = self._create_object(obj, batch_mapping)
+                if parent is not None:
+                    entity_obj.parent = parent
+                entities.append(entity_obj)
+                if obj["data"]:
+                    with_data.append((entity_obj, obj["data"]))
+                create(obj["children"], entity_obj)
+
+        create(objects)
+
+        session = self.mapper.session
+        with self.mapper.auto_session:
+            self.mapper.save_bulk(entities, batch_size=len(entities))
+            for entity_obj, data in with_data:
+                self._add_data(entity_obj, data, data_folder)
+            # read the ids while the objects are not yet expired
+            for key, entity_obj in batch_mapping.iteritems():
+                mapping[key] = entity_obj.id
+
+        for entity_obj in entities:
+            if entity_obj in session:
+                session.expunge(entity_obj)
+
+    def _stream_relations(self, relations, mapping, batch_size, progress):
+        count = 0
+        for batch in batches(relations, batch_size):
+            self._add_relations_batch(batch, mapping)
+            count += len(batch)
+            if progress:
+                progress("relations", count)
+
+    def _add_relations_batch(self, relations, mapping):
+        """ Writes the `relations` directly to the database, using the
+        entity ids from `mapping`."""
+        with self.mapper.auto_session as session:
+            self._collect_relations(relations, mapping.__getitem__).write(session)
+
+    def _collect_relations(self, relations, entity_id):
+        """ Resolves the `relations` with the function `entity_id`, which
+        returns the id of the entity for a key, and returns them as a
+        `_RelationBatch`."""
+        def resolve(key):
+            try:
+                return entity_id(key)
+            except KeyError:
+                raise InvalidInputError("Unknown object {0} in relation.".format(key))
+
+        batch = _RelationBatch()
+        for rel in self._iter_relations(relations):
+            rel_type = rel.get("relation")
+            rel_from = rel.get("from")
+            rel_to = rel.get("to")
+
+            if rel_type == "parent":
+                # rel_from is parent of rel_to
+                batch.add_parent(resolve(rel_to), resolve(rel_from), rel_to)
+            elif rel_type == "child":
+                # rel_from is child of rel_to
+                batch.add_parent(resolve(rel_from), resolve(rel_to), rel_from)
+            elif rel_type == "context":
+                batch.add_context(resolve(rel_from), resolve(rel_to), rel.get("name"), rel_from)
+            else:
+                raise InvalidInputError("Unknown relation type: {0}.".format(rel_type))
+        return batch
+
+    @instrumented
     def read_json(self, json_data, data_folder=None):
         types = json_data.get("types") or []
         objects = json_data.get("objects") or []
@@ -130,72 +761,116 @@ class JsonIO(IO):
 
             return db_objects
 
-    def write_string(self, objs):
-        json_data = self.write_json(objs)
-        json_string = json.dumps(json_data, indent=2)
-        return json_string
+    @instrumented
+    def write_string(self, objs, compact=False):
+        """ Returns the `objs` and all related entities as a JSON string.
 
-    def write_file(self, objs, file_name, data_folder=None):
+        See `write_file`.
+        """
+        fileobj = StringIO()
+        with self.mapper.auto_session as session:
+            types, entity_ids = self._export_graph(session, objs)
+            fragments = (_elements_fragment(_export_objects(session, self.mapper.connection.data_store, ids, None), compact)
+                         for ids in batches(entity_ids, EXPORT_BATCH_SIZE))
+            relations = (_elements_fragment(batch, compact) for batch in _export_relations(session, entity_ids))
+            self._write_document(fileobj, types, fragments, relations, compact)
+        return fileobj.getvalue()
+
+    @instrumented
+    def write_file(self, objs, file_name, data_folder=None, processes=None, compact=False, compression=None):
+        """ Writes the `objs` and all related entities to the file `file_name`
+        and their data to files in `data_folder` (which defaults to
+        ``file_name + ".data"``).
+
+        The objects and relations are written batch by batch, as soon as
+        they have been fetched, so that the memory needed does not grow
+        with the size of the export (apart from the ids of the entities).
+
+        Parameters
+        ----------
+        objs: list of entities
+            The entities to start the export from.
+        file_name: string
+            The JSON file. It must not exist.
+        data_folder: string, optional
+            The folder for the data files.
+        processes: int, optional
+            If given, the objects and data files are written by a pool of
+            this many worker processes, each with its own connection to the
+            database. The workers only see committed data, so this is not
+            possible inside an open transaction (e.g. an `auto_session`)
+            or with in-memory databases.
+        compact: bool, optional
+            If set, the JSON is written without indentation and whitespace.
+        compression: string, optional
+            ``"gzip"`` or ``"xz"``. Defaults to the compression belonging
+            to the suffix (``.gz`` or ``.xz``) of `file_name`, if any.
+            xz needs the ``lzma`` module (``backports.lzma`` on Python 2).
+            `read_file` and `read_file_streaming` decompress the file
+            automatically.
+        """
         data_folder = data_folder or file_name + ".data"
+        connection = self.mapper.connection
+        if processes:
+            if connection.url in (None, "sqlite://", "sqlite:///:memory:"):
+                raise ValueError("A parallel export needs a database which other processes can connect to.")
+            if connection.session.transaction is not None:
+                raise ValueError("A parallel export cannot run inside an open transaction, "
+                                 "since the worker processes only see committed data.")
+
+        # new objects are committed at the end of the session
+        with self.mapper.auto_session as session:
+            types, entity_ids = self._export_graph(session, objs)
 
-        json_data = self.write_json(objs, data_folder=data_folder)
-        with open(file_name, mode="wx") as fileobj:
-            return json.dump(json_data, fileobj, indent=2)
-
-    def write_json(self, objs, data_folder=None):
-        types = [{"type": t.__original_class_name__, "parameters": t.declared_params} for t in self.mapper.registered_entities]
-
-        relations = []
-        visited_objs = set()
-        unvisited_objs = set(objs)
+        batches_of_ids = list(batches(entity_ids, EXPORT_BATCH_SIZE))
 
-        while unvisited_objs:
+        def relations():
+            with self.mapper.auto_session as session:
+                for batch in _export_relations(session, entity_ids):
+                    yield _elements_fragment(batch, compact)
 
-            obj = unvisited_objs.pop()
-            if obj in visited_objs:
-                continue
+        if processes:
+            with _open_output(file_name, compression) as fileobj:
+                pool = multiprocessing.Pool(processes, _init_export_worker, (connection.url, connection.data_store))
+                try:
+                    fragments = pool.imap(_export_worker, [(ids, data_folder, compact) for ids in batches_of_ids])
+                    self._write_document(fileobj, types, fragments, relations(), compact)
+                finally:
+                    pool.terminate()
+                    pool.join()
+        else:
+            def fragments():
+                for ids in batches_of_ids:
+                    with self.mapper.auto_session as session:
+                        objects = _export_objects(session, connection.data_store, ids, data_folder)
+                    yield _elements_fragment(objects, compact)
+            with _open_output(file_name, compression) as fileobj:
+                self._write_document(fileobj, types, fragments(), relations(), compact)
+
+    def _write_document(self, fileobj, types, fragments, relations, compact=False):
+        """ Writes the JSON document with the serialised objects and relations
+        from `fragments` and `relations` to `fileobj`."""
+        if compact:
+            fileobj.write('{"types":' + _dumps(types, compact=True) + ',"objects":')
+        else:
+            fileobj.write('{\n  "types": ' + _dumps(types, indentation="  ") + ',\n  "objects": ')
+        _write_array(fileobj, fragments, compact)
+        fileobj.write(',"relations":' if compact else ',\n  "relations": ')
+        _write_array(fileobj, relations, compact)
+        fileobj.write("}\n" if compact else "\n}\n")
 
-            if obj.parent:
-                relation = {
-                    "relation": "child",
-                    "from": "unique_id:" + obj.unique_id,
-                    "to": "unique_id:" + obj.parent.unique_id
-                }
-                relations.append(relation)
-                unvisited_objs.add(obj.parent)
-
-            for child in obj.children:
-                unvisited_objs.add(child)
-
-            for ctx in obj.holds_context:
-                relation = {
-                    "relation": "context",
-                    "name": ctx.connection_type,
-                    "from": "unique_id:" + obj.unique_id,
-                    "to": "unique_id:" + ctx.attachment.unique_id
-                }
-                relations.append(relation)
-                unvisited_objs.add(ctx.attachment)
-
-            visited_objs.add(obj)
-
-        objects = []
-        for obj in visited_objs:
-            data_dict = {}
-            for key, data in obj.data.iteritems():
-                file_name = self.write_data(data_folder, obj.unique_id, key, data)
-                data_dict[key] = {
-                    "file": file_name
-                }
-                if data.mimetype is not None:
-                    data_dict[key]["mimetype"] = data.mimetype
-
-            json_obj = dict(obj._attributes())
-            json_obj["parameters"] = dict(obj.json_params)
-            if data_dict:
-                json_obj["data"] = data_dict
-
-            objects.append(json_obj)
+    @instrumented
+    def write_json(self, objs, data_folder=None):
+        """ Returns the `objs` and all related entities as a JSON-compatible
+        dict and writes their data to files in `data_folder`."""
+        with self.mapper.auto_session as session:
+            types, entity_ids = self._export_graph(session, objs)
+            objects = []
+            for ids in batches(entity_ids, EXPORT_BATCH_SIZE):
+                objects.extend(_export_objects(session, self.mapper.connection.data_store, ids, data_folder))
+            relations = []
+            for batch in _export_relations(session, entity_ids):
+                relations.extend(batch)
 
         return {
             "types": types,
@@ -203,18 +878,23 @@ class JsonIO(IO):
             "relations": relations
         }
 
-    def write_data(self, data_folder, object_ident, key, data):
-        folder = os.path.join(data_folder, object_ident)
-        try:
-            os.makedirs(folder)
-        except OSError, e:
-            if e.errno != errno.EEXIST:
-                raise
-        filename = os.path.join(data_folder, object_ident, key)
-        with open(filename, mode="wx") as f:
-            data.get(f)
+    def _export_graph(self, session, objs):
+        """ Returns the types and the sorted ids of all entities which are
+        reachable from `objs` (through parents, children and attachments).
+        """
+        types = [{"type": t.__original_class_name__, "parameters": t.declared_params} for t in self.mapper.registered_entities]
 
-        return os.path.relpath(filename, data_folder)
+        # the objects need their ids
+        session.flush()
+        return types, _export_closure(session, [obj.id for obj in objs])
+
+    def write_data(self, data_folder, object_ident, key, data):
+        """ Writes the content of the `_DataProxy` `data` to a file in `data_folder`
+        and returns the name of the file relative to `data_folder`."""
+        stored = data.get_data()
+        with self.mapper.auto_session as session:
+            return _export_data(session, self.mapper.connection.data_store, data_folder,
+                                object_ident, key, stored.id, stored.digest)
 
 
     def _iter_types(self, types):
@@ -261,46 +941,56 @@ class JsonIO(IO):
                     logger.info("Adding type %r.", type["type"])
                     self.mapper.register_type(type["type"], type["parameters"])
 
-    def add_objects(self, objects, data_folder=None):
-        mapping = {}
-        db_objects = []
+    def _create_object(self, obj, mapping):
+        """ Creates the entity for `obj` (without saving it) and
+        adds its keys to `mapping`."""
+        entity_obj = self.mapper.create(obj["type"], _unique_id=obj["unique_id"])
 
-        for obj in self._iter_objects(objects):
-            entity_obj = self.mapper.create(obj["type"], _unique_id=obj["unique_id"])
+        for k, v in obj["params"].iteritems():
+            try:
+                entity_obj.str_params[k] = v
+            except KeyError as err:
+                if self.ignore_unknown_attributes:
+                    logger.warn("Unknown key for {0}: {1}.".format(obj["type"], err))
+                else:
+                    raise
 
-            for k, v in obj["params"].iteritems():
-                try:
-                    entity_obj.str_params[k] = v
-                except KeyError as err:
-                    if self.ignore_unknown_attributes:
-                        logger.warn("Unknown key for {0}: {1}.".format(obj["type"], err))
-                    else:
-                        raise
+        if obj["id"]:
+            mapping["id:" + str(obj["id"])] = entity_obj
 
-            if obj["id"]:
-                mapping["id:" + str(obj["id"])] = entity_obj
+        if obj["unique_id"]:
+            mapping["unique_id:" + obj["unique_id"]] = entity_obj
 
-            if obj["unique_id"]:
-                mapping["unique_id:" + obj["unique_id"]] = entity_obj
+        return entity_obj
 
-            self.mapper.save(entity_obj)
+    def _add_data(self, entity_obj, data, data_folder=None):
+        """ Stores the `data` dict of an object. The entity must already be saved."""
+        for key, value in data.iteritems():
+            if value.get("file") and (value.get("inline") or value.get("encoding")):
+                raise ValueError("Both file and inline given.")
 
-            for key, value in obj["data"].iteritems():
-                if value.get("file") and (value.get("inline") or value.get("encoding")):
-                    raise ValueError("Both file and inline given.")
+            if value.get("file"):
+                if data_folder is not None:
+                    file_name = os.path.join(data_folder, value["file"])
+                else:
+                    file_name = value["file"]
+                with open(file_name) as f:
+                    entity_obj.data[key].put(f, mimetype=value.get("mimetype"))
+            elif value.get("inline"):
+                encoding = value["encoding"]
+                data = recode[encoding].decode(value["inline"])
+                entity_obj.data[key].put(data, mimetype=value.get("mimetype"))
 
-                if value.get("file"):
-                    if data_folder is not None:
-                        file_name = os.path.join(data_folder, value["file"])
-                    else:
-                        file_name = value["file"]
-                    with open(file_name) as f:
-                        entity_obj.data[key].put(f, mimetype=value.get("mimetype"))
-                elif value.get("inline"):
-                    encoding = value["encoding"]
-                    data = recode[encoding].decode(value["inline"])
-                    entity_obj.data[key].put(data, mimetype=value.get("mimetype"))
+    def add_objects(self, objects, data_folder=None):
+        mapping = {}
+        db_objects = []
 
+        for obj in self._iter_objects(objects):
+            entity_obj = self._create_object(obj, mapping)
+
+            self.mapper.save(entity_obj)
+
+            self._add_data(entity_obj, obj["data"], data_folder)
 
             # handle potential children
             if obj["children"]:
@@ -319,41 +1009,69 @@ class JsonIO(IO):
         return db_objects, mapping
 
     def add_relations(self, relations, mapping):
-        for rel in relations:
-            rel_type = rel.get("relation")
-            rel_name = rel.get("name")
-            rel_from = rel.get("from")
-            rel_to = rel.get("to")
-
-            if rel_type == "parent":
-                # rel_from is parent of rel_to
-                if mapping[rel_to].parent:
-                    raise InvalidInputError("Multiple parents defined for object {0} ({1}).".format(mapping[rel_to], rel_to))
-                mapping[rel_to].parent = mapping[rel_from]
-
-            if rel_type == "child":
-                # rel_from is child of rel_to
-                if mapping[rel_from].parent:
-                    raise InvalidInputError("Multiple parents defined for object {0} ({1}).".format(mapping[rel_from], rel_from))
-                mapping[rel_from].parent = mapping[rel_to]
-
-            elif rel_type == "context":
-                mapping[rel_from].attach(rel_name, mapping[rel_to])
-            else:
-                raise InvalidInputError("Unknown relation type: {0}.".format(rel_type))
+        """ Adds the `relations` between the entities in `mapping`
+        (which maps keys to entities) with bulk statements."""
+        with self.mapper.auto_session as session:
+            # the entities need their ids
+            session.flush()
+            batch = self._collect_relations(relations, lambda key: mapping[key].id)
+            batch.write(session)
+            _expire_relations(session, mapping.itervalues(), batch.entity_ids())
 
 
 
 class XmlIO(IO):
+    @instrumented
     def read(self, xml):
         root = ET.fromstring(xml)
         return self.filter(root)
 
+    @instrumented
     def read_file(self, filename):
         tree = ET.parse(filename)
         root = tree.getroot()
         return self.filter(root)
 
+    @instrumented
+    def read_file_streaming(self, source, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+        """ Imports an XML file incrementally with bounded memory.
+
+        The document is parsed with ``iterparse``. Types are validated as
+        their declarations are read. Entities are created when their
+        elements are closed, saved in batches of `batch_size` and removed
+        from the session after each batch. Processed elements are cleared,
+        so that the parsed tree never grows. For resolving references,
+        only the ids of the created entities are kept.
+
+        Unlike `read`, the sections must appear in the order ``types``,
+        ``values``, ``relations``.
+
+        .. note::
+
+            Each batch is committed on its own. If an error occurs, the
+            entities of earlier batches stay in the database.
+
+        Parameters
+        ----------
+        source: string or file
+            The name of the file or a file object.
+        batch_size: int, optional
+            The number of entities or relations to commit at once.
+        progress: callable, optional
+            Called as ``progress(section, count)`` after each batch with
+            the name of the section (``"objects"`` or ``"relations"``) and
+            the number of its elements which have been imported so far.
+
+        Returns
+        -------
+        references: dict
+            Maps the keys (``"id:..."`` and ``"unique_id:..."``) of the
+            imported entities to their ids in the database.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+        return _XmlStreamReader(self, batch_size, progress).read(source)
+
     def filter(self, root):
         if root.tag != "xdapy":
             raise InvalidInputError("Tag {0} does not belong here".format(root.tag))
@@ -373,31 +1091,48 @@ class XmlIO(IO):
 
     def filter_relations(self, e, references):
         # TODO: Make relations work with unique_ids
-        for entity in e:
-            from_id = entity.attrib["from"]
-            to_id = entity.attrib["to"]
-            name = entity.attrib["name"]
-            references[from_id].attach(name, references[to_id])
+        with self.mapper.auto_session as session:
+            session.flush()
+            batch = _RelationBatch()
+            for entity in e:
+                from_id, to_id = [self._reference_id(references, entity.attrib[attr]) for attr in ["from", "to"]]
+                batch.add_context(from_id, to_id, entity.attrib["name"], entity.attrib["from"])
+            batch.write(session)
+            _expire_relations(session, references.itervalues(), batch.entity_ids())
+
+    def _reference_id(self, references, key):
+        """ Returns the id of the entity (or the id) in `references` for `key`."""
+        if key not in references:
+            raise InvalidInputError("Unknown object {0} in relation.".format(key))
+        reference = references[key]
+        return reference.id if isinstance(reference, BaseEntity) else reference
 
     def filter_types(self, e):
         types = {}
         not_found = []
         for entity in e:
-            if not entity.tag == "entity":
-                raise InvalidInputError("Tag {0} does not belong here".format(entity.tag))
-            try:
-                type, params, key = self.parse_entity_type(entity)
+            self.check_type(entity, types, not_found)
+        self.report_unregistered_types(not_found)
+
+    def check_type(self, entity, types, not_found):
+        """ Validates a single type declaration and adds it to `types`.
+        Types which are not registered are added to `not_found`."""
+        if not entity.tag == "entity":
+            raise InvalidInputError("Tag {0} does not belong here".format(entity.tag))
+        try:
+            type, params, key = self.parse_entity_type(entity)
 
-                if type in types:
-                    if types[type]["key"] == key:
-                        pass
-                    else:
-                        raise AmbiguousObjectError("Type with name {0} has already been declared".format(type))
+            if type in types:
+                if types[type]["key"] == key:
+                    pass
                 else:
-                    types[type] = {"key": key, "params": params}
-            except UnregisteredTypesError as err:
-                not_found += err.types
+                    raise AmbiguousObjectError("Type with name {0} has already been declared".format(type))
+            else:
+                types[type] = {"key": key, "params": params}
+        except UnregisteredTypesError as err:
+            not_found += err.types
 
+    def report_unregistered_types(self, not_found):
         if not_found:
             print """The following objects were declared in the XML file but never imported:"""
         for nf in not_found:
@@ -516,10 +1251,11 @@ class XmlIO(IO):
     def entity_by_name(self, entity, **kwargs):
         return self.mapper.entity_by_name(entity)(**kwargs)
 
+    @instrumented
     def write(self):
         root = ET.Element("xdapy")
         types = ET.Element("types")
-        entities = ET.Element("objects")
+        entities = ET.Element("values")
         relations = ET.Element("relations")
 
         used_objects = set()
@@ -544,6 +1280,7 @@ class XmlIO(IO):
 
     def write_types(self, object):
         obj_entity = ET.Element("entity")
+        obj_entity.attrib["name"] = object.__original_class_name__
         for name, type in object.declared_params.iteritems():
             parameter = ET.Element("parameter")
             parameter.attrib["name"] = name
@@ -580,3 +1317,179 @@ class XmlIO(IO):
 
         return entity
 
+
+class _XmlStreamReader(object):
+    """ Imports an XML document with ``iterparse``. See `XmlIO.read_file_streaming`.
+    """
+    def __init__(self, xmlio, batch_size, progress):
+        self.xmlio = xmlio
+        self.mapper = xmlio.mapper
+        self.batch_size = batch_size
+        self.progress = progress
+
+        #: ids of all saved entities by their keys
+        self.references = {}
+        #: entities by their keys which have not yet been saved
+        self.pending = {}
+        #: created entities which have not yet been saved
+        self.batch = []
+        #: relations which have not yet been saved
+        self.relations = _RelationBatch()
+
+        #: the entities whose elements are still open
+        self.open_entities = []
+        #: the elements which are still open
+        self.open_elements = []
+
+        self.types = {}
+        self.not_found = []
+        self.counts = {"objects": 0, "relations": 0}
+
+    def read(self, source):
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                self.start(elem)
+                self.open_elements.append(elem)
+            else:
+                self.open_elements.pop()
+                self.end(elem)
+
+        self.save_objects()
+        self.save_relations()
+        return self.references
+
+    def section(self):
+        """ Returns the tag of the top-level section we are in."""
+        if len(self.open_elements) > 1:
+            return self.open_elements[1].tag
+
+    def start(self, elem):
+        if not self.open_elements:
+            if elem.tag != "xdapy":
+                raise InvalidInputError("Tag {0} does not belong here".format(elem.tag))
+        elif self.section() == "values" and elem.tag == "entity":
+            self.start_entity(elem)
+        elif elem.tag == "relations" and len(self.open_elements) == 1:
+            # relations need the ids of all entities
+            self.save_objects()
+
+    def end(self, elem):
+        depth = len(self.open_elements)
+        section = self.section()
+
+        if section == "types" and depth == 2:
+            self.xmlio.check_type(elem, self.types, self.not_found)
+        elif elem.tag == "types" and depth == 1:
+            self.xmlio.report_unregistered_types(self.not_found)
+        elif section == "values" and elem.tag == "entity":
+            self.end_entity(elem)
+        elif section == "relations" and depth == 2:
+            self.add_relation(elem)
+        elif depth > 2:
+            # parameters and data are read when their entity is closed
+            return
+
+        # forget about the processed element
+        elem.clear()
+        if self.open_elements:
+            self.open_elements[-1].remove(elem)
+
+    def lookup(self, key):
+        """ Returns the pending entity or the id of the saved entity for `key`."""
+        if key in self.pending:
+            return self.pending[key]
+        return self.references.get(key)
+
+    def start_entity(self, elem):
+        type = elem.attrib["type"]
+        new_entity = self.xmlio.entity_by_name(type, _unique_id=elem.attrib.get("unique_id"))
+
+        enclosing = self.open_entities[-1] if self.open_entities else None
+        if enclosing is not None:
+            new_entity.parent = enclosing
+
+        if "parent" in elem.attrib:
+            parent_id = elem.attrib["parent"]
+            parent = self.lookup(parent_id)
+            if parent is None:
+                raise InvalidInputError("Parent {0} undefined for entity {1}".format(parent_id, new_entity))
+            if enclosing is not None:
+                if not (parent is enclosing or parent == enclosing.id):
+                    raise InvalidInputError("Trying to mix nesting with explicit parent specification for {0}".format(new_entity))
+            elif isinstance(parent, BaseEntity):
+                new_entity.parent = parent
+            else:
+                new_entity.parent_id = parent
+
+        for attr in ["id", "unique_id"]:
+            if attr in elem.attrib:
+                key = attr + ":" + elem.attrib[attr]
+                if key in self.pending or key in self.references:
+                    raise InvalidInputError("Ambiguous declaration of {0}".format(key))
+                self.pending[key] = new_entity
+
+        self.open_entities.append(new_entity)
+
+    def end_entity(self, elem):
+        new_entity = self.open_entities.pop()
+
+        data = []
+        for sub in elem:
+            if sub.tag == "parameter":
+                name, value = self.xmlio.parse_parameter(sub)
+                if value is not None:
+                    new_entity.str_params[name] = value
+            if sub.tag == "data":
+                data.append(self.xmlio.parse_data(sub))
+
+        if data:
+            # We need to associate the entity with a session. Otherwise, we cannot add data.
+            self.mapper.save(new_entity)
+            for name, value in data:
+                new_entity.data[name].put(value["data"])
+                new_entity.data[name].mimetype = value["mimetype"]
+
+        self.batch.append(new_entity)
+        if len(self.batch) >= self.batch_size:
+            self.save_objects()
+
+    def save_objects(self):
+        if not self.batch:
+            return
+
+        session = self.mapper.session
+        with self.mapper.auto_session:
+            self.mapper.save_bulk(self.batch, batch_size=len(self.batch))
+            # keep only the ids of saved entities
+            for key, entity in self.pending.items():
+                if entity.id is not None:
+                    self.references[key] = entity.id
+                    del self.pending[key]
+
+        for entity in self.batch:
+            # entities with open elements are still needed as parents
+            if entity not in self.open_entities and entity in session:
+                session.expunge(entity)
+
+        self.counts["objects"] += len(self.batch)
+        self.batch = []
+        if self.progress:
+            self.progress("objects", self.counts["objects"])
+
+    def add_relation(self, elem):
+        from_id, to_id = [self.xmlio._reference_id(self.references, elem.attrib[attr]) for attr in ["from", "to"]]
+        self.relations.add_context(from_id, to_id, elem.attrib["name"], elem.attrib["from"])
+        if len(self.relations) >= self.batch_size:
+            self.save_relations()
+
+    def save_relations(self):
+        if not self.relations:
+            return
+
+        with self.mapper.auto_session as session:
+            self.relations.write(session)
+
+        self.counts["relations"] += len(self.relations)
+        self.relations = _RelationBatch()
+        if self.progress:
+            self.progress("relations", self.counts["relations"])
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queries across several related entities.
+
+A `JoinQuery` names the entities which take part in the query, the filters
+on their parameters and the relations between them. It is compiled into a
+single SQL statement, which joins the `entities` table on ``parent_id`` and
+on the `contexts` table. For example, all reaction times of the valid trials
+of experiment E1 with observer O1::
+
+    query = mapper.join_query()
+    query.add("trial", "Trial", {"z": lt(50), "correct": True})
+    query.add("experiment", "Experiment", {"project": "E1"})
+    query.add("observer", "Observer", {"name": "O1"})
+    query.ancestor("experiment", "trial")
+    query.context("experiment", "observer")
+
+    rows = query.select("trial._id", "trial.reaction_time")
+    trials = query.all("trial")
+
+Only the requested parameters are read, so that the costs depend on the size
+of the result rather than on the number of entities in the database.
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+from sqlalchemy.sql import select, and_
+from sqlalchemy.sql.util import ClauseAdapter
+
+from xdapy.structures import BaseEntity, Context
+from xdapy.parameters import parameter_for_type, outerjoin_parameter
+from xdapy.operators import in_
+from xdapy.instrumentation import instrumented
+
+#: The columns of an entity which may be selected with a leading underscore.
+ENTITY_COLUMNS = {
+    "_id": "id",
+    "_unique_id": "uniqueid",
+    "_parent_id": "parent_id",
+}
+
+
+class JoinQuery(object):
+    """ A query over several related entities.
+
+    All methods which add to the query return the query itself,
+    so that the calls may be chained.
+
+    Parameters
+    ----------
+    mapper: Mapper
+        The mapper which is used to look up the entity classes.
+    """
+    def __init__(self, mapper):
+        self.mapper = mapper
+        self._names = []
+        self._entities = {}
+        self._relations = []
+
+    def add(self, name, entity, filter=None, options=None):
+        """ Adds an entity to the query.
+
+        Parameters
+        ----------
+        name: string
+            The name by which the entity is referred to in relations and columns.
+        entity: string, class or Entity
+            The type of the entity (see `xdapy.mapper.Mapper.find`).
+        filter: dict, optional
+            A filter on its parameters (see `xdapy.mapper.Mapper.find`).
+        options: dict, optional
+            The options of the filter.
+        """
+        if name in self._entities:
+            raise ValueError("The name {0!r} is already used in the query.".format(name))
+        if "." in name:
+            raise ValueError("The name {0!r} must not contain a dot.".format(name))
+
+        klass, filter = self.mapper._mk_entity_filter(entity, filter)
+        klass = self.mapper.entity_by_name(klass)
+        self._names.append(name)
+        self._entities[name] = (klass, filter, options)
+        return self
+
+    def parent(self, parent, child):
+        """ Requires the entity `parent` to be the parent of the entity `child`."""
+        self._relations.append(("parent", self._check(parent), self._check(child), None))
+        return self
+
+    def ancestor(self, ancestor, descendant):
+        """ Requires the entity `ancestor` to be the parent, the grandparent
+        etc. of the entity `descendant`."""
+        self._relations.append(("ancestor", self._check(ancestor), self._check(descendant), None))
+        return self
+
+    def context(self, holder, attachment, connection_type=None):
+        """ Requires the entity `attachment` to be attached to the entity `holder`
+        (with the given `connection_type`, if any)."""
+        self._relations.append(("context", self._check(holder), self._check(attachment), connection_type))
+        return self
+
+    def _check(self, name):
+        if name not in self._entities:
+            raise ValueError("Unknown name {0!r} in query. Known names are {1}.".format(name, self._names))
+        return name
+
+    def _column_spec(self, column):
+        """ Splits ``"name.key"`` into its parts."""
+        name, _, key = column.partition(".")
+        self._check(name)
+        klass = self._entities[name][0]
+        if not key or not (key in ENTITY_COLUMNS or key in klass.declared_params):
+            raise ValueError("{0} has no parameter or column {1!r}.".format(klass.__original_class_name__, key))
+        return name, key
+
+    def _compile(self, columns):
+        """ Returns a select of the `columns` (given as ``(name, key)``),
+        with all entities joined according to the relations.
+        """
+        entities = BaseEntity.__table__
+        aliases = dict((name, entities.alias("join_" + name)) for name in self._names)
+
+        # the (name, value) of the parameters to select
+        from_objs = dict(aliases)
+        selected = []
+        for name, key in columns:
+            alias = aliases[name]
+            if key in ENTITY_COLUMNS:
+                selected.append(alias.c[ENTITY_COLUMNS[key]])
+                continue
+            klass = self._entities[name][0]
+            materialized = self.mapper._materialized_table(klass)
+            if materialized is not None:
+                materialized = materialized.alias()
+                from_objs[name] = from_objs[name].outerjoin(materialized, materialized.c._id == alias.c.id)
+                selected.append(materialized.c[key])
+            else:
+                from_objs[name], value = outerjoin_parameter(from_objs[name], alias.c.id, key,
+                                                             parameter_for_type(klass.declared_params[key]))
+                selected.append(value)
+
+        clauses = []
+        for name in self._names:
+            klass, filter, options = self._entities[name]
+            clauses.append(aliases[name].c.type == klass.__mapper_args__['polymorphic_identity'])
+            if filter:
+                clause = self.mapper.param_filter(klass, filter, options)
+                clauses.append(ClauseAdapter(aliases[name]).traverse(clause))
+
+        # The common table expressions of the ancestors must come first,
+        # so that their bound parameters are compiled before all others:
+        # SQLAlchemy 0.8 does not keep track of the position of parameters
+        # inside recursive common table expressions.
+        ctes = []
+        contexts = []
+        for kind, first, second, connection_type in self._relations:
+            if kind == "parent":
+                clauses.append(aliases[second].c.parent_id == aliases[first].c.id)
+            elif kind == "ancestor":
+                closure = self._closure(first, "ancestors_{0}".format(len(ctes)))
+                ctes.append(closure)
+                clauses.extend([closure.c.ancestor_id == aliases[first].c.id,
+                                closure.c.id == aliases[second].c.id,
+                                closure.c.id != closure.c.ancestor_id])
+            else:
+                context = Context.__table__.alias("context_{0}".format(len(contexts)))
+                contexts.append(context)
+                clauses.extend([context.c.entity_id == aliases[first].c.id,
+                                context.c.connected_id == aliases[second].c.id])
+                if connection_type is not None:
+                    clauses.append(context.c.connection_type == connection_type)
+
+        from_obj = ctes + [from_objs[name] for name in self._names] + contexts
+        return select(selected, from_obj=from_obj).where(and_(*clauses))
+
+    def _closure(self, name, cte_name):
+        """ Returns a recursive common table expression with the columns
+        ``ancestor_id`` and ``id`` for the entity `name` and all its descendants.
+        (Each entity is its own ancestor.)"""
+        klass, filter, options = self._entities[name]
+        entities = BaseEntity.__table__
+        related = entities.alias()
+
+        seed = select([entities.c.id.label("ancestor_id"), entities.c.id.label("id")]).\
+                   where(entities.c.type == klass.__mapper_args__['polymorphic_identity'])
+        if filter:
+            seed = seed.where(self.mapper.param_filter(klass, filter, options))
+
+        cte = seed.cte(cte_name, recursive=True)
+        previous = cte.alias()
+        step = select([previous.c.ancestor_id, related.c.id]).where(related.c.parent_id == previous.c.id)
+        return cte.union(step)
+
+    @instrumented
+    def select(self, *columns, **kwargs):
+        """ Returns the values of the `columns` for all matches.
+
+        Parameters
+        ----------
+        columns: strings
+            ``"name.parameter"`` or ``"name._id"`` (also ``_unique_id`` and
+            ``_parent_id``) for each column. Missing parameters are ``None``.
+        distinct: bool, optional
+            Whether to drop duplicate rows (the default). Without this,
+            each match is one row, even if the selected values are the same.
+
+        Returns
+        -------
+        rows: list of tuples
+            The rows, ordered by the columns.
+        """
+        distinct = kwargs.pop("distinct", True)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments {0}.".format(sorted(kwargs)))
+        if not columns:
+            raise ValueError("No columns given.")
+
+        query = self._compile([self._column_spec(column) for column in columns])
+        if distinct:
+            query = query.distinct()
+        query = query.order_by(*query.inner_columns)
+
+        with self.mapper.auto_session as session:
+            result = session.execute(query)
+            # sqlite3 does not report any columns for empty results
+            # of queries starting with WITH
+            return [tuple(row) for row in result.fetchall()] if result.returns_rows else []
+
+    def ids(self, name):
+        """ Returns the sorted ids of the entities `name` of all matches."""
+        return [id for id, in self.select(name + "._id")]
+
+    @instrumented
+    def all(self, name, load=None):
+        """ Returns the entities `name` of all matches, ordered by id.
+
+        Parameters
+        ----------
+        name: string
+            The name of the entities in the query.
+        load: list of strings, optional
+            The relations to load together with the entities (see `xdapy.mapper.Mapper.find`).
+        """
+        ids = self.ids(name)
+        if not ids:
+            return []
+        klass = self._entities[name][0]
+        return self.mapper.find(klass, load=load).filter(in_(ids)(BaseEntity.id)).order_by(BaseEntity.id).all()
+
+    def __repr__(self):
+        return "JoinQuery({0})".format(", ".join("{0}={1}".format(name, self._entities[name][0].__original_class_name__)
+                                                 for name in self._names))
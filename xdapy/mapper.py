@@ -13,16 +13,28 @@ __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>',
                '"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
 from xdapy.connection import Connection
-from xdapy.structures import ParameterDeclaration, BaseEntity, Entity, calculate_polymorphic_name, create_entity
-from xdapy.parameters import StringParameter, DateParameter, parameter_for_type
+from xdapy.structures import ParameterDeclaration, BaseEntity, Entity, EntityRecord, Context, calculate_polymorphic_name, \
+    create_entity, _related_ids_cte
+from xdapy.parameters import Parameter, StringParameter, DateParameter, parameter_for_type, outerjoin_parameter, \
+    select_parameter_values
 from xdapy.errors import StringConversionError, FilterError
 from xdapy.find import SearchProxy
+from xdapy.instrumentation import instrumented
+from xdapy.join import JoinQuery
+from xdapy.materialize import Materializer
+from xdapy.operators import Missing, in_
+from xdapy.utils.algorithms import batches
 
-from sqlalchemy.sql import or_, and_
+from sqlalchemy import Sequence
+from sqlalchemy.orm import joinedload, subqueryload, subqueryload_all, with_polymorphic
+from sqlalchemy.sql import or_, and_, select, func, literal, union
 
 import logging
 logger = logging.getLogger(__name__)
 
+#: The default number of objects which `Mapper.save_bulk` stores per flush.
+DEFAULT_BATCH_SIZE = 1000
+
 """
 TODO: Load: what happens if more attributes given as saved in database
 TODO: Save: what happens if similar object with more or less but otherwise the same
@@ -30,6 +42,126 @@ TODO: Save: what happens if similar object with more or less but otherwise the s
 TODO: Error if the committing fails
 """
 
+def _typed_array(numpy, parameter_type, values):
+    """ Converts the `values` of a parameter of type `parameter_type`
+    into a NumPy array with an appropriate dtype.
+    """
+    missing = None in values
+    if parameter_type == "integer":
+        if missing:
+            return numpy.array([numpy.nan if v is None else v for v in values], dtype="f8")
+        return numpy.array(values, dtype="i8")
+    if parameter_type == "float":
+        return numpy.array([numpy.nan if v is None else v for v in values], dtype="f8")
+    if parameter_type == "boolean":
+        return numpy.array(values, dtype=object if missing else "?")
+    if parameter_type == "date":
+        return numpy.array(values, dtype="datetime64[D]")
+    if parameter_type == "datetime":
+        return numpy.array(values, dtype="datetime64[us]")
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+#: The aggregate functions which may be used in `Mapper.aggregate`.
+AGGREGATE_FUNCTIONS = {
+    "count": func.count,
+    "sum": func.sum,
+    "mean": func.avg,
+    "min": func.min,
+    "max": func.max
+}
+
+#: The names of the relations which may be loaded eagerly with the `load` argument of `Mapper.find`.
+LOAD_RELATIONS = ("params", "data_keys", "context", "holders", "parent", "children")
+
+def _loader_options(load):
+    """ Returns the SQLAlchemy loader options for the relations named in `load`.
+
+    Collections are loaded with one additional query each (``subqueryload``),
+    the parent is joined to the main query. Parameters are loaded
+    together with all typed parameter tables.
+    """
+    options = []
+    for relation in load:
+        if relation == "params":
+            parameters = with_polymorphic(Parameter, "*")
+            options.append(subqueryload(Entity._params.of_type(parameters)))
+        elif relation == "data_keys":
+            options.append(subqueryload(Entity._data))
+        elif relation == "context":
+            options.append(subqueryload_all(Entity.holds_context, Context.attachment))
+        elif relation == "holders":
+            options.append(subqueryload_all(Entity.attached_by, Context.holder))
+        elif relation == "parent":
+            options.append(joinedload(BaseEntity.parent))
+        elif relation == "children":
+            options.append(subqueryload(BaseEntity.children))
+        else:
+            raise ValueError("Unknown relation {0!r} in load. Possible values are {1}.".format(relation, LOAD_RELATIONS))
+    return options
+
+class EntityRegistry(object):
+    """ Keeps the entity classes which are registered with a `Mapper`.
+
+    Besides the list of classes in order of registration, the registry holds
+    indexes on the polymorphic name (``Experiment_<hash>``) and on the original
+    class name (``Experiment``) so that entity classes can be looked up in
+    constant time.
+    """
+    def __init__(self):
+        self._entities = []
+        self._classes = set()
+        self._by_name = {}
+        self._by_original_name = {}
+
+    def add(self, klass):
+        """ Adds the entity class `klass`. A class which has been
+        added before is ignored."""
+        if klass in self._classes:
+            return
+        self._entities.append(klass)
+        self._classes.add(klass)
+        self._by_name[klass.__name__] = klass
+
+        # several classes may have the same original name but
+        # different parameters; only the latest class per
+        # polymorphic name is kept
+        original_name = klass.__name__.split('_')[0]
+        self._by_original_name.setdefault(original_name, {})[klass.__name__] = klass
+
+    def __iter__(self):
+        return iter(self._entities)
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, klass):
+        try:
+            return klass in self._classes
+        except TypeError:
+            # unhashable
+            return False
+
+    @property
+    def entities(self):
+        """ A copy of the list of registered classes."""
+        return list(self._entities)
+
+    def by_name(self, polymorphic_name):
+        """ Returns the class with `polymorphic_name` or None."""
+        return self._by_name.get(polymorphic_name)
+
+    def by_original_name(self, name):
+        """ Returns the list of classes whose original class name is `name`."""
+        return self._by_original_name.get(name, {}).values()
+
+    def names(self):
+        """ Returns a dict of all polymorphic names and their classes."""
+        return dict(self._by_name)
+
+
 class Mapper(object):
     """ Handles database access and sessions
 
@@ -43,8 +175,8 @@ class Mapper(object):
     connection
         The database connection or URL
 
-    registered_entities
-        The objects this mapper cares about
+    registry
+        The `EntityRegistry` of the objects this mapper cares about
     """
 
     def __init__(self, connection):
@@ -53,7 +185,15 @@ class Mapper(object):
             connection = Connection(url=connection)
 
         self.connection = connection
-        self.registered_entities = []
+        self.registry = EntityRegistry()
+
+    @property
+    def registered_entities(self):
+        """ The list of objects this mapper cares about.
+
+        This is a copy; use `register` to add new objects.
+        """
+        return self.registry.entities
 
     @property
     def auto_session(self):
@@ -85,7 +225,8 @@ class Mapper(object):
         """
         return self.connection.session
 
-    def save(self, *args):
+    @instrumented
+    def save(self, *args, **kwargs):
         """ Save instances inheriting from `Entity` (or any other SQLAlchemy structure)
         into database.
 
@@ -98,6 +239,10 @@ class Mapper(object):
         ----------
         args
             One or more objects derived from `xdapy.structures.Entity`.
+        flush: string, optional
+            Either ``"each"`` (the default), which flushes the session after
+            every single object, or ``"batch"``, which hands the objects
+            over to `save_bulk`.
 
         Raises
         ------
@@ -105,12 +250,97 @@ class Mapper(object):
             If the type of an object's attribute is not supported.
         TypeError
             If the attribute is None
+        ValueError
+            If an unknown `flush` mode is given.
         """
+        flush = kwargs.pop("flush", "each")
+        if kwargs:
+            raise TypeError("save() got unexpected keyword arguments %s." % ", ".join(kwargs))
+
+        if flush == "batch":
+            self.save_bulk(args)
+            return
+        if flush != "each":
+            raise ValueError("Unknown flush mode %r. Use 'each' or 'batch'." % flush)
+
         with self.auto_session as session:
             for arg in args:
                 session.add(arg)
                 session.flush()
 
+    @instrumented
+    def save_bulk(self, entities, batch_size=DEFAULT_BATCH_SIZE):
+        """ Saves a (possibly large) iterable of entities, flushing and
+        committing only once per batch.
+
+        All objects of a batch (together with their parameters, data and
+        context relations) are handed to a single flush. This lets SQLAlchemy
+        group the inserts per table and issue them as one ``executemany``
+        where the primary keys are known in advance, which is considerably
+        faster than `save`, which flushes after every object.
+
+        .. note::
+
+            Each batch is committed on its own. If an error occurs, only the
+            current batch is rolled back; earlier batches stay in the database.
+
+        Parameters
+        ----------
+        entities: iterable
+            The objects to be saved. May also be a generator.
+        batch_size: int, optional
+            The number of objects to save per flush.
+
+        Returns
+        -------
+        list
+            The saved objects. All objects have their `id` set.
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        saved = []
+        for batch in batches(entities, batch_size):
+            self._save_batch(batch)
+            saved += batch
+        return saved
+
+    def _save_batch(self, batch):
+        """ Adds all objects in `batch` to the session and commits them with a single flush."""
+        session = self.session
+        session.add_all(batch)
+        self._reserve_ids(session)
+        with self.auto_session as session:
+            session.flush()
+
+    def _reserve_ids(self, session):
+        """ Assigns primary keys to all pending entities and parameters in the session.
+
+        SQLAlchemy can only group the inserts of a flush into one ``executemany``
+        per table if it already knows the primary keys of the rows. On PostgreSQL,
+        we fetch the keys for a whole batch with a single query per sequence.
+        Other engines keep their auto-incrementing keys.
+        """
+        if self.connection.engine_name != "postgresql":
+            return
+
+        for base_class in (BaseEntity, Parameter):
+            pending = [obj for obj in session.new if isinstance(obj, base_class) and obj.id is None]
+            if not pending:
+                continue
+
+            id_column = base_class.__table__.c.id
+            if isinstance(id_column.default, Sequence):
+                sequence = literal(id_column.default.name)
+            else:
+                sequence = func.pg_get_serial_sequence(base_class.__table__.name, id_column.name)
+
+            ids = session.execute(select([func.nextval(sequence)],
+                                         from_obj=func.generate_series(1, len(pending))))
+            for obj, (id,) in itertools.izip(pending, ids):
+                obj.id = id
+
+    @instrumented
     def delete(self, *args):
         """ Deletes the objects from the database.
 
@@ -143,6 +373,36 @@ class Mapper(object):
     def is_in_session(self, entity):
         return entity in self.session
 
+    def materialize(self, *entities):
+        """ Keeps a materialized wide table with the parameters of each
+        of the given entity types. (See `xdapy.materialize`.)
+
+        As long as a table is fresh, `find`, `aggregate`, `get_data_array`
+        and `iter_find` (with ``records=True``) read the parameters from
+        it instead of joining the parameter tables. Tables which already
+        exist are rebuilt.
+
+        Parameters
+        ----------
+        entities: strings or classes
+            The entity types to materialize.
+
+        Returns
+        -------
+        materializer: `xdapy.materialize.Materializer`
+        """
+        if self.connection.materializer is None:
+            self.connection.materializer = Materializer(self.connection)
+        for entity in entities:
+            self.connection.materializer.materialize(self.entity_by_name(entity))
+        return self.connection.materializer
+
+    def _materialized_table(self, entity):
+        """ Returns the fresh materialized table of `entity` or None."""
+        if self.connection.materializer is None:
+            return None
+        return self.connection.materializer.fresh_table(entity)
+
     def param_filter(self, entity, filter, options=None):
         default_options = {
             "convert_string": False,
@@ -153,30 +413,34 @@ class Mapper(object):
             default_options.update(options)
         options = default_options
 
+        # the parameters are read from the materialized table, if it is fresh
+        materialized = self._materialized_table(entity)
+
         and_clause = []
+        materialized_clause = []
         for key, value in filter.iteritems():
         # create sql for each key and concatenate with AND
-            def makeParam(key, value):
+            def makeParam(key, value, column, parameter_class):
                 """ Takes a value list as input and concatenates with OR.
                 This means that {age: [1, 12, 13]}  will yield a result if
-                age == 1 OR age == 12 OR age == 13.
+                age == 1 OR age == 12 OR age == 13. (Plain values are
+                tested with a single ``age IN (1, 12, 13)``.)
                 """
                 if not (isinstance(value, list) or isinstance(value, tuple)):
                     value = [value]
 
                 or_clause = []
-                # Ask for the type of the parameter according to the entity
-                parameter_class = parameter_for_type(entity.declared_params[key])
+                plain = []
                 for val in value:
                     if callable(val):
                         # we’ve been given a function
-                        or_clause.append(val(parameter_class.value))
+                        or_clause.append(val(column))
                     elif parameter_class == StringParameter:
                         # test string using ‘like’
                         if not options["strict"]:
                             val = "%" + val + "%"
 
-                        or_clause.append(parameter_class.value.like(val))
+                        or_clause.append(column.like(val))
                     else:
                         if options["convert_string"]:
                             try:
@@ -213,20 +477,25 @@ class Mapper(object):
                                                           self.connection.engine_name)
 
                                     if len(ymd) > 0:
-                                         clauses.append(year_part(parameter_class.value) ==  ymd[0])
+                                         clauses.append(year_part(column) ==  ymd[0])
                                     if len(ymd) > 1:
-                                         clauses.append(month_part(parameter_class.value) ==  ymd[1])
+                                         clauses.append(month_part(column) ==  ymd[1])
                                     if len(ymd) > 2:
-                                         clauses.append(day_part(parameter_class.value) ==  ymd[2])
+                                         clauses.append(day_part(column) ==  ymd[2])
 
                                     clause = (and_(*clauses))
                                     or_clause.append(clause)
                                 else:
                                     raise
+                            else:
+                                plain.append(val)
                         else:
-                            or_clause.append(parameter_class.value == val)
-                # FIXME
-                return entity._params.of_type(parameter_class).any(or_(*or_clause))
+                            plain.append(val)
+                if len(plain) == 1:
+                    or_clause.append(column == plain[0])
+                elif plain:
+                    or_clause.append(in_(plain)(column))
+                return or_(*or_clause)
 
             def makeAttr(key, value):
                 if not callable(value):
@@ -238,8 +507,37 @@ class Mapper(object):
                 k = key[1::]
                 and_clause.append(makeAttr(k, value))
             else:
-                # the key is a parameter
-                and_clause.append(makeParam(key, value))
+                # the key is a parameter;
+                # ask for its type according to the entity
+                parameter_class = parameter_for_type(entity.declared_params[key])
+                if materialized is not None:
+                    # a column of the materialized table
+                    materialized_clause.append(makeParam(key, value, materialized.c[key], parameter_class))
+                    continue
+
+                if not (isinstance(value, list) or isinstance(value, tuple)):
+                    value = [value]
+                present = [val for val in value if not isinstance(val, Missing)]
+
+                parameters = Parameter.__table__
+                clauses = []
+                if present:
+                    # an uncorrelated sub-select, which is driven by the
+                    # (name, value) index of the typed table
+                    values = parameter_class.__table__
+                    matching = select([parameters.c.entity_id]).where(
+                        and_(values.c.name == key, makeParam(key, present, parameter_class.value, parameter_class),
+                             parameters.c.id == values.c.id))
+                    clauses.append(BaseEntity.id.in_(matching))
+                if len(present) < len(value):
+                    # entities without the parameter
+                    having = select([parameters.c.entity_id]).where(parameters.c.name == key)
+                    clauses.append(~BaseEntity.id.in_(having))
+                and_clause.append(or_(*clauses))
+
+        if materialized_clause:
+            matching = select([materialized.c._id]).where(and_(*materialized_clause))
+            and_clause.append(BaseEntity.id.in_(matching))
         return and_(*and_clause)
 
     def _mk_entity_filter(self, entity, filter=None):
@@ -271,7 +569,41 @@ class Mapper(object):
 
         return entity, filter
 
-    def find(self, entity, filter=None, options=None):
+    def _order_by(self, query, entity, order_by):
+        """ Orders `query` by the values of the parameters in `order_by`.
+
+        Each key is the name of a declared parameter of `entity` or ``"_id"``
+        and may be prefixed with ``"-"`` for descending order. The values are
+        taken from an outer join with the typed parameter table. Entities
+        without the parameter come last in either direction (the backends
+        disagree on where ``NULL`` is sorted). Ties are ordered by id.
+        """
+        if isinstance(order_by, basestring):
+            order_by = [order_by]
+
+        parameters = Parameter.__table__
+        for key in order_by:
+            descending = key.startswith("-")
+            key = key.lstrip("-")
+            if key == "_id":
+                column = BaseEntity.id
+            else:
+                try:
+                    parameter_type = entity.declared_params[key]
+                except (AttributeError, KeyError):
+                    raise ValueError("Cannot order {0} by unknown parameter {1!r}.".format(entity.__name__, key))
+                key_parameters = parameters.alias()
+                values = parameter_for_type(parameter_type).__table__.alias()
+                query = query.outerjoin(key_parameters, and_(key_parameters.c.entity_id == BaseEntity.id,
+                                                             key_parameters.c.name == key)).\
+                              outerjoin(values, values.c.id == key_parameters.c.id)
+                column = values.c.value
+                query = query.order_by(column == None)
+            query = query.order_by(column.desc() if descending else column)
+        return query.order_by(BaseEntity.id)
+
+    @instrumented
+    def find(self, entity, filter=None, options=None, load=None, order_by=None, limit=None):
         """ Finds entities in the mapper.
 
         This method prepares the query (via SQLAlchemy).
@@ -288,6 +620,17 @@ class Mapper(object):
         filter : dict
             a filter
         options
+        load : list of strings, optional
+            The relations which are loaded together with the entities
+            (see `LOAD_RELATIONS`), e.g. ``["params", "context"]``.
+            Otherwise, each relation is loaded with a separate query
+            per entity on first access.
+        order_by : list of strings, optional
+            Parameter names (or ``"_id"``) to order the result by. A leading
+            ``"-"`` reverses the order, e.g. ``["-date", "number_of_runs"]``.
+            Entities without the parameter come last.
+        limit : int, optional
+            The maximum number of entities to return.
 
         Returns
         -------
@@ -296,29 +639,121 @@ class Mapper(object):
         with self.auto_session as session:
             entity, filter = self._mk_entity_filter(entity, filter)
 
+            if load and entity is BaseEntity:
+                # loader options for the relations of Entity
+                # are ignored on queries for BaseEntity
+                entity = Entity
+
             query = session.query(entity)
+            if load:
+                query = query.options(*_loader_options(load))
 
             if filter:
                 f = self.param_filter(entity, filter, options)
-                return query.filter(f)
-            else:
-                return query
-
-    def find_first(self, entity, filter=None, options=None):
+                query = query.filter(f)
+            if order_by:
+                query = self._order_by(query, entity, order_by)
+            if limit is not None:
+                query = query.limit(limit)
+            return query
+
+    @instrumented
+    def find_first(self, entity, filter=None, options=None, load=None, order_by=None):
         """ Convenience method for ``find(...).first()``.
         """
-        return self.find(entity, filter, options).first()
+        return self.find(entity, filter, options, load, order_by).first()
 
-    def find_all(self, entity, filter=None, options=None):
+    @instrumented
+    def find_all(self, entity, filter=None, options=None, load=None, order_by=None, limit=None):
         """ Convenience method for ``find(...).all()``.
         """
-        return self.find(entity, filter, options).all()
+        return self.find(entity, filter, options, load, order_by, limit).all()
+
+    @instrumented
+    def iter_find(self, entity, filter=None, options=None, batch_size=DEFAULT_BATCH_SIZE, load=None, records=False):
+        """ Iterates over the entities which `find` would return, ordered by id.
+
+        Unlike ``find_all``, the results are fetched in batches of
+        `batch_size` entities (paginated by their id, so that no batch
+        needs an ``OFFSET``). After a batch has been processed, pending
+        changes are flushed and the entities are removed from the session,
+        so that the memory use stays bounded. (Entities which have been
+        changed are expired by the flush and cannot be accessed anymore
+        once their batch is over.)
+
+        Parameters
+        ----------
+        entity : string or class
+            The entity to search for
+        filter : dict
+            a filter
+        options
+        batch_size : int, optional
+            The number of entities which are fetched at once.
+        load : list of strings, optional
+            The relations which are loaded together with each batch (see `find`).
+        records : bool, optional
+            If true, yields read-only `xdapy.structures.EntityRecord` tuples
+            instead of entities. This avoids the ORM altogether.
+
+        Returns
+        -------
+        iterator over entities or `EntityRecord` objects
+        """
+        query = self.find(entity, filter, options, load=None if records else load)
+        if records:
+            query = query.with_entities(BaseEntity.id, BaseEntity._type, BaseEntity._unique_id, BaseEntity.parent_id)
+        query = query.order_by(BaseEntity.id)
+
+        last_id = None
+        while True:
+            page = query
+            if last_id is not None:
+                page = page.filter(BaseEntity.id > last_id)
+            batch = page.limit(batch_size).all()
+            if not batch:
+                return
+            last_id = batch[-1].id
+
+            if records:
+                for record in self._entity_records(batch, entity):
+                    yield record
+            else:
+                for item in batch:
+                    yield item
+                session = self.session
+                session.flush()
+                for item in batch:
+                    if item in session:
+                        session.expunge(item)
+            del batch
 
-    def find_roots(self, entity=None):
+    def _entity_records(self, rows, entity=None):
+        """ Returns `EntityRecord` objects for rows of (id, type, unique_id, parent_id).
+
+        If all rows are of the type `entity` and its materialized table is
+        fresh, the parameters are read from there.
+        """
+        params = dict((row[0], {}) for row in rows)
+        entity = self._mk_entity_filter(entity)[0] if entity is not None else None
+        materialized = self._materialized_table(entity)
+        if materialized is not None:
+            keys = [column.name for column in materialized.columns if column.name != "_id"]
+            for value_row in self.session.execute(materialized.select().where(materialized.c._id.in_(params.keys()))):
+                params[value_row._id] = dict((key, value_row[key]) for key in keys if value_row[key] is not None)
+        else:
+            for value_row in self.session.execute(select_parameter_values(params.keys())):
+                params[value_row.entity_id][value_row.name] = value_row["value_" + value_row.type]
+        return [EntityRecord(id, type.split('_')[0], unique_id, parent_id, params[id])
+                for id, type, unique_id, parent_id in rows]
+
+    @instrumented
+    def find_roots(self, entity=None, load=None):
         if not entity:
             entity = BaseEntity
-        return self.find(entity).filter(BaseEntity.parent==None).all()
+        return self.find(entity, load=load).filter(BaseEntity.parent==None).all()
 
+    @instrumented
     def find_related(self, entity, related):
         """ Returns all entities of type `entity`
         which have an attachment relation to `related`::
@@ -344,13 +779,43 @@ class Mapper(object):
                     the_set.add(rel)
         return list(the_set)
 
+    def join_query(self):
+        """ Returns an empty `xdapy.join.JoinQuery` for queries across
+        several related entities, e.g. all trials of an experiment
+        with a certain observer::
+
+            query = mapper.join_query()
+            query.add("trial", "Trial", {"z": lt(50)})
+            query.add("experiment", "Experiment", {"project": "E1"})
+            query.add("observer", "Observer", {"name": "O1"})
+            query.ancestor("experiment", "trial").context("experiment", "observer")
+            trials = query.all("trial")
+        """
+        return JoinQuery(self)
+
+    def measure(self):
+        """ Returns a context manager which records the statements, rows
+        and timings of all calls inside the ``with`` block::
+
+            with mapper.measure() as stats:
+                mapper.find_all(Trial)
+            print stats["Mapper.find_all"].statements
+
+        This switches on the instrumentation of the connection
+        (see `xdapy.connection.Connection.instrument`).
+        """
+        return self.connection.instrument().measure()
+
+    @instrumented
     def find_by_id(self, entity, id):
         with self.auto_session as session:
             return session.query(entity).filter(BaseEntity.id==id).one()
 
+    @instrumented
     def find_by_unique_id(self, unique_id):
         return self.find(BaseEntity).filter(BaseEntity._unique_id==unique_id).one()
 
+    @instrumented
     def get_data_matrix(self, entity, items, include=None):
         """ Finds related items for the entity which satisfies condition
 
@@ -400,6 +865,244 @@ class Mapper(object):
 
         return matrix
 
+    def _related_ids(self, entity, include):
+        """ Returns a common table expression with the ids of all entities
+        matching `entity` together with the ids of their related entities.
+        """
+        entity, filter = self._mk_entity_filter(entity)
+        matched = self.find(entity, filter).with_entities(entity.id).subquery()
+        matched = select([matched.c.id]).cte("matched")
+        matched_ids = select([matched.c.id])
+
+        contexts = Context.__table__
+        related = [matched_ids]
+        if "PARENT" in include:
+            ancestors = _related_ids_cte(matched_ids, upwards=True, name="ancestors")
+            related.append(select([ancestors.c.id]))
+        if "CHILDREN" in include:
+            descendants = _related_ids_cte(matched_ids, upwards=False, name="descendants")
+            related.append(select([descendants.c.id]))
+        if "ATTACHMENTS" in include:
+            related.append(select([contexts.c.connected_id]).where(contexts.c.entity_id.in_(matched_ids)))
+        if "HOLDERS" in include:
+            related.append(select([contexts.c.entity_id]).where(contexts.c.connected_id.in_(matched_ids)))
+        return union(*related).cte("related")
+
+    @instrumented
+    def get_data_array(self, entity, items, include=None, as_dict=False):
+        """ Columnar variant of `get_data_matrix`.
+
+        Instead of loading the entities, the parameters of all related
+        entities are fetched with one query per entity type in `items`
+        and returned as NumPy arrays. The rows are ordered by entity id.
+
+        The dtype of each column is derived from the declared type of the
+        parameter. Missing integer values turn an integer column into a
+        float column with ``nan``, missing boolean values turn a boolean
+        column into an object column with ``None``. Dates and datetimes
+        are stored as ``datetime64``, strings and times as objects.
+
+        Requires NumPy.
+
+        Parameters
+        ----------
+        entity : string, class or Entity
+            The entities whose related entities should be returned.
+        items : dict
+            Maps entity type names to lists of parameter names::
+
+                {"Observer": ["age", "name"]}
+
+        include : list
+            list of entities relations which should be included
+            (see `get_data_matrix`)
+        as_dict : bool
+            Return a dict of arrays instead of a structured array
+            for each entity type.
+
+        Returns
+        -------
+        arrays: dict
+            Maps the entity type names from `items` to a structured array
+            (or to a dict of arrays, if `as_dict` is set).
+        """
+        import numpy
+
+        if include is None:
+            include = ["ALL"]
+        if "ALL" in include:
+            include = ["PARENT", "CHILDREN", "ATTACHMENTS", "HOLDERS"]
+
+        related = self._related_ids(entity, include)
+        entities = BaseEntity.__table__
+
+        arrays = {}
+        for rel_entity, params in items.iteritems():
+            klass = self.entity_by_name(rel_entity)
+
+            # The related ids must come first in the query, so that their
+            # bound parameters are compiled before all others: SQLAlchemy 0.8
+            # does not keep track of the position of parameters inside
+            # recursive common table expressions.
+            from_obj = related.join(entities, entities.c.id == related.c.id)
+            columns = [entities.c.id]
+            materialized = self._materialized_table(klass)
+            if materialized is not None:
+                from_obj = from_obj.outerjoin(materialized, materialized.c._id == entities.c.id)
+            for param in params:
+                parameter_type = klass.declared_params[param]
+                if materialized is not None:
+                    value = materialized.c[param]
+                else:
+                    from_obj, value = outerjoin_parameter(from_obj, entities.c.id, param,
+                                                          parameter_for_type(parameter_type))
+                columns.append(value)
+
+            query = select(columns, from_obj=[from_obj], use_labels=True).where(
+                entities.c.type == klass.__mapper_args__['polymorphic_identity']).order_by(entities.c.id)
+
+            with self.auto_session as session:
+                result = session.execute(query)
+                # sqlite3 does not report any columns for empty results
+                # of queries starting with WITH
+                rows = result.fetchall() if result.returns_rows else []
+
+            values = zip(*rows)[1:] if rows else [()] * len(params)
+            columns = [(str(param), _typed_array(numpy, klass.declared_params[param], column))
+                       for param, column in zip(params, values)]
+
+            if as_dict:
+                arrays[rel_entity] = dict(columns)
+            else:
+                array = numpy.empty(len(rows), dtype=[(name, column.dtype) for name, column in columns])
+                for name, column in columns:
+                    array[name] = column
+                arrays[rel_entity] = array
+
+        return arrays
+
+    @instrumented
+    def aggregate(self, entity, filter=None, group_by=None, metrics=None, options=None, as_array=False):
+        """ Computes aggregates over the parameters of the entities which
+        `find` would return, inside the database.
+
+        For example, the number of trials and the mean reaction time
+        for each session::
+
+            mapper.aggregate("Trial", {"valid": True}, group_by=["_parent"],
+                             metrics={"n": "count", "rt": "mean", "slowest": ("max", "rt")})
+
+        Parameters
+        ----------
+        entity : string or class
+            The entity to search for
+        filter : dict
+            a filter (see `find`)
+        group_by : list, optional
+            Names of parameters or ``"_parent"`` (for the id of the parent).
+            Without `group_by`, all entities are aggregated into a single row.
+        metrics : dict
+            Maps the name of each result column to an aggregate function
+            (one of `AGGREGATE_FUNCTIONS`). If the name is a parameter, the
+            function is applied to its values. A tuple ``(function, parameter)``
+            names the parameter explicitly. ``"count"`` without a parameter
+            counts the entities.
+        options
+        as_array : bool
+            Return a NumPy structured array instead of a list of dicts.
+
+        Returns
+        -------
+        rows : list of dicts or structured array
+            One row per group, ordered by the values of `group_by`.
+        """
+        entity, filter = self._mk_entity_filter(entity, filter)
+        klass = self.entity_by_name(entity)
+        if not metrics:
+            raise ValueError("No metrics given.")
+
+        def parameter_type(param):
+            try:
+                return klass.declared_params[param]
+            except KeyError:
+                raise ValueError("{0} has no parameter {1!r}.".format(klass.__original_class_name__, param))
+
+        matched = self.find(klass, filter, options).\
+                       with_entities(BaseEntity.id.label("id"), BaseEntity.parent_id.label("parent_id")).\
+                       subquery("matched")
+
+        # normalise the metrics to (name, function, parameter or None)
+        metric_specs = []
+        for name in sorted(metrics):
+            function, param = metrics[name], name
+            if isinstance(function, tuple):
+                function, param = function
+            elif function == "count" and name not in klass.declared_params:
+                param = None
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError("Unknown aggregate function {0!r}. Possible values are {1}.".format(
+                                 function, sorted(AGGREGATE_FUNCTIONS)))
+            metric_specs.append((name, function, param))
+
+        # join each needed parameter once
+        # (or the materialized table, which holds all of them)
+        from_obj = matched
+        values = {}
+        needed = [key for key in group_by or [] if key != "_parent"] + \
+                 [param for _, _, param in metric_specs if param is not None]
+        materialized = self._materialized_table(klass)
+        if materialized is not None and needed:
+            from_obj = from_obj.outerjoin(materialized, materialized.c._id == matched.c.id)
+        for param in needed:
+            if param not in values:
+                parameter_class = parameter_for_type(parameter_type(param))
+                if materialized is not None:
+                    values[param] = materialized.c[param]
+                else:
+                    from_obj, values[param] = outerjoin_parameter(from_obj, matched.c.id, param, parameter_class)
+
+        # (name, type, column) of the groups and the aggregates
+        groups = []
+        for key in group_by or []:
+            if key == "_parent":
+                groups.append((key, "integer", matched.c.parent_id))
+            else:
+                groups.append((key, parameter_type(key), values[key]))
+
+        aggregates = []
+        for name, function, param in metric_specs:
+            if function == "count":
+                column_type = "integer"
+            elif function == "mean":
+                column_type = "float"
+            else:
+                column_type = parameter_type(param)
+            column = matched.c.id if param is None else values[param]
+            aggregates.append((name, column_type, AGGREGATE_FUNCTIONS[function](column)))
+
+        group_columns = [column for _, _, column in groups]
+        query = select([column.label("column_%d" % i) for i, (_, _, column) in enumerate(groups + aggregates)],
+                       from_obj=[from_obj])
+        if group_columns:
+            query = query.group_by(*group_columns).order_by(*group_columns)
+
+        with self.auto_session as session:
+            rows = session.execute(query).fetchall()
+
+        names = [name for name, _, _ in groups + aggregates]
+        if not as_array:
+            return [dict(zip(names, row)) for row in rows]
+
+        import numpy
+        values = zip(*rows) if rows else [()] * len(names)
+        columns = [(str(name), _typed_array(numpy, column_type, column))
+                   for (name, column_type, _), column in zip(groups + aggregates, values)]
+        array = numpy.empty(len(rows), dtype=[(name, column.dtype) for name, column in columns])
+        for name, column in columns:
+            array[name] = column
+        return array
+
+    @instrumented
     def find_with(self, entity, filter=None):
         """ find_with provides an advanced filtering mode for higher structured queries.
         """
@@ -470,13 +1173,16 @@ class Mapper(object):
 
         return FindHelper((entity, filter)).search()
 
-    def find_complex(self, entity, the_filter=None):
+    @instrumented
+    def find_complex(self, entity, the_filter=None, load=None):
         """
         find_complex is able to search for structured data, including sub-queries
         where either one or all sub-items are being checked for a certain property.
+
+        `load` names the relations which are loaded eagerly (see `find`).
         """
         proxy = SearchProxy((entity, the_filter))
-        return proxy.find(self)
+        return proxy.find(self, load)
 
     def _register_parameter(self, entity_name, parameter_name, parameter_type):
         """Register a new parameter description for a specific experimental object
@@ -512,14 +1218,14 @@ class Mapper(object):
                 raise ValueError("Class must be subclass of Entity.")
             if klass is Entity:
                 raise ValueError("Entity is no valid class.")
-            self.registered_entities.append(klass)
+            self.registry.add(klass)
 
             for name, paramtype in klass.declared_params.iteritems():
                 self._register_parameter(klass.__name__, name, paramtype)
 
     def is_registered(self, name, declared_params):
         polymorphic_name = calculate_polymorphic_name(name, declared_params)
-        return polymorphic_name in (t.__name__ for t in self.registered_entities)
+        return self.registry.by_name(polymorphic_name) is not None
 
     def register_type(self, name, declared_params):
         new_type = create_entity(name, declared_params=declared_params)
@@ -536,15 +1242,18 @@ class Mapper(object):
             The name of the entity object to find.
         """
         # maybe name was a class already, then we're done
-        if name in self.registered_entities:
+        if name in self.registry:
             return name
 
-        klasses = dict((sub.__name__, sub) for sub in self.registered_entities)
-        if name in klasses:
-            return klasses[name]
-        klasses_guessed = [cls for cls in klasses if cls.startswith(name + "_") or cls == name]
+        if not isinstance(name, basestring):
+            raise TypeError("Entity name must be a string or a registered entity class.")
+
+        klass = self.registry.by_name(name)
+        if klass is not None:
+            return klass
+        klasses_guessed = self.registry.by_original_name(name)
         if len(klasses_guessed) == 1:
-            return klasses[klasses_guessed[0]]
+            return klasses_guessed[0]
         if len(klasses_guessed) > 1:
             raise ValueError("""More than one entity with name "{0}" registered.""".format(name))
 
@@ -587,6 +1296,7 @@ class Mapper(object):
         sorted_roots = sorted(roots, _by_entity_type)
         root_groups = itertools.groupby(roots, _by_entity_type)
 
+    @instrumented
     def rebrand(self, old_entity_type, new_entity_type, before=None, after=None):
         """ Changes all occurrences from `old_entity_type`
         to `new_entity_type`.
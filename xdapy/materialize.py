@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Materialized wide tables for read-heavy analytics.
+
+Reading the parameters of many entities requires a join of `entities`,
+`parameters` and one of the typed parameter tables for every parameter.
+A `Materializer` keeps a pivoted copy of the parameters of an entity type
+in a table of its own, with one typed column per key of `declared_params`
+and the entity id in the column ``_id``::
+
+    mapper.materialize(Observer, Trial)
+    mapper.aggregate(Trial, group_by=["observer"], metrics={"rt": "mean"})
+
+The tables are filled with a single ``INSERT ... SELECT`` and afterwards kept
+up to date from the flush events of the sessions of the connection. As long as
+a table is *fresh*, `xdapy.mapper.Mapper.find`, `~xdapy.mapper.Mapper.aggregate`,
+`~xdapy.mapper.Mapper.get_data_array` and `~xdapy.mapper.Mapper.iter_find` read
+from it instead of from the parameter tables.
+
+.. note::
+
+    Only changes which go through the ORM sessions of the connection are
+    seen. Bulk updates with `Query.update` or `Query.delete` mark all tables
+    as stale; changes from other processes or from plain SQL statements are
+    not noticed at all and require a `Materializer.rebuild`.
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+import hashlib
+import itertools
+
+from sqlalchemy import MetaData, Table, Column, Integer, Index, event
+from sqlalchemy.sql import select, and_
+
+from xdapy.structures import BaseEntity, Entity
+from xdapy.parameters import Parameter, parameter_for_type, outerjoin_parameter
+from xdapy.utils.algorithms import batches
+
+#: The number of entity ids which are refreshed with one statement.
+REFRESH_BATCH_SIZE = 500
+
+#: The metadata of the materialized tables. These are not part of
+#: `xdapy.structures.Base.metadata` and are not created by `create_tables`.
+metadata = MetaData()
+
+
+def materialized_table_name(klass):
+    """ Returns the name of the materialized table of the entity class `klass`.
+
+    The name is derived from the original class name and the polymorphic
+    identity and stays below the 63 characters allowed by PostgreSQL.
+    """
+    polymorphic_name = klass.__mapper_args__['polymorphic_identity']
+    name = klass.__original_class_name__.lower()[:32]
+    return "materialized_{0}_{1}".format(name, hashlib.sha1(polymorphic_name).hexdigest()[:8])
+
+def materialized_table(klass):
+    """ Returns the `Table` which holds the pivoted parameters of `klass`.
+
+    The table has the column ``_id`` with the entity id and one column per
+    declared parameter, with the type of the ``value`` column of the
+    respective parameter table. Each parameter column is indexed.
+    """
+    name = materialized_table_name(klass)
+    if name in metadata.tables:
+        return metadata.tables[name]
+
+    columns = [Column("_id", Integer, primary_key=True, autoincrement=False)]
+    for key, parameter_type in sorted(klass.declared_params.iteritems()):
+        value_type = parameter_for_type(parameter_type).__table__.c.value.type
+        if hasattr(value_type, "copy"):
+            # schema types (like Boolean) must not be shared between tables
+            value_type = value_type.copy()
+        columns.append(Column(key, value_type))
+
+    table = Table(name, metadata, *columns)
+    for position, key in enumerate(sorted(klass.declared_params)):
+        Index("ix_{0}_{1}".format(name, position), table.c[key])
+    return table
+
+
+class Materializer(object):
+    """ Keeps the materialized tables of a connection up to date.
+
+    Parameters
+    ----------
+    connection: Connection
+        The connection whose sessions are observed.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._tables = {}
+        self._fresh = set()
+
+        event.listen(connection.Session, "after_flush", self._after_flush)
+        event.listen(connection.Session, "after_bulk_update", self._after_bulk)
+        event.listen(connection.Session, "after_bulk_delete", self._after_bulk)
+
+    @property
+    def entities(self):
+        """ The list of materialized entity classes."""
+        return sorted(self._tables, key=lambda klass: klass.__name__)
+
+    def materialize(self, klass):
+        """ Creates the materialized table of `klass`, if needed,
+        and fills it with the current parameters.
+
+        Returns
+        -------
+        table: `Table`
+        """
+        if not (isinstance(klass, type) and issubclass(klass, Entity)) or klass is Entity:
+            raise TypeError("Only subclasses of Entity can be materialized.")
+
+        table = materialized_table(klass)
+        table.create(bind=self.connection.engine, checkfirst=True)
+        self._tables[klass] = table
+        self.rebuild(klass)
+        return table
+
+    def drop(self, klass=None):
+        """ Drops the materialized table of `klass` (or all tables)."""
+        klasses = list(self._tables) if klass is None else [klass]
+        for klass in klasses:
+            table = self._tables.pop(klass)
+            self._fresh.discard(klass)
+            table.drop(bind=self.connection.engine, checkfirst=True)
+
+    def is_fresh(self, klass):
+        """ Returns True if the materialized table of `klass` reflects
+        all changes which have been made through the ORM."""
+        return klass in self._fresh
+
+    def fresh_table(self, klass):
+        """ Returns the materialized table of `klass` if it is fresh, else None."""
+        if klass in self._fresh:
+            return self._tables[klass]
+        return None
+
+    def invalidate(self, klass=None):
+        """ Marks the table of `klass` (or all tables) as stale."""
+        if klass is None:
+            self._fresh.clear()
+        else:
+            self._fresh.discard(klass)
+
+    def rebuild(self, klass=None):
+        """ Refills the table of `klass` (or all tables) from the
+        parameter tables and marks it as fresh."""
+        klasses = list(self._tables) if klass is None else [klass]
+        with self.connection.auto_session as session:
+            for klass in klasses:
+                table = self._tables[klass]
+                session.execute(table.delete())
+                session.execute(self._insert(klass))
+                self._fresh.add(klass)
+
+    def refresh(self, session, entity_ids):
+        """ Updates the rows of the entities with `entity_ids`
+        in all tables, inside the transaction of `session`."""
+        for ids in batches(sorted(entity_ids), REFRESH_BATCH_SIZE):
+            for klass, table in self._tables.iteritems():
+                session.execute(table.delete().where(table.c._id.in_(ids)))
+                session.execute(self._insert(klass, ids))
+
+    def _insert(self, klass, entity_ids=None):
+        """ Returns an ``INSERT ... SELECT`` which pivots the parameters
+        of all entities of `klass` (or only those with `entity_ids`)."""
+        table = self._tables[klass]
+        entities = BaseEntity.__table__
+
+        from_obj = entities
+        columns = [entities.c.id]
+        keys = sorted(klass.declared_params)
+        for key in keys:
+            from_obj, value = outerjoin_parameter(from_obj, entities.c.id, key,
+                                                  parameter_for_type(klass.declared_params[key]))
+            columns.append(value)
+
+        clauses = [entities.c.type == klass.__mapper_args__['polymorphic_identity']]
+        if entity_ids is not None:
+            clauses.append(entities.c.id.in_(entity_ids))
+        pivot = select(columns, from_obj=[from_obj]).where(and_(*clauses))
+        return table.insert().from_select([table.c._id] + [table.c[key] for key in keys], pivot)
+
+    def _after_flush(self, session, flush_context):
+        if not self._tables:
+            return
+
+        entity_ids = set()
+        for obj in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, BaseEntity):
+                entity_ids.add(obj.id)
+            elif isinstance(obj, Parameter):
+                entity_ids.add(obj.entity_id)
+        entity_ids.discard(None)
+
+        if entity_ids:
+            self.refresh(session, entity_ids)
+
+    def _after_bulk(self, session, query, query_context, result):
+        mapper = query._mapper_zero()
+        if mapper is not None and issubclass(mapper.class_, (BaseEntity, Parameter)):
+            self.invalidate()
+
+    def __repr__(self):
+        return "Materializer({0!r})".format(self.connection)
+
@@ -10,48 +10,75 @@ values of an entity’s parameter.
 
 restricts the result to all Observers with `oberserver.params["age"] > 20`.
 
+Membership tests with `in_` and `not_in` are sent as a single ``IN``
+clause. Lists with more than `IN_ARRAY_THRESHOLD` values are bound as one
+array parameter instead of one parameter per value (``= ANY(:array)`` on
+PostgreSQL and a ``json_each(:json)`` sub-select on SQLite).
+
 """
 
 __docformat__ = "restructuredtext"
 
 __authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
 
-from sqlalchemy import and_
+import json
+
+from sqlalchemy import and_, literal, func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement, select, literal_column, _clone
+from sqlalchemy.types import Boolean
+
+#: Value lists longer than this are bound as a single array parameter.
+IN_ARRAY_THRESHOLD = 250
+
+def _sql_operator(test):
+    """ Marks `test` as an operator of this module, which returns the
+    equivalent SQL clause when it is applied to a column."""
+    test.is_sql_operator = True
+    return test
+
+def is_sql_operator(test):
+    """ Returns True, if `test` is one of the operators of this module.
+
+    Arbitrary callables may use Python’s ``and``, ``or`` or ``not``, which
+    do not translate into SQL, and must therefore be checked in Python.
+    """
+    return getattr(test, "is_sql_operator", False)
 
 def ge(v):
     """ Greater or even than.
 
     ``ge(v)(t) == t >= v``
     """
-    return lambda type: type >= v
+    return _sql_operator(lambda type: type >= v)
 
 def gt(v):
     """ Greater than.
 
     ``gt(v)(t) == t > v``
     """
-    return lambda type: type > v
+    return _sql_operator(lambda type: type > v)
 
 def le(v):
     """ Lesser or equal than.
 
     ``le(v)(t) == t <= v``
     """
-    return lambda type: type <= v
+    return _sql_operator(lambda type: type <= v)
 
 def lt(v):
     """ Lesser than.
 
     ``lt(v)(t) == t < v``
     """
-    return lambda type: type < v
+    return _sql_operator(lambda type: type < v)
 
 def between(v1, v2):
     """ Between.
 
     ``between(v1, v2)(t) == t >= v1 and t <= v2``
     """
-    return lambda type: and_(ge(v1)(type), le(v2)(type))
+    return _sql_operator(lambda type: and_(ge(v1)(type), le(v2)(type)))
 
 
 def eq(v):
@@ -60,7 +87,7 @@ def eq(v):
     ``eq(v)(t) == (v == t)``
     """
 
-    return lambda type: type == v
+    return _sql_operator(lambda type: type == v)
 
 def like(v):
     """ Like.
@@ -68,7 +95,127 @@ def like(v):
     ``like(v)(t) == t.like(v)``
     """
 
-    return lambda type: type.like(v) # TODO or the other way round?
+    return _sql_operator(lambda type: type.like(v)) # TODO or the other way round?
+
+def in_(values):
+    """ Is one of.
+
+    ``in_(vs)(t) == t in vs``
+    """
+    values = list(values)
+    def test(type):
+        if hasattr(type, "in_"):
+            return InValues(type, values)
+        return type in values
+    return _sql_operator(test)
+
+def not_in(values):
+    """ Is none of.
 
+    ``not_in(vs)(t) == t not in vs``
+    """
+    values = list(values)
+    def test(type):
+        if hasattr(type, "in_"):
+            return InValues(type, values, negate=True)
+        return type not in values
+    return _sql_operator(test)
 
+def in_range(start=None, stop=None):
+    """ Half-open range. Either bound may be omitted.
 
+    ``in_range(v1, v2)(t) == t >= v1 and t < v2``
+    """
+    if start is None and stop is None:
+        raise ValueError("in_range needs a start or a stop value.")
+    def test(type):
+        clauses = []
+        if start is not None:
+            clauses.append(ge(start)(type))
+        if stop is not None:
+            clauses.append(lt(stop)(type))
+        return and_(*clauses)
+    return _sql_operator(test)
+
+
+class Missing(object):
+    """ Matches entities which do not have a value for the parameter.
+    (See `missing`.)
+    """
+    is_sql_operator = True
+
+    def __call__(self, type):
+        if hasattr(type, "in_"):
+            return type == None
+        return type is None
+
+    def __repr__(self):
+        return "missing()"
+
+def missing():
+    """ Missing.
+
+    ``missing()(t) == t is None``, i.e. the entity has no such parameter.
+    """
+    return Missing()
+
+#: Alias for `missing`; parameters cannot hold a ``NULL`` value.
+is_null = missing
+
+
+class InValues(ColumnElement):
+    """ The clause ``column IN (values)`` (or ``NOT IN``), which is compiled
+    into an array parameter if there are many values.
+    """
+    __visit_name__ = "in_values"
+    type = Boolean()
+
+    def __init__(self, column, values, negate=False):
+        if hasattr(column, "__clause_element__"):
+            column = column.__clause_element__()
+        self.column = column
+        self.values = values
+        self.negate = negate
+
+    @property
+    def _from_objects(self):
+        return self.column._from_objects
+
+    def get_children(self, **kwargs):
+        return self.column,
+
+    def _copy_internals(self, clone=_clone, **kw):
+        self.column = clone(self.column, **kw)
+
+    def _in_clause(self, selectable=None):
+        if not self.values:
+            # nothing is in an empty list
+            return literal(1) == (1 if self.negate else 0)
+        clause = self.column.in_(selectable if selectable is not None else self.values)
+        return ~clause if self.negate else clause
+
+@compiles(InValues)
+def _compile_in_values(element, compiler, **kw):
+    return compiler.process(element._in_clause(), **kw)
+
+@compiles(InValues, "postgresql")
+def _compile_in_values_postgresql(element, compiler, **kw):
+    if len(element.values) <= IN_ARRAY_THRESHOLD:
+        return compiler.process(element._in_clause(), **kw)
+    from sqlalchemy.dialects.postgresql import ARRAY
+    array = literal(element.values, ARRAY(element.column.type))
+    if element.negate:
+        clause = element.column != func.all(array)
+    else:
+        clause = element.column == func.any(array)
+    return compiler.process(clause, **kw)
+
+@compiles(InValues, "sqlite")
+def _compile_in_values_sqlite(element, compiler, **kw):
+    if len(element.values) <= IN_ARRAY_THRESHOLD:
+        return compiler.process(element._in_clause(), **kw)
+    # the values are stored the same way as in the column
+    processor = element.column.type.dialect_impl(compiler.dialect).bind_processor(compiler.dialect)
+    values = [processor(value) if processor else value for value in element.values]
+    array = select([literal_column("value")]).select_from(func.json_each(literal(json.dumps(values))))
+    return compiler.process(element._in_clause(array), **kw)
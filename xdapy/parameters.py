@@ -12,8 +12,9 @@ __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>',
 from datetime import date, time, datetime
 from sqlalchemy import Sequence, Column, ForeignKey, \
      String, Integer, Float, Date, Time, DateTime, Boolean
-from sqlalchemy.orm import validates
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.orm import validates, column_property
+from sqlalchemy.sql import exists, and_, select
+from sqlalchemy.schema import UniqueConstraint, Index
 
 from xdapy import Base
 from xdapy.errors import StringConversionError
@@ -95,7 +96,11 @@ class StringParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', String(40))
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_string'
+    __table_args__ = (Index('ix_parameters_string_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'string'}
 
     @classmethod
@@ -147,7 +152,11 @@ class IntegerParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', Integer)
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_integer'
+    __table_args__ = (Index('ix_parameters_integer_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'integer'}
 
     @classmethod
@@ -199,7 +208,11 @@ class FloatParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', Float)
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_float'
+    __table_args__ = (Index('ix_parameters_float_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'float'}
 
     @classmethod
@@ -251,7 +264,11 @@ class DateParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', Date)
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_date'
+    __table_args__ = (Index('ix_parameters_date_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'date'}
 
     @classmethod
@@ -315,7 +332,11 @@ class TimeParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', Time)
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_time'
+    __table_args__ = (Index('ix_parameters_time_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'time'}
 
     @classmethod
@@ -372,7 +393,11 @@ class DateTimeParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', DateTime)
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_datetime'
+    __table_args__ = (Index('ix_parameters_datetime_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'datetime'}
 
     @classmethod
@@ -430,7 +455,11 @@ class BooleanParameter(Parameter):
     id = Column('id', Integer, ForeignKey('parameters.id'), primary_key=True)
     value = Column('value', Boolean)
 
+    #: Copy of `Parameter.name` for the (name, value) index.
+    name = column_property(Column('name', String(40)), Parameter.name)
+
     __tablename__ = 'parameters_boolean'
+    __table_args__ = (Index('ix_parameters_boolean_name_value', 'name', 'value'), {})
     __mapper_args__ = {'polymorphic_identity':'boolean'}
 
     @classmethod
@@ -512,6 +541,120 @@ def parameter_for_type(typename):
     """
     return _parameter_map[typename]
 
+class _BareValue(object):
+    """ Gives the value properties of a parameter class access to a plain
+    value, without creating a mapped parameter object."""
+    def __init__(self, parameter_class, value):
+        self.parameter_class = parameter_class
+        self.value = value
+
+    @property
+    def value_string(self):
+        return self.parameter_class.value_string.fget(self)
+
+def json_value(typename, value):
+    """ Returns `value` in the format of `Parameter.value_json` of the
+    parameter class for `typename`, e.g. for values which have been
+    read with `select_parameter_values`.
+    """
+    parameter_class = parameter_for_type(typename)
+    return parameter_class.value_json.fget(_BareValue(parameter_class, value))
+
+def parameter_exists(entity_id, key, parameter_class, condition=None):
+    """ Returns an ``EXISTS`` clause which holds if the entity with the id
+    `entity_id` has a parameter `key` whose value fulfills `condition`.
+
+    Parameters
+    ----------
+    entity_id: column
+        The id column of the (possibly aliased) entities table.
+    key: string
+        The name of the parameter.
+    parameter_class: subclass of `Parameter`
+        The class which stores the values of the parameter.
+    condition: clause, optional
+        An expression on ``parameter_class.value``.
+    """
+    parameters = Parameter.__table__
+    values = parameter_class.__table__
+    clauses = [parameters.c.entity_id == entity_id,
+               parameters.c.name == key,
+               values.c.id == parameters.c.id,
+               values.c.name == key]
+    if condition is not None:
+        clauses.append(condition)
+    return exists().where(and_(*clauses))
+
+def outerjoin_parameter(from_obj, entity_id, key, parameter_class):
+    """ Joins the values of the parameter `key` to `from_obj`. Entities
+    without this parameter get ``NULL`` as their value.
+
+    Parameters
+    ----------
+    from_obj: selectable
+        The selectable to join to.
+    entity_id: column
+        The column in `from_obj` which holds the entity id.
+    key: string
+        The name of the parameter.
+    parameter_class: subclass of `Parameter`
+        The class which stores the values of the parameter.
+
+    Returns
+    -------
+    (joined, value): tuple
+        The joined selectable and the column of the parameter value.
+    """
+    parameters = Parameter.__table__.alias()
+    values = parameter_class.__table__.alias()
+    joined = from_obj.outerjoin(parameters, and_(parameters.c.entity_id == entity_id,
+                                                 parameters.c.name == key))
+    joined = joined.outerjoin(values, values.c.id == parameters.c.id)
+    return joined, values.c.value
+
+def copy_parameter_names(connection, parameter_classes=None):
+    """ Copies the names from the `parameters` table into the ``name``
+    column of the typed tables, where it is not yet set.
+
+    This is only needed for databases which have been created before
+    the typed tables had a ``name`` column. (See `xdapy.connection.Connection.upgrade_tables`.)
+
+    Parameters
+    ----------
+    connection: sqlalchemy connection
+        The connection to execute the updates on.
+    parameter_classes: list, optional
+        The parameter classes whose tables are updated. Defaults to all.
+    """
+    parameters = Parameter.__table__
+    if parameter_classes is None:
+        parameter_classes = _parameter_classes
+    for pc in parameter_classes:
+        values = pc.__table__
+        name = select([parameters.c.name]).where(parameters.c.id == values.c.id).as_scalar()
+        connection.execute(values.update().where(values.c.name == None).values(name=name))
+
+def select_parameter_values(entity_ids):
+    """ Returns a select of all parameters of the entities with the ids
+    `entity_ids`, regardless of their type.
+
+    Each row has the columns ``entity_id``, ``name``, ``type`` and
+    one column ``value_<type>`` for each parameter type. Only the column
+    of the parameter’s own type is set.
+
+    Parameters
+    ----------
+    entity_ids: list or selectable
+        The ids of the entities.
+    """
+    parameters = Parameter.__table__
+    joined = parameters
+    columns = [parameters.c.entity_id, parameters.c.name, parameters.c.type]
+    for pc in _parameter_classes:
+        joined = joined.outerjoin(pc.__table__, pc.__table__.c.id == parameters.c.id)
+        columns.append(pc.__table__.c.value.label("value_" + pc.__mapper_args__['polymorphic_identity']))
+    return select(columns).select_from(joined).where(parameters.c.entity_id.in_(entity_ids))
+
 def find_accepting_class(value):
     """ Goes through all classes and the first class which accepts the given `value`.
 
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storage backends for binary data.
+
+By default, the binary data of an entity is stored inside the database,
+split into rows of `xdapy.data.DataChunks`. For large recordings this bloats
+the database, so a `DataStore` may be configured on the `Connection`::
+
+    store = FileSystemStore("/var/lib/xdapy/data")
+    connection = Connection.profile("default", data_store=store)
+
+New data is then written to the store and the `data` table only keeps
+the digest and the size of the content. Data which has been stored in the
+database before stays readable and may be moved to the store with
+`migrate_to_store`.
+"""
+
+__docformat__ = "restructuredtext"
+
+__authors__ = ['"Rike-Benjamin Schuppner" <rikebs@debilski.de>']
+
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+
+from xdapy.errors import DataInconsistencyError
+
+#: The number of bytes which are copied at once.
+COPY_BUFFER_SIZE = 1024 * 1024 # Byte
+
+
+class DataStore(object):
+    """ Base class for storage backends.
+
+    A store keeps immutable blobs of bytes which are addressed by the
+    digest of their content.
+    """
+
+    def put_file(self, fileish):
+        """ Stores the content of a file-like object.
+
+        Parameters
+        ----------
+        fileish: file-like object
+            The file to read from.
+
+        Returns
+        -------
+        (digest, size): tuple
+            The digest under which the content is stored and its size in bytes.
+        """
+        return self.put_chunks(iter(lambda: fileish.read(COPY_BUFFER_SIZE), ""))
+
+    def put_chunks(self, chunks):
+        """ Stores the concatenation of the strings in `chunks`.
+
+        Returns
+        -------
+        (digest, size): tuple
+            The digest under which the content is stored and its size in bytes.
+        """
+        raise NotImplementedError
+
+    def open(self, digest):
+        """ Returns a read-only file object for the content with `digest`."""
+        raise NotImplementedError
+
+    def get(self, digest, fileish):
+        """ Writes the content with `digest` to the file-like object `fileish`."""
+        with self.open(digest) as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), ""):
+                fileish.write(chunk)
+
+    def exists(self, digest):
+        """ Returns True if there is content for `digest`."""
+        raise NotImplementedError
+
+    def size(self, digest):
+        """ Returns the size of the content with `digest`."""
+        raise NotImplementedError
+
+    def delete(self, digest):
+        """ Removes the content with `digest`."""
+        raise NotImplementedError
+
+    def digests(self):
+        """ Iterates over the digests of all stored contents."""
+        raise NotImplementedError
+
+
+class FileSystemStore(DataStore):
+    """ Stores each content as a file in a local directory.
+
+    The files are named after the digest of their content and sharded into
+    sub-directories, which are named after the first characters of the digest::
+
+        root/3f/a2/3fa2...
+
+    As equal contents share one file, a file must not be removed as long as
+    some data refers to it. (See `remove_unreferenced`.)
+
+    Parameters
+    ----------
+    root: string
+        The directory which holds the files.
+    hash_name: string, optional
+        The name of the `hashlib` algorithm to use.
+    levels: int, optional
+        The number of sub-directory levels.
+    """
+    def __init__(self, root, hash_name="sha1", levels=2):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.hash_name = hash_name
+        self.levels = levels
+
+    def path(self, digest):
+        """ Returns the name of the file for `digest`."""
+        shards = [digest[2 * level:2 * level + 2] for level in range(self.levels)]
+        return os.path.join(self.root, *(shards + [digest]))
+
+    def _makedirs(self, folder):
+        try:
+            os.makedirs(folder)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def put_chunks(self, chunks):
+        # The content is first streamed into a temporary file in the same
+        # file system and moved into place once its digest is known.
+        tmp_folder = os.path.join(self.root, "tmp")
+        self._makedirs(tmp_folder)
+
+        the_hash = hashlib.new(self.hash_name)
+        size = 0
+        fd, tmp_name = tempfile.mkstemp(dir=tmp_folder)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                for chunk in chunks:
+                    the_hash.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+
+            digest = the_hash.hexdigest()
+            file_name = self.path(digest)
+            if os.path.exists(file_name):
+                # we already have this content
+                os.remove(tmp_name)
+            else:
+                self._makedirs(os.path.dirname(file_name))
+                os.rename(tmp_name, file_name)
+        except Exception:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+        return digest, size
+
+    def open(self, digest):
+        try:
+            return open(self.path(digest), "rb")
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise DataInconsistencyError("No content for digest {0} in {1!r}.".format(digest, self))
+            raise
+
+    def mmap(self, digest):
+        """ Returns a read-only memory map of the content with `digest`.
+
+        This allows for zero-copy access, e.g. with ``numpy.frombuffer``.
+        """
+        with self.open(digest) as f:
+            if not os.fstat(f.fileno()).st_size:
+                # empty files cannot be mapped
+                return ""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, digest, fileish):
+        content = self.mmap(digest)
+        try:
+            for start in xrange(0, len(content), COPY_BUFFER_SIZE):
+                fileish.write(content[start:start + COPY_BUFFER_SIZE])
+        finally:
+            if content:
+                content.close()
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest):
+        return os.path.getsize(self.path(digest))
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def digests(self):
+        for folder, dirs, files in os.walk(self.root):
+            if folder == os.path.join(self.root, "tmp"):
+                continue
+            for file_name in files:
+                yield file_name
+
+    def __repr__(self):
+        return "FileSystemStore(root={0!r})".format(self.root)
+
+
+def _chunk_contents(session, data_id):
+    """ Yields the data chunks of the data with `data_id` in order.
+    Only one chunk is held in memory at a time."""
+    from xdapy.data import DataChunks
+    ids = [chunk_id for chunk_id, in session.query(DataChunks.id).\
+                                        filter(DataChunks.data_id == data_id).\
+                                        order_by(DataChunks.index)]
+    for chunk_id in ids:
+        yield session.query(DataChunks._chunk).filter(DataChunks.id == chunk_id).scalar()
+
+
+def migrate_to_store(connection, store=None, progress=None):
+    """ Moves all data which is stored as data chunks inside the database
+    into a `DataStore`. Each data object is committed on its own, so the
+    migration may be interrupted and resumed.
+
+    Parameters
+    ----------
+    connection: Connection
+        The connection to the database.
+    store: DataStore, optional
+        The target store. Defaults to the store of the connection.
+    progress: callable, optional
+        Called as ``progress(count, total)`` after each migrated data object.
+
+    Returns
+    -------
+    count: int
+        The number of migrated data objects.
+    """
+    from xdapy.data import Data, DataChunks
+
+    store = store or connection.data_store
+    if store is None:
+        raise ValueError("No data store given.")
+
+    session = connection.session
+    data_ids = [data_id for data_id, in session.query(Data.id).filter(Data.digest == None).order_by(Data.id)]
+
+    count = 0
+    for data_id in data_ids:
+        with connection.auto_session as session:
+            digest, size = store.put_chunks(_chunk_contents(session, data_id))
+            session.query(Data).filter(Data.id == data_id).update({"digest": digest, "size": size},
+                                                                   synchronize_session=False)
+            session.query(DataChunks).filter(DataChunks.data_id == data_id).delete(synchronize_session=False)
+        count += 1
+        if progress:
+            progress(count, len(data_ids))
+    session.expire_all()
+    return count
+
+
+def remove_unreferenced(connection, store=None):
+    """ Removes all contents from the store which are not referenced by any data.
+
+    Returns
+    -------
+    removed: list
+        The digests of the removed contents.
+    """
+    from xdapy.data import Data
+
+    store = store or connection.data_store
+    if store is None:
+        raise ValueError("No data store given.")
+
+    session = connection.session
+    referenced = set(digest for digest, in session.query(Data.digest).filter(Data.digest != None).distinct())
+
+    removed = []
+    for digest in list(store.digests()):
+        if digest not in referenced:
+            store.delete(digest)
+            removed.append(digest)
+    return removed
+
+
+def main(argv=None):
+    """ Command line interface for `migrate_to_store`::
+
+        python -m xdapy.storage [--profile PROFILE] [--config FILE] STORE_DIRECTORY
+    """
+    import argparse
+    import sys
+
+    from xdapy.connection import Connection
+
+    parser = argparse.ArgumentParser(description="Moves the binary data from the database into a file system store.")
+    parser.add_argument("root", help="the directory of the file system store")
+    parser.add_argument("--profile", default=Connection.DEFAULT_PROFILE, help="the connection profile to use")
+    parser.add_argument("--config", default=None, help="the configuration file of the profiles")
+    args = parser.parse_args(argv)
+
+    connection = Connection.profile(args.profile, filename=args.config)
+    connection.upgrade_tables()
+
+    def report(count, total):
+        sys.stdout.write("\r{0}/{1} data objects migrated".format(count, total))
+        sys.stdout.flush()
+
+    migrate_to_store(connection, FileSystemStore(args.root), progress=report)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
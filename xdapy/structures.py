@@ -17,6 +17,7 @@ import itertools
 
 from sqlalchemy import Column, ForeignKey, String, Integer, event
 from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql import select, literal, and_
 from sqlalchemy.orm import relationship, backref, validates
 from sqlalchemy.orm.session import Session
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -30,7 +31,30 @@ from xdapy.errors import EntityDefinitionError, InsertionError, MissingSessionEr
 from xdapy.utils.algorithms import gen_uuid, hash_dict
 
 
+#: Cache for `calculate_polymorphic_name`.
+_polymorphic_names = {}
+
 def calculate_polymorphic_name(name, declared_params):
+    """ Returns the polymorphic name ``name_<hash>`` of an entity
+    with `declared_params`.
+
+    The results are cached, as hashing the declared parameters
+    is comparatively expensive and this function is called for every
+    type check while importing objects.
+    """
+    try:
+        # str and unicode names must not share an entry
+        cache_key = (type(name), name, frozenset(declared_params.iteritems()))
+        return _polymorphic_names[cache_key]
+    except TypeError:
+        # unhashable values; calculate without cache
+        return _calculate_polymorphic_name(name, declared_params)
+    except KeyError:
+        polymorphic_name = _calculate_polymorphic_name(name, declared_params)
+        _polymorphic_names[cache_key] = polymorphic_name
+        return polymorphic_name
+
+def _calculate_polymorphic_name(name, declared_params):
     split_name = name.split('_')
     if len(split_name) > 2:
         raise EntityDefinitionError("Entity class must not contain more than one underscore.")
@@ -49,6 +73,74 @@ def calculate_polymorphic_name(name, declared_params):
     return name + "_" + the_hash
 
 
+def _related_ids_cte(entity_ids, upwards, max_depth=None, name="related_entities"):
+    """ Returns a recursive common table expression which selects the ids
+    `entity_ids` together with the ids of all their ancestors (`upwards`)
+    or of all their descendants.
+
+    The entities themselves are part of the result so that the query never
+    comes back empty; the sqlite3 module of Python 2 does not report result
+    columns for empty results of statements starting with WITH.
+
+    Without `max_depth`, only the ids are selected and the recursive part is
+    joined with UNION so that the query terminates even on circular references.
+
+    Parameters
+    ----------
+    entity_ids: list or select
+        The ids of the entities to start with.
+    upwards: bool
+        Whether to select the ancestors instead of the descendants.
+    max_depth: int, optional
+        The maximum number of generations to select.
+    name: string, optional
+        The name of the expression in the query.
+    """
+    entities = BaseEntity.__table__
+    related = entities.alias()
+
+    seed = select([entities.c.id.label("id")]).where(entities.c.id.in_(entity_ids))
+    if max_depth is not None:
+        seed = seed.column(literal(0).label("depth"))
+
+    cte = seed.cte(name, recursive=True)
+    previous = cte.alias()
+
+    if upwards:
+        step = select([related.c.parent_id]).where(and_(related.c.id == previous.c.id,
+                                                        related.c.parent_id != None))
+    else:
+        step = select([related.c.id]).where(related.c.parent_id == previous.c.id)
+
+    if max_depth is not None:
+        step = step.column(previous.c.depth + 1).where(previous.c.depth < max_depth)
+
+    return cte.union(step)
+
+
+class EntityRecord(collections.namedtuple("EntityRecord", "id type unique_id parent_id params")):
+    """ A lightweight, read-only copy of an entity.
+
+    Records are not attached to a session and do not track changes;
+    they are meant for scanning large numbers of entities.
+    (See `xdapy.mapper.Mapper.iter_find`.)
+
+    Attributes
+    ----------
+    id: int
+        The database id of the entity.
+    type: string
+        The type of the entity, leaving out the type hash.
+    unique_id: string
+        The unique_id of the entity.
+    parent_id: int or None
+        The id of the parent entity.
+    params: dict
+        The parameters of the entity.
+    """
+    __slots__ = ()
+
+
 class BaseEntity(Base):
     """
     The class `BaseEntity` is mapped on the table 'entities'. The name column
@@ -426,9 +518,31 @@ class Entity(BaseEntity):
             if v is not None:
                 self.params[n] = v
 
+    def _load_related(self, upwards, max_depth=None):
+        """ Loads all ancestors (`upwards`) or all descendants of this entity
+        with a single recursive query. The loaded entities are placed in the
+        identity map of the session, so that subsequent access to `parent`
+        does not issue any further queries.
+
+        Returns
+        -------
+        entities: list or None
+            The loaded entities or None, if the entity is not yet persisted.
+        """
+        session = Session.object_session(self)
+        if session is None or self.id is None:
+            return None
+
+        cte = _related_ids_cte([self.id], upwards, max_depth)
+        return session.query(BaseEntity).filter(BaseEntity.id.in_(select([cte.c.id]))).all()
+
     def ancestors(self):
         """ Returns a list of all parent and grand-parent entities.
         """
+        # keep a reference to the loaded entities while walking up, otherwise
+        # they may be dropped from the (weak-referencing) identity map
+        loaded = self._load_related(upwards=True)
+
         node = self
         parents = []
         while node.parent:
@@ -438,14 +552,54 @@ class Entity(BaseEntity):
             parents.append(node)
         return parents
 
+    def descendants(self, max_depth=None):
+        """ Returns a list of all children and grand-children of this entity,
+        ordered by their depth in the tree.
+
+        Parameters
+        ----------
+        max_depth: int, optional
+            The maximum number of generations to return. `None` returns all
+            descendants.
+
+        Returns
+        -------
+        descendants: list
+            The descendants of this entity.
+        """
+        if max_depth is not None and max_depth < 1:
+            return []
+
+        loaded = self._load_related(upwards=False, max_depth=max_depth)
+        if loaded is None:
+            # not persisted: walk the children in memory
+            children_of = lambda node: node.children
+        else:
+            by_parent = collections.defaultdict(list)
+            for entity in loaded:
+                by_parent[entity.parent_id].append(entity)
+            children_of = lambda node: by_parent[node.id]
+
+        descendants = []
+        seen = set([self])
+        generation = [self]
+        depth = 0
+        while generation and (max_depth is None or depth < max_depth):
+            depth += 1
+            next_generation = []
+            for node in generation:
+                for child in children_of(node):
+                    if child not in seen:
+                        seen.add(child)
+                        next_generation.append(child)
+            descendants.extend(next_generation)
+            generation = next_generation
+        return descendants
+
     def siblings(self):
         """ Returns a list of all children and siblings.
         """
-        children = set()
-        children.update(self.children)
-        for child in self.children:
-            children.update(child.siblings())
-        return children
+        return set(self.descendants())
 
     def __repr__(self):
         return "{cls}(id={id!s}, unique_id={unique_id!s})".format(cls=self.type, id=self.id, unique_id=self.unique_id)
@@ -511,7 +665,7 @@ class Entity(BaseEntity):
         if connection_type:
             return self.context[connection_type]
         else:
-            return set(item for sublist in self.context.values() for item in sublist)
+            return set(self._context_index("holds_context").entities())
 
     def holders(self, connection_type=None):
         """ Returns all entities which hold this entity as an attachment.
@@ -521,10 +675,22 @@ class Entity(BaseEntity):
         connection_type : string, optional
             Restricts the output to the specified `connection_type`
         """
-        if connection_type:
-            return set(ctx.holder for ctx in self.attached_by if ctx.connection_type==connection_type)
-        else:
-            return set(ctx.holder for ctx in self.attached_by)
+        return set(self._context_index("attached_by").entities(connection_type))
+
+    def _context_index(self, attribute):
+        """ Returns the `_ContextIndex` of the context collection `attribute`
+        (``"holds_context"`` or ``"attached_by"``).
+
+        The index is kept up to date by the events of `Context`; it is only
+        rebuilt when the collection itself has been (re-)loaded.
+        """
+        collection = getattr(self, attribute)
+        index = self.__dict__.get("_index_" + attribute)
+        if index is None or index.collection is not collection:
+            index = _ContextIndex(collection, "attachment" if attribute == "holds_context" else "holder")
+            self.__dict__["_index_" + attribute] = index
+        index.update()
+        return index
 
     @property
     def context(self):
@@ -581,18 +747,75 @@ def create_entity(name, declared_params):
         name = str(name)
     return type(name, (Entity,), {'declared_params': declared_params})
 
+class _ContextIndex(object):
+    """ Indexes a collection of `Context` objects by their `connection_type`
+    and by the entity on the other side (the `attachment` for
+    ``holds_context``, the `holder` for ``attached_by``).
+
+    Contexts which are added to the collection are only queued and indexed
+    on the next call to `update`, because the attributes of a new `Context`
+    may not all be set when it is added.
+    """
+    def __init__(self, collection, key):
+        self.collection = collection
+        self.key = key
+        self.by_type = {}
+        self.pending = set(collection)
+
+    def update(self):
+        """ Indexes the queued contexts which are still part of the collection.
+
+        Orphaned contexts, which have been removed from the other side and
+        are deleted on the next flush, are not indexed.
+        """
+        while self.pending:
+            ctx = self.pending.pop()
+            entity = getattr(ctx, self.key)
+            if entity is not None and ctx in self.collection:
+                self.by_type.setdefault(ctx.connection_type, {})[entity] = ctx
+
+    def add(self, ctx):
+        self.pending.add(ctx)
+
+    def remove(self, ctx):
+        self.pending.discard(ctx)
+        by_entity = self.by_type.get(ctx.connection_type)
+        if by_entity and by_entity.get(getattr(ctx, self.key)) is ctx:
+            del by_entity[getattr(ctx, self.key)]
+            if not by_entity:
+                del self.by_type[ctx.connection_type]
+
+    def get(self, connection_type, entity):
+        """ Returns the context with `connection_type` to `entity` or None."""
+        return self.by_type.get(connection_type, {}).get(entity)
+
+    def contexts(self, connection_type):
+        """ Returns a list of the contexts with `connection_type`."""
+        return self.by_type.get(connection_type, {}).values()
+
+    def entities(self, connection_type=None):
+        """ Returns a list of the entities with `connection_type` (or with any type)."""
+        if connection_type is not None:
+            return self.by_type.get(connection_type, {}).keys()
+        return [entity for by_entity in self.by_type.itervalues() for entity in by_entity]
+
+
 class _ContextBySetDict(collections.MutableMapping):
     def __init__(self, parent):
         self.parent = parent
 
+    @property
+    def index(self):
+        return self.parent._context_index("holds_context")
+
     def __iter__(self):
         return iter(self.keys())
 
     def keys(self):
-        return list(set(ctx.connection_type for ctx in self.parent.holds_context))
+        return self.index.by_type.keys()
 
     def __delitem__(self, connection_type):
-        toremove = set([ctx for ctx in self.parent.holds_context if ctx.connection_type == connection_type])
+        toremove = self.index.contexts(connection_type)
         if not toremove:
             raise KeyError(connection_type)
         self.parent.holds_context.difference_update(toremove)
@@ -601,17 +824,19 @@ class _ContextBySetDict(collections.MutableMapping):
         return _ContextBySet(self.parent, connection_type)
 
     def __setitem__(self, connection_type, value):
-        current = set([ctx for ctx in self.parent.holds_context if ctx.connection_type == connection_type])
-        toremove = set([ctx for ctx in current if ctx.attachment not in value])
-        toadd = set([Context(connection_type=connection_type,attachment=v) for v in value if v not in current])
+        value = set(value)
+        index = self.index
+        toremove = set([ctx for ctx in index.contexts(connection_type) if ctx.attachment not in value])
+        toadd = set([Context(connection_type=connection_type, attachment=v) for v in value
+                     if index.get(connection_type, v) is None])
         self.parent.holds_context.update(toadd)
         self.parent.holds_context.difference_update(toremove)
 
     def __contains__(self, connection_type):
-        return any(ctx for ctx in self.parent.holds_context if ctx.connection_type == connection_type)
+        return connection_type in self.index.by_type
 
     def __len__(self):
-        return len(self.keys())
+        return len(self.index.by_type)
 
     def __repr__(self):
         return repr(dict(self))
@@ -621,35 +846,33 @@ class _ContextBySet(collections.MutableSet):
         self.connection_type = connection_type
         self.parent = parent
 
+    @property
+    def index(self):
+        return self.parent._context_index("holds_context")
+
     def __iter__(self):
-        return iter([ctx.attachment for ctx
-                     in self.parent.holds_context if ctx.connection_type == self.connection_type])
+        return iter(self.index.entities(self.connection_type))
 
     def update(self, items):
-        curr = set([ctx.attachment for ctx
-                    in self.parent.holds_context if ctx.connection_type==self.connection_type])
-        toadd = set(items).difference(curr)
+        index = self.index
+        toadd = set(item for item in items if index.get(self.connection_type, item) is None)
         self.parent.holds_context.update(
             [Context(connection_type=self.connection_type, attachment=item) for item in toadd])
 
     def add(self, item):
-        for ctx in self.parent.holds_context:
-            if ctx.connection_type == self.connection_type and ctx.attachment is item:
-                break
-        else:
+        if self.index.get(self.connection_type, item) is None:
             self.parent.holds_context.add(Context(connection_type=self.connection_type, attachment=item))
 
     def discard(self, item):
-        for ctx in self.parent.holds_context:
-            if ctx.connection_type == self.connection_type and ctx.attachment is item:
-                self.parent.holds_context.remove(ctx)
-                break
+        ctx = self.index.get(self.connection_type, item)
+        if ctx is not None:
+            self.parent.holds_context.remove(ctx)
 
     def __contains__(self, item):
-        return item in iter(self)
+        return self.index.get(self.connection_type, item) is not None
 
     def __len__(self):
-        return sum(1 for _ in iter(self))
+        return len(self.index.contexts(self.connection_type))
 
     def __repr__(self):
         return repr(set(self))
@@ -684,6 +907,45 @@ class Context(Base):
         return "Context({e} has {t} {a})".format(e=self.holder, t=self.connection_type, a=self.attachment)
 
 
+#: The sides of a `Context` and the context collections of the entities there.
+_CONTEXT_SIDES = (("holder", "holds_context"), ("attachment", "attached_by"))
+
+def _existing_context_index(entity, attribute):
+    """ Returns the `_ContextIndex` of `entity` for the collection `attribute`
+    or None, if it has not been built."""
+    if isinstance(entity, Entity):
+        return entity.__dict__.get("_index_" + attribute)
+    return None
+
+def _reindex_context(key):
+    """ Returns a listener for changes of `Context.holder`, `Context.attachment`
+    or `Context.connection_type` (given as `key`) which keeps the
+    `_ContextIndex` of the entities on both sides of the context up to date.
+
+    The listener is called before the value changes. The context is therefore
+    removed under its old key and queued to be indexed under the new one.
+    """
+    def listener(ctx, value, oldvalue, initiator):
+        for side, attribute in _CONTEXT_SIDES:
+            if side == key:
+                # the context moves to the collection of another entity
+                for entity, method in ((oldvalue, "remove"), (value, "add")):
+                    index = _existing_context_index(entity, attribute)
+                    if index is not None:
+                        getattr(index, method)(ctx)
+            else:
+                # the context stays, but its key changes
+                index = _existing_context_index(getattr(ctx, side), attribute)
+                if index is not None:
+                    index.remove(ctx)
+                    index.add(ctx)
+    return listener
+
+event.listen(Context.holder, "set", _reindex_context("holder"))
+event.listen(Context.attachment, "set", _reindex_context("attachment"))
+event.listen(Context.connection_type, "set", _reindex_context("connection_type"))
+
+
 class ParameterDeclaration(Base):
     """
     The class `ParameterDeclaration` is mapped on the table 'parameter_declarations'. This
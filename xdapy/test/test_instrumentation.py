@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""Unittest for the instrumentation of the database access"""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.instrumentation import OUTSIDE, QueryStats, slow_query_logger
+from xdapy.io import JsonIO
+
+
+class Observer(Entity):
+    declared_params = {
+        'name': 'string',
+        'age': 'integer'
+    }
+
+class Trial(Entity):
+    declared_params = {
+        'rt': 'float'
+    }
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection.test()
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Observer, Trial)
+
+        observers = [Observer(name="O%d" % i, age=20 + i) for i in range(3)]
+        for observer in observers:
+            for j in range(4):
+                Trial(rt=0.1 * j).parent = observer
+        self.m.save(*observers)
+
+    def tearDown(self):
+        self.connection.drop_tables()
+        # need to dispose manually to avoid too many connections error
+        self.connection.engine.dispose()
+
+    def test_disabled(self):
+        self.assertTrue(self.connection.instrumentation is None)
+        self.assertEqual(len(self.m.find_all(Observer)), 3)
+
+    def test_stats(self):
+        instrumentation = self.connection.instrument()
+        self.assertTrue(self.connection.instrument() is instrumentation)
+
+        self.m.find_all(Observer, {"age": 21})
+        self.m.find_all(Trial)
+        stats = instrumentation.stats
+
+        self.assertEqual(stats["Mapper.find_all"].calls, 2)
+        # the call to find inside find_all is not counted separately
+        self.assertFalse("Mapper.find" in stats)
+        self.assertEqual(stats["Mapper.find_all"].statements, 2)
+        self.assertEqual(stats["Mapper.find_all"].rows, 13)
+        self.assertTrue(stats["Mapper.find_all"].time >= stats["Mapper.find_all"].sql_time > 0)
+        self.assertEqual(stats["Mapper.unknown"].calls, 0)
+        self.assertTrue("Mapper.find_all" in stats.report())
+
+        stats.reset()
+        self.assertEqual(len(stats), 0)
+        instrumentation.enabled = False
+        self.m.find_all(Trial)
+        self.assertEqual(len(stats), 0)
+
+    def test_measure_lazy_loads(self):
+        with self.m.measure() as stats:
+            observers = self.m.find_all(Observer)
+            for observer in observers:
+                observer.children
+        self.assertTrue(isinstance(stats, QueryStats))
+        self.assertEqual(stats["Mapper.find_all"].statements, 1)
+        # one statement per observer
+        self.assertEqual(stats[OUTSIDE].statements, 3)
+        self.assertEqual(stats[OUTSIDE].rows, 12)
+        self.assertEqual(stats.total.statements, 4)
+
+        with self.m.measure() as stats:
+            observers = self.m.find_all(Observer, load=["children"])
+            for observer in observers:
+                observer.children
+        self.assertEqual(stats[OUTSIDE].statements, 0)
+
+        # the global stats contain both measurements
+        self.assertEqual(self.connection.instrumentation.stats["Mapper.find_all"].calls, 2)
+
+    def test_generator(self):
+        with self.m.measure() as stats:
+            trials = list(self.m.iter_find(Trial, batch_size=5))
+        self.assertEqual(len(trials), 12)
+        self.assertEqual(stats["Mapper.iter_find"].calls, 1)
+        self.assertEqual(stats[OUTSIDE].statements, 0)
+        self.assertTrue(stats["Mapper.iter_find"].statements >= 3)
+
+    def test_data_bytes(self):
+        observer = self.m.find_first(Observer)
+        with self.m.measure() as stats:
+            with self.m.auto_session:
+                observer.data["raw"].put("0123456789" * 100)
+        self.assertEqual(stats.total.bytes, 1000)
+
+        with self.m.measure() as stats:
+            self.assertEqual(len(observer.data["raw"].get_string()), 1000)
+        self.assertEqual(stats.total.bytes, 1000)
+
+    def test_io(self):
+        with self.m.measure() as stats:
+            JsonIO(self.m).write_string(self.m.find_all(Observer))
+        self.assertEqual(stats["JsonIO.write_string"].calls, 1)
+        self.assertTrue(stats["JsonIO.write_string"].statements > 0)
+
+
+class TestSlowQueryLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "slow.log")
+        self.connection = Connection.test(slow_query_threshold=0, slow_query_log=self.filename)
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Observer)
+        self.m.save(Observer(name="O1", age=20), Observer(name="O2", age=30))
+
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        slow_query_logger.addHandler(self.handler)
+
+    def tearDown(self):
+        slow_query_logger.removeHandler(self.handler)
+        self.connection.log_slow_queries(None)
+        self.connection.drop_tables()
+        # need to dispose manually to avoid too many connections error
+        self.connection.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_log(self):
+        self.assertFalse(self.connection.instrumentation.enabled)
+        self.m.find_all(Observer, {"age": 30})
+
+        record, = [r for r in self.records if r.call == "Mapper.find_all"]
+        self.assertTrue("SELECT" in record.statement)
+        self.assertTrue(30 in record.parameters)
+        self.assertTrue(record.duration >= 0)
+        # sqlite reports a SCAN or a SEARCH for each table
+        self.assertTrue("entities" in record.plan)
+
+        with open(self.filename) as log:
+            content = log.read()
+        self.assertTrue("Mapper.find_all" in content)
+        self.assertTrue("Plan:" in content)
+
+    def test_threshold(self):
+        self.connection.log_slow_queries(60)
+        self.m.find_all(Observer)
+        self.assertEqual(self.records, [])
+
+        self.connection.log_slow_queries(0, explain=False)
+        self.m.find_all(Observer)
+        self.assertTrue(self.records)
+        self.assertTrue(all(r.plan is None for r in self.records))
+
+        self.assertRaises(ValueError, self.connection.log_slow_queries, -1)
+
+    def test_explained_statements(self):
+        log = self.connection.instrumentation.slow_query_log
+        with self.connection.engine.connect() as conn:
+            self.assertTrue("entities" in log.query_plan(conn, "SELECT * FROM entities", ()))
+            # DDL is not explained
+            self.assertEqual(log.query_plan(conn, "CREATE INDEX ix_test ON entities (type)", ()), None)
+
+            # the plan of a statement inside a transaction must not commit it
+            transaction = conn.begin()
+            conn.execute("DELETE FROM entities")
+            transaction.rollback()
+        self.assertEqual(len(self.m.find_all(Observer)), 2)
+
+    def test_file_per_connection(self):
+        other_filename = os.path.join(self.directory, "other.log")
+        other = Connection.test(slow_query_threshold=0, slow_query_log=other_filename)
+        try:
+            other.create_tables()
+            other_mapper = Mapper(other)
+            other_mapper.register(Observer)
+            other_mapper.find_all(Observer, {"name": "only in other"})
+            self.m.find_all(Observer, {"name": "only in self"})
+        finally:
+            other.log_slow_queries(None)
+            other.drop_tables()
+            other.engine.dispose()
+
+        with open(self.filename) as log:
+            content = log.read()
+        self.assertTrue("only in self" in content)
+        self.assertFalse("only in other" in content)
+        with open(other_filename) as log:
+            content = log.read()
+        self.assertTrue("only in other" in content)
+        self.assertFalse("only in self" in content)
+
+
+if __name__ == "__main__":
+    unittest.main()
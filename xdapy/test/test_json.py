@@ -5,10 +5,13 @@ import json
 import tempfile
 import unittest
 import os
+import shutil
+from StringIO import StringIO
 from sqlalchemy.exc import IntegrityError
 
 from xdapy import Connection, Mapper
-from xdapy.io import JsonIO
+from xdapy import io as json_io
+from xdapy.io import JsonIO, _JsonStreamReader
 from xdapy.errors import InvalidInputError
 from xdapy.structures import Entity
 
@@ -158,6 +161,106 @@ class TestJson(unittest.TestCase):
         roots = self.mapper.find_roots()
         self.assertEqual(set([roots[0].params["s"], roots[1].params["s"]]), set(["parent1", "parent2"]))
 
+    def test_relations(self):
+        types = [{"type": "A", "parameters": {"s": "string"}}]
+        objects = [
+            {"type": "A", "id": 1, "parameters": {"s": "parent"},
+             "children": [{"type": "A", "id": 4, "parameters": {"s": "nested"}}]},
+            {"type": "A", "id": 2, "parameters": {"s": "child"}},
+            {"type": "A", "id": 3, "parameters": {"s": "observer"}},
+        ]
+
+        jio = JsonIO(self.mapper, add_new_types=True)
+        objs = jio.read_json({"types": types, "objects": objects, "relations": [
+            {"relation": "parent", "from": "id:1", "to": "id:2"},
+            {"relation": "context", "name": "Observer", "from": "id:1", "to": "id:3"},
+            {"relation": "context", "name": "Observer", "from": "id:2", "to": "id:3"}
+        ]})
+        parent, child, observer = [obj for obj in objs if obj.params["s"] in ("parent", "child", "observer")]
+        self.assertEqual(sorted(c.params["s"] for c in parent.children), ["child", "nested"])
+        self.assertEqual(child.parent, parent)
+        self.assertEqual(parent.context["Observer"], set([observer]))
+        self.assertEqual(observer.holders("Observer"), set([parent, child]))
+
+        # conflicts inside the relations
+        self.assertRaises(InvalidInputError, jio.read_json, {"types": types, "objects": objects, "relations": [
+            {"relation": "child", "from": "id:2", "to": "id:1"},
+            {"relation": "child", "from": "id:2", "to": "id:3"}
+        ]})
+        self.assertRaises(InvalidInputError, jio.read_json, {"types": types, "objects": objects, "relations": [
+            {"relation": "context", "name": "Observer", "from": "id:1", "to": "id:3"},
+            {"relation": "context", "name": "Observer", "from": "id:1", "to": "id:3"}
+        ]})
+        # conflict with a nested child
+        self.assertRaises(InvalidInputError, jio.read_json, {"types": types, "objects": objects, "relations": [
+            {"relation": "child", "from": "id:4", "to": "id:3"}
+        ]})
+        # unknown keys
+        self.assertRaises(InvalidInputError, jio.read_json, {"types": types, "objects": objects, "relations": [
+            {"relation": "child", "from": "id:2", "to": "id:5"}
+        ]})
+
+    def test_streaming_import(self):
+        json_string = json.dumps({
+            "relations": [
+                {"relation": "child", "from": "id:2", "to": "id:1"},
+                {"relation": "context", "name": "Owner", "from": "id:1", "to": "id:3"}
+            ],
+            "objects": [
+                {"type": "A", "id": 1, "parameters": {"s": "parent1"}},
+                {"type": "A", "parameters": {"s": "parent2"},
+                 "children": [{"type": "A", "parameters": {"s": "child21"}},
+                              {"type": "A", "parameters": {"s": "child22"}}]},
+                {"type": "A", "id": 2, "parameters": {"s": "child11"}},
+                {"type": "A", "id": 3, "parameters": {"s": u"\u00fcberall"}},
+            ],
+            "types": [{"type": "A", "parameters": {"s": "string"}}]
+        })
+
+        progress = []
+        jio = JsonIO(self.mapper, add_new_types=True)
+        mapping = jio.read_stream(StringIO(json_string), batch_size=2,
+                                  progress=lambda section, count: progress.append((section, count)))
+
+        self.assertEqual(progress, [("types", 1), ("objects", 2), ("objects", 4),
+                                    ("relations", 2)])
+        self.assertEqual(set(mapping.keys()), set(["id:1", "id:2", "id:3"]))
+
+        A = self.mapper.entity_by_name("A")
+        self.assertEqual(len(self.mapper.find_all(A)), 6)
+        roots = self.mapper.find_roots()
+        self.assertEqual(sorted(root.params["s"] for root in roots), ["parent1", "parent2", u"\u00fcberall"])
+
+        parent1 = self.mapper.find_first(A, {"s": "parent1"})
+        self.assertEqual([c.params["s"] for c in parent1.children], ["child11"])
+        self.assertEqual(parent1.context["Owner"], set([self.mapper.find_by_id(A, mapping["id:3"])]))
+        parent2 = self.mapper.find_first(A, {"s": "parent2"})
+        self.assertEqual(sorted(c.params["s"] for c in parent2.children), ["child21", "child22"])
+
+        json_string = json.dumps({
+            "types": [{"type": "A", "parameters": {"s": "string"}}],
+            "objects": [{"type": "A", "id": 1}, {"type": "A", "id": 2}, {"type": "A", "id": 3}],
+            "relations": [{"relation": "child", "from": "id:3", "to": "id:1"},
+                          {"relation": "child", "from": "id:3", "to": "id:2"}]
+        })
+        self.assertRaises(InvalidInputError, jio.read_stream, StringIO(json_string))
+
+    def test_stream_reader(self):
+        reader = _JsonStreamReader(StringIO(""" { "a" : [1, 22, {"b": [333]}] , "c": 4444, "d": [] } """),
+                                   chunk_size=3)
+        items = []
+        for key in reader.iter_object():
+            if key == "c":
+                items.append((key, reader.decode()))
+            else:
+                items.append((key, list(reader.iter_array())))
+        self.assertEqual(items, [("a", [1, 22, {"b": [333]}]), ("c", 4444), ("d", [])])
+
+        reader = _JsonStreamReader(StringIO("""{"a": [1, 2"""), chunk_size=3)
+        keys = reader.iter_object()
+        keys.next()
+        self.assertRaises(InvalidInputError, list, reader.iter_array())
+
     def test_data_export(self):
         class SomeEntity(Entity):
             declared_params = {"some_value": "string"}
@@ -204,3 +307,135 @@ class TestJson(unittest.TestCase):
             self.assertEqual(obj_in_db.data[data_key].get_string(), data_value)
             self.assertEqual(obj_in_db.data[data_key].mimetype, data_mimetype)
 
+
+    def test_parallel_export(self):
+        directory = tempfile.mkdtemp()
+        connection = Connection(url="sqlite:///" + os.path.join(directory, "export.db"))
+        connection.create_tables()
+        try:
+            mapper = Mapper(connection)
+            jio = JsonIO(mapper, add_new_types=True)
+            jio.read_json({
+                "types": [{"type": "A", "parameters": {"s": "string", "d": "date", "n": "integer"}}],
+                "objects": [{"type": "A", "id": i, "parameters": {"s": "a%d" % i, "d": "2012-02-%02d" % i, "n": i},
+                             "children": [{"type": "A", "parameters": {"s": "child of %d" % i}}]}
+                            for i in range(1, 21)] +
+                           [{"type": "A", "id": 99, "parameters": {"s": "unrelated"}}],
+                "relations": [{"relation": "context", "name": "Next", "from": "id:%d" % i, "to": "id:%d" % (i + 1)}
+                              for i in range(1, 20)]
+            })
+            A = mapper.entity_by_name("A")
+            first = mapper.find_first(A, {"s": "a1"})
+            first.data["raw"].put("0123456789" * 100)
+            first.data["raw"].mimetype = "text"
+
+            json_io.EXPORT_BATCH_SIZE, batch_size = 7, json_io.EXPORT_BATCH_SIZE
+            try:
+                serial_name = os.path.join(directory, "serial.json")
+                jio.write_file([first], serial_name)
+                parallel_name = os.path.join(directory, "parallel.json")
+                jio.write_file([first], parallel_name, processes=2)
+            finally:
+                json_io.EXPORT_BATCH_SIZE = batch_size
+
+            with open(serial_name) as serial:
+                serial_json = json.load(serial)
+            with open(parallel_name) as parallel:
+                parallel_json = json.load(parallel)
+            self.assertEqual(serial_json, parallel_json)
+            # the plain type name, not the polymorphic one
+            self.assertEqual(set(obj["type"] for obj in serial_json["objects"]), set(["A"]))
+            self.assertEqual(set(obj["type"] for obj in parallel_json["objects"]), set(["A"]))
+            # all but the unrelated object are reachable through the contexts
+            self.assertEqual(len(parallel_json["objects"]), 40)
+            self.assertEqual(len(parallel_json["relations"]), 20 + 19)
+            dict_json = jio.write_json([first], os.path.join(directory, "dict.data"))
+            self.assertEqual(parallel_json, dict_json)
+            with open(os.path.join(parallel_name + ".data", first.unique_id, "raw")) as data_file:
+                self.assertEqual(data_file.read(), "0123456789" * 100)
+            data_name = jio.write_data(os.path.join(directory, "single.data"), "first", "raw", first.data["raw"])
+            self.assertEqual(data_name, os.path.join("first", "raw"))
+            with open(os.path.join(directory, "single.data", data_name)) as data_file:
+                self.assertEqual(data_file.read(), "0123456789" * 100)
+
+            exported = [obj for obj in parallel_json["objects"] if obj["unique_id"] == first.unique_id][0]
+            self.assertEqual(exported["parameters"], {"s": "a1", "d": "2012-02-01", "n": 1})
+            self.assertEqual(exported["data"], {"raw": {"file": os.path.join(first.unique_id, "raw"), "mimetype": "text"}})
+
+            self.assertRaises(ValueError, JsonIO(self.mapper).write_file, [], os.path.join(directory, "memory.json"),
+                              processes=2)
+
+            # the workers would not see the uncommitted child
+            child = A(s="new child")
+            child.parent = first
+            with mapper.auto_session:
+                mapper.save(child)
+                self.assertRaises(ValueError, jio.write_file, [first], os.path.join(directory, "open.json"),
+                                  processes=2)
+            self.assertFalse(os.path.exists(os.path.join(directory, "open.json")))
+
+            committed_name = os.path.join(directory, "committed.json")
+            jio.write_file([first], committed_name, processes=2)
+            with open(committed_name) as committed:
+                committed_json = json.load(committed)
+            unique_ids = set("unique_id:" + obj["unique_id"] for obj in committed_json["objects"])
+            self.assertEqual(len(unique_ids), 41)
+            self.assertTrue(all(rel["from"] in unique_ids and rel["to"] in unique_ids
+                                for rel in committed_json["relations"]))
+        finally:
+            connection.drop_tables()
+            connection.engine.dispose()
+            shutil.rmtree(directory)
+
+    def test_compact_and_compressed_export(self):
+        jio = JsonIO(self.mapper, add_new_types=True)
+        jio.read_json({
+            "types": [{"type": "A", "parameters": {"s": "string"}}],
+            "objects": [{"type": "A", "id": i, "parameters": {"s": "a%d" % i},
+                         "children": [{"type": "A", "parameters": {"s": "child of %d" % i}}]}
+                        for i in range(1, 4)],
+            "relations": [{"relation": "context", "name": "Next", "from": "id:1", "to": "id:2"}]
+        })
+        roots = self.mapper.find_roots()
+        expected = json.loads(jio.write_string(roots))
+        self.assertEqual(expected, jio.write_json(roots))
+
+        compact = jio.write_string(roots, compact=True)
+        self.assertFalse("\n" in compact.strip() or ": " in compact or ", " in compact)
+        self.assertEqual(json.loads(compact), expected)
+
+        directory = tempfile.mkdtemp()
+        try:
+            for file_name, compression, magic in [("plain.json.gz", None, "\x1f\x8b"),
+                                                  ("plain.json", "gzip", "\x1f\x8b"),
+                                                  ("compact.json", None, "{")]:
+                file_name = os.path.join(directory, file_name)
+                jio.write_file(roots, file_name, compact=True, compression=compression)
+                with open(file_name, "rb") as f:
+                    self.assertTrue(f.read().startswith(magic))
+
+                for read in [JsonIO.read_file, JsonIO.read_file_streaming]:
+                    connection = Connection.test()
+                    connection.create_tables()
+                    try:
+                        mapper = Mapper(connection)
+                        read(JsonIO(mapper, add_new_types=True), file_name)
+                        self.assertEqual(len(mapper.find_roots()), 3)
+                        self.assertEqual(len(mapper.find_all("A")), 6)
+                    finally:
+                        connection.drop_tables()
+                        connection.engine.dispose()
+
+            self.assertRaises(ValueError, jio.write_file, roots, os.path.join(directory, "x.json"), compression="zip")
+            try:
+                json_io._import_lzma()
+            except ImportError:
+                self.assertRaises(ImportError, jio.write_file, roots, os.path.join(directory, "x.json.xz"))
+                self.assertFalse(os.path.exists(os.path.join(directory, "x.json.xz")))
+            else:
+                file_name = os.path.join(directory, "x.json.xz")
+                jio.write_file(roots, file_name)
+                with json_io._open_input(file_name) as f:
+                    self.assertEqual(json.load(f), expected)
+        finally:
+            shutil.rmtree(directory)
@@ -5,12 +5,13 @@
 Created on Jun 17, 2009
 """
 import operator
+from sqlalchemy import event
 from sqlalchemy.exc import CircularDependencyError, InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound, DetachedInstanceError
 from xdapy import Connection, Mapper, Entity
-from xdapy.structures import Context, create_entity
+from xdapy.structures import Context, create_entity, calculate_polymorphic_name
 from xdapy.errors import InsertionError
-from xdapy.operators import gt, lt, eq, between, ge
+from xdapy.operators import gt, lt, eq, between, ge, in_, not_in, in_range, missing, IN_ARRAY_THRESHOLD
 
 import unittest
 import datetime
@@ -181,6 +182,213 @@ class TestMapper(Setup):
         # but we cannot save t1 again
         self.assertRaises(InvalidRequestError, self.m.save, t1)
 
+    def test_save_bulk(self):
+        e = Experiment(project='YourProject', experimenter="Johny Dony")
+        o = Observer(name="Max Mustermann", handedness="right", age=26)
+        e.attach("Observer", o)
+
+        trials = [Trial(rt=i, valid=True, response='right') for i in range(25)]
+        for t in trials:
+            t.parent = e
+
+        saved = self.m.save_bulk(iter(trials), batch_size=10)
+        self.assertEqual(saved, trials)
+        self.assertTrue(all(t.id is not None for t in saved))
+
+        # related entities are saved along with the batches
+        self.assertEqual(len(self.m.find_all(Trial)), 25)
+        self.assertEqual(len(self.m.find_all(Experiment)), 1)
+        self.assertEqual(len(self.m.find_all(Observer)), 1)
+        self.assertEqual(self.m.find_first(Trial, {"rt": 24}).parent, e)
+        self.assertEqual(e.context["Observer"], set([o]))
+
+        self.m.save(Session(count=1), Session(count=2), flush="batch")
+        self.assertEqual(len(self.m.find_all(Session)), 2)
+
+        self.assertRaises(ValueError, self.m.save, Session(count=3), flush="never")
+        self.assertRaises(ValueError, self.m.save_bulk, [Session(count=3)], batch_size=0)
+
+    def test_find_with_load(self):
+        e = Experiment(project='MyProject')
+        observers = [Observer(name="o%d" % i, age=i) for i in range(10)]
+        for o in observers:
+            o.parent = e
+        self.m.save(e, *observers)
+        observers[0].data["raw"].put("some data")
+        e.attach("Observer", observers[1])
+        self.m.save(e)
+        self.connection.session.expunge_all()
+
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+
+        def touch(entities):
+            return [(dict(o.params), list(o.data), dict((k, set(v)) for k, v in o.context.iteritems()), o.parent)
+                    for o in entities]
+
+        found = self.m.find_all(Observer, load=["params", "data_keys", "context", "parent"])
+        touched = touch(found)
+        # observers and parent, params, data, context (the attachments are already loaded)
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(touched[0][0], {"name": "o0", "age": 0})
+        self.assertEqual(touched[0][1], ["raw"])
+        self.assertEqual([p.params["project"] for _1, _2, _3, p in touched], ["MyProject"] * 10)
+
+        self.connection.session.expunge_all()
+        del statements[:]
+        found = self.m.find_complex("Observer", {"age": ge(0)}, load=["params"])
+        self.assertEqual(sorted(o.params["age"] for o in found), range(10))
+        self.assertEqual(len(statements), 2)
+
+        self.connection.session.expunge_all()
+        del statements[:]
+        roots = self.m.find_roots(load=["context", "children"])
+        self.assertEqual(dict((k, set(v)) for k, v in roots[0].context.iteritems()),
+                         {"Observer": set([self.m.find_first(Observer, {"name": "o1"})])})
+        self.assertEqual(len(roots[0].children), 10)
+
+        self.assertRaises(ValueError, self.m.find_all, Observer, load=["unknown"])
+
+    def test_find_checks_parameter_name(self):
+        self.m.save(Session(count=1, category1=2), Session(count=2, category1=1))
+        sessions = self.m.find_all(Session, {"count": 1})
+        self.assertEqual([s.params["category1"] for s in sessions], [2])
+
+    def test_find_order_by(self):
+        ages = [30, 10, None, 20, 10]
+        for i, age in enumerate(ages):
+            o = Observer(name="o%d" % i, handedness="left" if i % 2 else "right")
+            if age is not None:
+                o.params["age"] = age
+            self.m.save(o)
+
+        names = lambda observers: [o.params["name"] for o in observers]
+        # observers without an age come last in either direction
+        self.assertEqual(names(self.m.find_all(Observer, order_by=["age"])), ["o1", "o4", "o3", "o0", "o2"])
+        self.assertEqual(names(self.m.find_all(Observer, order_by="-age")), ["o0", "o3", "o1", "o4", "o2"])
+        self.assertEqual(names(self.m.find_all(Observer, order_by="-age", limit=2)), ["o0", "o3"])
+        self.assertEqual(names(self.m.find_all(Observer, order_by=["handedness", "-age"])), ["o3", "o1", "o0", "o4", "o2"])
+        self.assertEqual(names(self.m.find_all(Observer, {"handedness": "right"}, order_by=["-_id"], limit=2)),
+                         ["o4", "o2"])
+        first = self.m.find_first(Observer, {"age": gt(15)}, order_by=["age"])
+        self.assertEqual(first.params["name"], "o3")
+        self.assertEqual(names(self.m.find_all(Observer, order_by=["age"], limit=1, load=["params"])), ["o1"])
+
+        self.assertRaises(ValueError, self.m.find_all, Observer, order_by=["project"])
+
+    def test_find_operators(self):
+        observers = [Observer(name="o%d" % i, age=i) for i in range(10)]
+        observers.append(Observer(name="no age"))
+        self.m.save(*observers)
+
+        ages = lambda observers: sorted(o.params.get("age") for o in observers)
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": in_([1, 3, 5])})), [1, 3, 5])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": [1, 3, 5]})), [1, 3, 5])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": not_in(range(2, 10))})), [0, 1])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": in_([])})), [])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": in_range(3, 6)})), [3, 4, 5])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": in_range(stop=2)})), [0, 1])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": missing()})), [None])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": [missing(), gt(7)]})), [None, 8, 9])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": ["8", "9"]}, {"convert_string": True})), [8, 9])
+        self.assertEqual(ages(self.m.find_complex(Observer, {"age": missing()})), [None])
+        self.assertRaises(ValueError, in_range)
+
+        # many values are bound as a single parameter
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, parameters, context, executemany: statements.append(parameters))
+        many = range(5, 5 + 2 * IN_ARRAY_THRESHOLD)
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": in_(many)})), [5, 6, 7, 8, 9])
+        self.assertEqual(ages(self.m.find_all(Observer, {"age": not_in(many)})), [0, 1, 2, 3, 4])
+        self.assertTrue(len(statements[0]) < IN_ARRAY_THRESHOLD)
+
+        # the values are stored as the dialect does it (dates as strings on sqlite)
+        start = datetime.date(2012, 1, 1)
+        self.m.save(*[Session(count=i, date=start + datetime.timedelta(days=i)) for i in range(5)])
+        days = [start + datetime.timedelta(days=i) for i in range(3, 3 + 2 * IN_ARRAY_THRESHOLD)]
+        counts = lambda sessions: sorted(s.params["count"] for s in sessions)
+        self.assertEqual(counts(self.m.find_all(Session, {"date": in_(days)})), [3, 4])
+        self.assertEqual(counts(self.m.find_all(Session, {"date": not_in(days)})), [0, 1, 2])
+
+    def test_iter_find(self):
+        e = Experiment(project='MyProject')
+        observers = [Observer(name="o%d" % i, age=i, handedness="left") for i in range(7)]
+        for o in observers:
+            o.parent = e
+        self.m.save(e, *observers)
+        e_id = e.id
+        ids = [o.id for o in observers]
+        self.connection.session.expunge_all()
+
+        found = []
+        found_ids = []
+        for o in self.m.iter_find(Observer, batch_size=3):
+            # objects of former batches have been removed from the session
+            former_batches = found[:len(found) // 3 * 3]
+            self.assertFalse(any(f in self.m.session for f in former_batches))
+            self.assertTrue(all(f in self.m.session for f in found[len(former_batches):]))
+            found.append(o)
+            found_ids.append(o.id)
+            o.params["handedness"] = "right"
+        self.assertEqual(found_ids, ids)
+        self.assertEqual(len(self.m.find_all(Observer, {"handedness": "right"})), 7)
+
+        self.assertEqual([o.params["age"] for o in self.m.iter_find(Observer, {"age": gt(4)}, batch_size=1)], [5, 6])
+        self.assertEqual(list(self.m.iter_find(Observer, {"age": gt(10)})), [])
+
+        self.connection.session.expunge_all()
+        records = list(self.m.iter_find(Observer, batch_size=2, records=True))
+        self.assertEqual(len(self.m.session.identity_map), 0)
+        self.assertEqual([r.id for r in records], ids)
+        self.assertEqual(records[1].type, "Observer")
+        self.assertEqual(records[1].parent_id, e_id)
+        self.assertEqual(records[1].params, {"name": "o1", "age": 1, "handedness": "right"})
+        self.assertRaises(AttributeError, setattr, records[1], "id", 10)
+
+    def test_ancestors_and_descendants(self):
+        e = Experiment(project='MyProject')
+        o = Observer(name="Max Mustermann")
+        s1 = Session(count=1)
+        s2 = Session(count=2)
+        t1 = Trial(rt=1)
+        t2 = Trial(rt=2)
+        o.parent = e
+        s1.parent = o
+        s2.parent = o
+        t1.parent = s1
+        t2.parent = s2
+
+        # works without a session
+        self.assertEqual(t1.ancestors(), [s1, o, e])
+        self.assertEqual(e.descendants(max_depth=2), [o, s1, s2])
+
+        self.m.save(e)
+        e_id, o_id, s1_id, s2_id, t1_id, t2_id = [x.id for x in (e, o, s1, s2, t1, t2)]
+        self.connection.session.expunge_all()
+
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+
+        trial = self.m.find_first(Trial, {"rt": 1})
+        del statements[:]
+        ancestors = trial.ancestors()
+        self.assertEqual([a.id for a in ancestors], [s1_id, o_id, e_id])
+        self.assertEqual(len(statements), 1)
+
+        experiment = ancestors[-1]
+        del statements[:]
+        descendants = experiment.descendants()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([d.id for d in descendants[:3]], [o_id, s1_id, s2_id])
+        self.assertEqual(set(d.id for d in descendants[3:]), set([t1_id, t2_id]))
+        self.assertEqual(set(d.id for d in experiment.descendants(max_depth=2)), set([o_id, s1_id, s2_id]))
+        self.assertEqual(experiment.descendants(max_depth=0), [])
+        self.assertEqual(experiment.siblings(), set(descendants))
+        self.assertEqual(trial.descendants(), [])
+
     def testLoad(self):
         obs = Observer(name="Max Mustermann", handedness="right", age=26)
         self.m.save(obs)
@@ -245,6 +453,26 @@ class TestMapper(Setup):
         self.assertEqual(Observer, self.m.entity_by_name(Observer))
         self.assertEqual(Observer_new, self.m.entity_by_name(Observer_new))
 
+    def test_registry(self):
+        self.assertEqual(self.m.registered_entities, [Observer, Experiment, Trial, Session])
+
+        # registering a class twice has no effect
+        self.m.register(Observer)
+        self.assertEqual(len(self.m.registry), 4)
+
+        # the list is a copy
+        self.m.registered_entities.append(Entity)
+        self.assertFalse(Entity in self.m.registry)
+
+        self.assertEqual(self.m.registry.by_original_name("Observer"), [Observer])
+        self.assertEqual(self.m.registry.by_original_name("Obs"), [])
+        self.assertEqual(self.m.registry.by_name(Observer.__name__), Observer)
+
+        self.assertTrue(self.m.is_registered("Observer", Observer.declared_params))
+        self.assertFalse(self.m.is_registered("Observer", {}))
+        self.assertEqual(calculate_polymorphic_name(u"Observer", Observer.declared_params), Observer.__name__)
+        self.assertTrue(isinstance(calculate_polymorphic_name(u"Observer", Observer.declared_params), unicode))
+
 
     def testCreate(self):
         obs = self.m.create("Observer")
@@ -520,6 +748,75 @@ class TestContext(Setup):
             str(ctx)
             repr(ctx)
 
+    def test_context_index(self):
+        e3 = Experiment(project="index")
+        observers = [Observer(name="o%d" % i) for i in range(50)]
+        for o in observers:
+            e3.attach("Observer", o)
+        self.assertEqual(len(e3.context["Observer"]), 50)
+        self.assertRaises(InsertionError, e3.attach, "Observer", observers[0])
+        self.assertEqual(observers[1].holders("Observer"), set([e3]))
+
+        # all ways of removing a context are reflected
+        ctx = e3._context_index("holds_context").get("Observer", observers[0])
+        e3.holds_context.remove(ctx)
+        self.assertFalse(observers[0] in e3.context["Observer"])
+        self.assertEqual(observers[0].holders(), set())
+
+        ctx = e3._context_index("holds_context").get("Observer", observers[1])
+        ctx.holder = self.e1
+        self.assertFalse(observers[1] in e3.context["Observer"])
+        self.assertTrue(observers[1] in self.e1.context["Observer"])
+        self.assertEqual(observers[1].holders(), set([self.e1]))
+
+        e3.context["Observer"].discard(observers[2])
+        Context(holder=e3, attachment=observers[2], connection_type="Supervisor")
+        self.assertEqual(observers[2].holders("Observer"), set())
+        self.assertEqual(e3.context["Supervisor"], set([observers[2]]))
+
+        self.m.save(e3)
+        # the collections are reloaded after the commit
+        self.assertEqual(len(e3.context["Observer"]), 47)
+        self.assertEqual(sorted(e3.context), ["Observer", "Supervisor"])
+        self.assertEqual(e3.attachments(), set(observers[2:]))
+
+    def test_context_index_other_side(self):
+        e3 = Experiment(project="index")
+        observers = [Observer(name="o%d" % i) for i in range(4)]
+        for o in observers:
+            e3.attach("Observer", o)
+        self.m.save(e3)
+        self.assertEqual(len(e3.context["Observer"]), 4)
+        self.assertEqual(observers[0].holders(), set([e3]))
+
+        # removal from the attachment's side
+        ctx = observers[0]._context_index("attached_by").get("Observer", e3)
+        observers[0].attached_by.remove(ctx)
+        self.assertFalse(observers[0] in e3.context["Observer"])
+        self.assertEqual(len(e3.context["Observer"]), 3)
+        self.assertEqual(observers[0].holders(), set())
+
+        # reassignment of the attachment
+        other = Observer(name="other")
+        ctx = e3._context_index("holds_context").get("Observer", observers[1])
+        ctx.attachment = other
+        self.assertFalse(observers[1] in e3.context["Observer"])
+        self.assertTrue(other in e3.context["Observer"])
+        self.assertEqual(observers[1].holders(), set())
+        self.assertEqual(other.holders("Observer"), set([e3]))
+
+        # a new connection type
+        ctx = e3._context_index("holds_context").get("Observer", observers[2])
+        ctx.connection_type = "Supervisor"
+        self.assertFalse(observers[2] in e3.context["Observer"])
+        self.assertEqual(e3.context["Supervisor"], set([observers[2]]))
+        self.assertEqual(observers[2].holders("Observer"), set())
+        self.assertEqual(observers[2].holders("Supervisor"), set([e3]))
+
+        self.m.save(e3)
+        self.assertEqual(e3.context["Observer"], set([other, observers[3]]))
+        self.assertEqual(e3.context["Supervisor"], set([observers[2]]))
+
     def test_number_of_connections(self):
         self.assertEqual(self.m.find(Context).count(), 4)
 
@@ -698,6 +995,53 @@ class TestGetDataMatrix(Setup):
                                   [{'name': 'Susanne Sorgenfrei'}, {'project': 'YourProject'},
                                    {'name': 'Susi Sorgen'}, {'project': 'MyProject'}])
 
+    def test_get_data_array(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        e1 = Experiment(project='MyProject', experimenter="John Doe")
+        o1 = Observer(name="Max Mustermann", handedness="right", age=26)
+        o2 = Observer(name="Susanne Sorgenfrei", handedness='left')
+        e2 = Experiment(project='YourProject', experimenter="John Doe")
+        s1 = Session(count=1, date=datetime.date(2011, 1, 1))
+        t1 = Trial(rt=120, valid=True)
+        t2 = Trial(rt=140)
+
+        e1.attach("Observer", o1)
+        e1.attach("Observer", o2)
+        s1.parent = e1
+        t1.parent = s1
+        t2.parent = s1
+        self.m.save(e1, e2, o1, o2)
+
+        arrays = self.m.get_data_array(Experiment, {'Observer': ['age', 'name'],
+                                                    'Session': ['date'],
+                                                    'Trial': ['rt', 'valid']})
+        observers = arrays['Observer']
+        self.assertEqual(observers.dtype.names, ('age', 'name'))
+        self.assertEqual(observers.dtype['age'], numpy.dtype('f8'))
+        self.assertEqual(sorted(observers['name']), ["Max Mustermann", "Susanne Sorgenfrei"])
+        self.assertEqual(numpy.isnan(observers['age']).sum(), 1)
+        self.assertEqual(numpy.nansum(observers['age']), 26)
+
+        self.assertEqual(list(arrays['Session']['date']), [numpy.datetime64('2011-01-01')])
+        self.assertEqual(arrays['Trial']['rt'].dtype, numpy.dtype('i8'))
+        self.assertEqual(list(arrays['Trial']['rt']), [120, 140])
+        self.assertEqual(list(arrays['Trial']['valid']), [True, None])
+
+        arrays = self.m.get_data_array(Experiment(project='YourProject'), {'Observer': ['age']}, as_dict=True)
+        self.assertEqual(len(arrays['Observer']['age']), 0)
+
+        arrays = self.m.get_data_array(Trial, {'Experiment': ['project'], 'Trial': ['rt']}, include=["PARENT"])
+        self.assertEqual(list(arrays['Experiment']['project']), ['MyProject'])
+        self.assertEqual(list(arrays['Trial']['rt']), [120, 140])
+
+        arrays = self.m.get_data_array(Trial(rt=140), {'Trial': ['valid']}, include=[])
+        self.assertEqual(arrays['Trial'].dtype['valid'], numpy.dtype(object))
+        self.assertEqual(list(arrays['Trial']['valid']), [None])
+
 #
 #    def testRegisterParameter(self):
 #        valid_parameters = (('Observer', 'glasses', 'string'),
@@ -787,6 +1131,61 @@ class TestGetDataMatrix(Setup):
 #        self.assertEqual(exp_children,[o])
 #===============================================================================
 
+class TestAggregate(Setup):
+    def setUp(self):
+        super(TestAggregate, self).setUp()
+
+        self.s1 = Session(count=1)
+        self.s2 = Session(count=2)
+        for rt, valid, response in [(100, True, "left"), (200, True, "right"), (600, False, "left")]:
+            Trial(rt=rt, valid=valid, response=response).parent = self.s1
+        for rt, valid, response in [(300, True, "left"), (500, True, "left")]:
+            Trial(rt=rt, valid=valid, response=response).parent = self.s2
+        # a trial without rt
+        Trial(valid=False).parent = self.s2
+        self.m.save(self.s1, self.s2)
+
+    def test_aggregate(self):
+        self.assertEqual(self.m.aggregate(Trial, metrics={"n": "count", "rt": "mean"}),
+                         [{"n": 6, "rt": 340.0}])
+
+        rows = self.m.aggregate("Trial", {"valid": True}, group_by=["_parent"],
+                                metrics={"n": "count", "rt": "mean", "slowest": ("max", "rt")})
+        self.assertEqual(rows, [{"_parent": self.s1.id, "n": 2, "rt": 150.0, "slowest": 200},
+                                {"_parent": self.s2.id, "n": 2, "rt": 400.0, "slowest": 500}])
+
+        rows = self.m.aggregate(Trial, group_by=["valid", "response"], metrics={"rt": "count", "total": ("sum", "rt")})
+        self.assertEqual([(r["valid"], r["response"], r["rt"], r["total"]) for r in rows],
+                         [(False, None, 0, None), (False, "left", 1, 600),
+                          (True, "left", 3, 900), (True, "right", 1, 200)])
+
+        self.assertEqual(self.m.aggregate(Trial, {"rt": gt(1000)}, group_by=["_parent"], metrics={"n": "count"}), [])
+
+        self.assertRaises(ValueError, self.m.aggregate, Trial, metrics={"rt": "median"})
+        self.assertRaises(ValueError, self.m.aggregate, Trial, group_by=["age"], metrics={"n": "count"})
+        self.assertRaises(ValueError, self.m.aggregate, Trial)
+
+    def test_aggregate_array(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        array = self.m.aggregate(Trial, group_by=["_parent"], metrics={"n": "count", "rt": "mean"}, as_array=True)
+        self.assertEqual(array.dtype.names, ("_parent", "n", "rt"))
+        self.assertEqual(list(array["_parent"]), [self.s1.id, self.s2.id])
+        self.assertEqual(list(array["n"]), [3, 3])
+        self.assertEqual(list(array["rt"]), [300.0, 400.0])
+
+
+class TestMaterializedAggregate(TestAggregate):
+    """ Runs the aggregations against the materialized table."""
+    def setUp(self):
+        super(TestMaterializedAggregate, self).setUp()
+        self.m.materialize(Trial)
+        self.assertTrue(self.connection.materializer.is_fresh(Trial))
+
+
 class TestComplicatedQuery(Setup):
     def setUp(self):
         super(TestComplicatedQuery, self).setUp()
@@ -862,6 +1261,64 @@ class TestComplicatedQuery(Setup):
                                                                                               ("Observer", {"name": "C"})]}})
         self.assertEqual(set(experiments), set([self.e1, self.e2, self.e3]))
 
+    def test_find_complex_runs_in_sql(self):
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+
+        sessions = self.m.find_complex("Session", {"_parent": {"_any": [
+                                                    ("Trial", {"rt": gt(2)}),
+                                                    ("Trial", {"_parent": ("Experiment", {"project": "E1"}),
+                                                               "_child": ("Session", {"count": eq(2)})})]}})
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(set(s.params["count"] for s in sessions), set([1, 2, 5, 6]))
+
+        t1_id = self.t1.id
+        self.o1.id # refresh the expired attributes
+        del statements[:]
+        experiments = self.m.find_complex("Experiment", {("_context", "Observed by"): self.o1,
+                                                         "_child": {"_id": eq(t1_id)}})
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(experiments, [self.e1])
+
+        # a class may be given as well
+        trials = self.m.find_complex(Trial, {"response": "resp_1"})
+        self.assertEqual(len(trials), 2)
+
+    def test_find_complex_sql_clause(self):
+        from xdapy.find import SearchProxy
+        from xdapy.structures import BaseEntity
+
+        def compile(the_filter):
+            entity = SearchProxy(("Session", the_filter)).inner
+            return entity.inner.sql_clause(self.m, BaseEntity.__table__, Session)
+
+        clause, exact = compile({"count": gt(1), "_parent": ("Trial", {"rt": 1})})
+        self.assertTrue(clause is not None)
+        self.assertTrue(exact)
+
+        # _with can only be checked in Python
+        clause, exact = compile({"count": gt(1), "_with": lambda e: True})
+        self.assertTrue(clause is not None)
+        self.assertFalse(exact)
+
+        clause, exact = compile({"_any": [{"count": gt(1)}, {"_with": lambda e: True}]})
+        self.assertTrue(clause is None)
+        self.assertFalse(exact)
+
+        # other callables are checked in Python as well
+        clause, exact = compile({"count": lambda count: count == 1 or count == 3})
+        self.assertTrue(clause is None)
+        self.assertFalse(exact)
+
+    def test_find_complex_python_callables(self):
+        # `or` and `and` do not work on columns; the lambdas are evaluated in Python
+        trials = self.m.find_complex("Trial", {"rt": lambda x: x == 1 or x == 3})
+        self.assertEqual(sorted(t.params["rt"] for t in trials), [1, 3])
+
+        trials = self.m.find_complex("Trial", {"rt": lambda x: x != 1 and x < 3})
+        self.assertEqual(sorted(t.params["rt"] for t in trials), [2])
+
     def test_find_with(self):
         # we can also do parent relations with find_with
         sessions = self.m.find_with("Session", {"_parent": ("Trial", {"rt": gt(2)})})
@@ -920,6 +1377,43 @@ class TestComplicatedQuery(Setup):
         self.assertEqual(len(sessions), 0) # TODO Prepare a better test and example
 
 
+    def test_join_query(self):
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+
+        query = self.m.join_query()
+        query.add("trial", "Trial", {"rt": lt(4)})
+        query.add("experiment", Experiment)
+        query.add("observer", Observer, {"name": "A"})
+        query.parent("experiment", "trial").context("experiment", "observer", "Observed by")
+        self.assertEqual(query.select("trial.rt", "trial.response", "experiment.project"),
+                         [(1, "resp_0", "E1"), (2, "resp_1", "E1"), (3, "noresp", "E2")])
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(query.all("trial")[0], self.t1)
+
+        # sessions below experiment E1, which has been observed by B
+        query = self.m.join_query().add("session", Session).add("experiment", Experiment, {"project": "E1"}).\
+                    add("observer", Observer, {"name": "B"})
+        query.ancestor("experiment", "session").context("experiment", "observer")
+        self.assertEqual(query.select("session.count", "session.date"), [(1, None), (2, None), (3, None), (4, None)])
+        self.assertEqual(query.ids("experiment"), [self.e1.id])
+
+        query.add("trial", Trial, {"rt": gt(1)}).parent("trial", "session")
+        self.assertEqual(query.select("session.count"), [(3,), (4,)])
+        self.assertEqual(query.select("observer.name", distinct=False), [("B",), ("B",)])
+
+        query = self.m.join_query().add("experiment", Experiment).add("observer", Observer, {"name": "C"})
+        query.context("experiment", "observer", "Supervised by")
+        self.assertEqual(query.select("experiment._id"), [])
+        self.assertEqual(query.all("experiment"), [])
+
+        self.assertRaises(ValueError, query.add, "experiment", Experiment)
+        self.assertRaises(ValueError, query.parent, "experiment", "trial")
+        self.assertRaises(ValueError, query.select, "experiment.age")
+        self.assertRaises(ValueError, query.select)
+
+
 class TestTypeMagic(unittest.TestCase):
     def setUp(self):
         self.connection = Connection.test()
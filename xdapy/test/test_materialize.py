@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""Unittest for the materialized tables"""
+
+import datetime
+import unittest
+
+from sqlalchemy import event, inspect
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.materialize import materialized_table_name
+from xdapy.operators import gt, between, in_, missing
+from xdapy.parameters import Parameter
+
+
+class Observer(Entity):
+    declared_params = {
+        'name': 'string',
+        'age': 'integer',
+        'birthday': 'date'
+    }
+
+class Trial(Entity):
+    declared_params = {
+        'rt': 'float',
+        'valid': 'boolean',
+        'response': 'string'
+    }
+
+
+class TestMaterialize(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection.test()
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Observer, Trial)
+
+        self.o1 = Observer(name="A", age=20, birthday=datetime.date(1990, 5, 1))
+        self.o2 = Observer(name="B", age=30)
+        self.trials = [Trial(rt=100.0 * i, valid=bool(i % 2), response="left") for i in range(1, 5)]
+        for trial in self.trials:
+            trial.parent = self.o1
+        self.m.save(self.o1, self.o2)
+
+        self.materializer = self.m.materialize(Observer, Trial)
+        self.statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: self.statements.append(args[2]))
+
+    def tearDown(self):
+        self.connection.drop_tables()
+        # need to dispose manually to avoid too many connections error
+        self.connection.engine.dispose()
+
+    def rows(self, entity):
+        table = self.connection.materializer.fresh_table(entity)
+        return sorted(tuple(row) for row in self.connection.engine.execute(table.select()))
+
+    def test_tables(self):
+        self.assertEqual(self.materializer.entities, [Observer, Trial])
+        self.assertTrue(self.materializer.is_fresh(Observer))
+
+        table_names = inspect(self.connection.engine).get_table_names()
+        self.assertTrue(materialized_table_name(Trial) in table_names)
+        self.assertEqual(self.rows(Observer), [(self.o1.id, 20, datetime.date(1990, 5, 1), "A"),
+                                               (self.o2.id, 30, None, "B")])
+
+        self.assertRaises(TypeError, self.m.materialize, Entity)
+
+    def test_incremental_refresh(self):
+        self.o2.params["age"] = 31
+        self.o2.params["birthday"] = datetime.date(1980, 1, 1)
+        del self.o1.params["age"]
+        o3 = Observer(name="C")
+        self.m.save(o3)
+        self.m.delete(self.trials[0])
+        self.m.session.flush()
+
+        self.assertTrue(self.materializer.is_fresh(Observer))
+        self.assertEqual(self.rows(Observer), [(self.o1.id, None, datetime.date(1990, 5, 1), "A"),
+                                               (self.o2.id, 31, datetime.date(1980, 1, 1), "B"),
+                                               (o3.id, None, None, "C")])
+        self.assertEqual(len(self.rows(Trial)), 3)
+
+    def test_find(self):
+        del self.statements[:]
+        found = self.m.find_all(Observer, {"age": gt(25), "name": "B"})
+        self.assertEqual(found, [self.o2])
+        self.assertEqual(self.m.find_all(Trial, {"rt": between(150, 350), "valid": True}), [self.trials[2]])
+        self.assertEqual(len(self.m.find_all(Observer, {"birthday": "1990"}, {"convert_string": True})), 1)
+        self.assertEqual(self.m.find_all(Observer, {"birthday": missing(), "age": in_([10, 30])}), [self.o2])
+        self.assertTrue(all(Parameter.__tablename__ not in statement for statement in self.statements))
+
+        self.materializer.invalidate(Observer)
+        del self.statements[:]
+        self.assertEqual(self.m.find_all(Observer, {"age": gt(25), "name": "B"}), [self.o2])
+        self.assertTrue(any(Parameter.__tablename__ in statement for statement in self.statements))
+
+    def test_records(self):
+        records = list(self.m.iter_find(Observer, records=True))
+        self.assertEqual([record.params for record in records],
+                         [{"name": "A", "age": 20, "birthday": datetime.date(1990, 5, 1)},
+                          {"name": "B", "age": 30}])
+
+    def test_get_data_array(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        arrays = self.m.get_data_array(self.o1, {"Trial": ["rt", "valid"]})
+        self.assertEqual(list(arrays["Trial"]["rt"]), [100.0, 200.0, 300.0, 400.0])
+        self.assertEqual(list(arrays["Trial"]["valid"]), [True, False, True, False])
+
+    def test_stale(self):
+        # bulk updates are not tracked
+        self.m.session.query(Observer).filter(Observer.id == self.o2.id).delete(synchronize_session=False)
+        self.assertFalse(self.materializer.is_fresh(Observer))
+        self.assertEqual(self.m._materialized_table(Observer), None)
+
+        self.materializer.rebuild()
+        self.assertTrue(self.materializer.is_fresh(Observer))
+        self.assertEqual(len(self.rows(Observer)), 1)
+
+        self.materializer.drop(Trial)
+        self.assertEqual(self.materializer.entities, [Observer])
+        self.assertFalse(materialized_table_name(Trial) in inspect(self.connection.engine).get_table_names())
+
+
+if __name__ == '__main__':
+    unittest.main()
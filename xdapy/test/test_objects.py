@@ -6,6 +6,7 @@ Created on Jun 17, 2009
 """
 from datetime import date, time, datetime
 import operator
+import os
 import xdapy
 from xdapy.data import DataChunks, Data
 from xdapy.parameters import StringParameter
@@ -13,6 +14,7 @@ from xdapy.parameters import StringParameter
 __authors__ = ['"Hannah Dold" <hannah.dold@mailbox.tu-berlin.de>']
 """TODO: Load image into testSetData"""
 
+from sqlalchemy import event
 from sqlalchemy.orm.session import Session
 
 from xdapy import Connection, Mapper, Entity
@@ -204,6 +206,48 @@ class TestObjectDict(unittest.TestCase):
         datachunks = self.m.find_all(DataChunks)
         self.assertEqual(len(datachunks), 0)
 
+    def test_copy_data(self):
+        exp_1 = Experiment()
+        exp_2 = Experiment()
+        self.m.save(exp_1, exp_2)
+
+        old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 10
+        try:
+            data = "0123456789ABCDEF" * 10
+            exp_1.data['alphabet'].put(data, mimetype="text/plain")
+        finally:
+            xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
+
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+
+        # the chunks are copied inside the database
+        exp_2.data['copy'] = exp_1.data['alphabet']
+        self.assertTrue(any(s.startswith("INSERT INTO data_chunks") and "SELECT" in s for s in statements))
+        self.assertFalse(any(s.startswith("SELECT data_chunks.data") for s in statements))
+
+        self.assertEqual(exp_2.data['copy'].get_string(), data)
+        self.assertEqual(exp_2.data['copy'].mimetype, "text/plain")
+        self.assertEqual(exp_2.data['copy'].chunks(), 16)
+        self.assertEqual(exp_2.data['copy'].size(), 160)
+        self.assertTrue(exp_2.data['copy'].check_consistency())
+
+        # copying to another database streams the chunks
+        other_connection = Connection.memory()
+        other_connection.create_tables()
+        other_mapper = Mapper(other_connection)
+        other_mapper.register(Experiment)
+        try:
+            exp_3 = Experiment()
+            other_mapper.save(exp_3)
+            exp_3.data.copy(exp_2.data)
+            self.assertEqual(exp_3.data['copy'].get_string(), data)
+            self.assertEqual(exp_3.data['copy'].mimetype, "text/plain")
+        finally:
+            other_connection.engine.dispose()
+
     def testAssignDataTooEarly(self):
         exp = Experiment()
         self.assertRaises(MissingSessionError, exp.data['default'].put, "2")
@@ -242,6 +286,50 @@ class TestObjectDict(unittest.TestCase):
 
         xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
 
+    def test_open_data(self):
+        exp_1 = Experiment()
+
+        self.m.save(exp_1)
+
+        old_chunk_size = xdapy.data.DATA_CHUNK_SIZE
+        xdapy.data.DATA_CHUNK_SIZE = 10
+        try:
+            data = "0123456789ABCDEF" * 100
+            exp_1.data['alphabet'].put(data)
+            exp_1.data['empty'].put("")
+        finally:
+            xdapy.data.DATA_CHUNK_SIZE = old_chunk_size
+
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+
+        with exp_1.data['alphabet'].open() as f:
+            self.assertTrue(f.seekable())
+            del statements[:]
+            f.seek(795)
+            self.assertEqual(f.read(10), data[795:805])
+            self.assertEqual(f.tell(), 805)
+            f.seek(-10, os.SEEK_CUR)
+            self.assertEqual(f.read(3), data[795:798])
+            # only the two chunks have been fetched
+            self.assertEqual(len(statements), 2)
+
+            f.seek(-5, os.SEEK_END)
+            self.assertEqual(f.read(), data[-5:])
+            self.assertEqual(f.read(10), "")
+
+            f.seek(0)
+            buf = bytearray(25)
+            self.assertEqual(f.readinto(buf), 25)
+            self.assertEqual(str(buf), data[:25])
+            self.assertEqual(f.read(), data[25:])
+
+        self.assertRaises(ValueError, f.read)
+
+        with exp_1.data['empty'].open() as f:
+            self.assertEqual(f.read(), "")
+
 
 class TestStrJsonParams(unittest.TestCase):
     def setUp(self):
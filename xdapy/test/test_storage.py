@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Unittest for the data stores"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import event, inspect
+
+from xdapy import Connection, Mapper, Entity
+from xdapy.data import Data, DataChunks
+from xdapy.errors import DataInconsistencyError
+from xdapy.storage import FileSystemStore, migrate_to_store, remove_unreferenced
+
+
+class Recording(Entity):
+    declared_params = {
+        'name': 'string'
+    }
+
+
+class TestFileSystemStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = FileSystemStore(self.root)
+
+        self.connection = Connection.test(data_store=self.store)
+        self.connection.create_tables()
+        self.m = Mapper(self.connection)
+        self.m.register(Recording)
+
+    def tearDown(self):
+        self.connection.drop_tables()
+        # need to dispose manually to avoid too many connections error
+        self.connection.engine.dispose()
+        shutil.rmtree(self.root)
+
+    def test_store(self):
+        digest, size = self.store.put_chunks(["abc", "def"])
+        self.assertEqual(size, 6)
+        self.assertTrue(self.store.exists(digest))
+        self.assertEqual(self.store.path(digest), os.path.join(self.root, digest[0:2], digest[2:4], digest))
+        self.assertEqual(self.store.open(digest).read(), "abcdef")
+        self.assertEqual(self.store.mmap(digest)[2:4], "cd")
+
+        # equal content is stored only once
+        self.assertEqual(self.store.put_chunks(["abcdef"]), (digest, size))
+        self.assertEqual(list(self.store.digests()), [digest])
+
+        self.assertEqual(self.store.mmap(self.store.put_chunks([])[0]), "")
+
+        self.store.delete(digest)
+        self.assertFalse(self.store.exists(digest))
+        self.assertRaises(DataInconsistencyError, self.store.open, digest)
+
+    def test_data_in_store(self):
+        rec = Recording(name="r1")
+        self.m.save(rec)
+        rec.data["raw"].put("0123456789" * 1000, mimetype="text/plain")
+
+        data = self.m.session.query(Data).one()
+        self.assertEqual(data.size, 10000)
+        self.assertTrue(self.store.exists(data.digest))
+        self.assertEqual(self.m.session.query(DataChunks).count(), 0)
+
+        self.assertEqual(rec.data["raw"].get_string(), "0123456789" * 1000)
+        self.assertEqual(rec.data["raw"].size(), 10000)
+        self.assertEqual(rec.data["raw"].mimetype, "text/plain")
+        self.assertTrue(rec.data["raw"].check_consistency())
+        with rec.data["raw"].open() as f:
+            f.seek(9995)
+            self.assertEqual(f.read(), "56789")
+
+        # data is copied as well
+        rec2 = Recording(name="r2")
+        self.m.save(rec2)
+        rec2.data["copy"] = rec.data["raw"]
+        self.assertEqual(rec2.data["copy"].get_string(), "0123456789" * 1000)
+        self.assertEqual(len(list(self.store.digests())), 1)
+
+        rec.data["raw"].put("new content")
+        self.assertEqual(rec.data["raw"].get_string(), "new content")
+        self.assertEqual(remove_unreferenced(self.connection), [])
+        rec2.data["copy"].delete()
+        self.assertEqual(len(remove_unreferenced(self.connection)), 1)
+
+    def test_migration(self):
+        rec = Recording(name="r1")
+        self.m.save(rec)
+
+        # store some data inside the database
+        self.connection.session.data_store = None
+        rec.data["raw"].put("legacy data")
+        rec.data["empty"].put("")
+        self.assertEqual(self.m.session.query(DataChunks).count(), 1)
+        self.connection.session.data_store = self.store
+
+        # legacy data stays readable
+        self.assertEqual(rec.data["raw"].get_string(), "legacy data")
+
+        self.assertEqual(migrate_to_store(self.connection), 2)
+        self.assertEqual(self.m.session.query(DataChunks).count(), 0)
+        self.assertEqual(rec.data["raw"].get_string(), "legacy data")
+        self.assertEqual(rec.data["raw"].size(), 11)
+        self.assertEqual(rec.data["empty"].get_string(), "")
+        self.assertEqual(migrate_to_store(self.connection), 0)
+
+    def test_missing_store(self):
+        rec = Recording(name="r1")
+        self.m.save(rec)
+        rec.data["raw"].put("some data")
+
+        self.connection.session.data_store = None
+        self.assertRaises(DataInconsistencyError, rec.data["raw"].get_string)
+
+
+class TestUpgradeTables(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection.memory()
+        self.connection.create_tables()
+
+    def tearDown(self):
+        self.connection.drop_tables()
+        self.connection.engine.dispose()
+
+    def test_upgrade_tables(self):
+        with self.connection.engine.begin() as connection:
+            connection.execute("DROP INDEX ix_data_digest")
+            connection.execute("ALTER TABLE data DROP COLUMN digest")
+            connection.execute("ALTER TABLE data DROP COLUMN size")
+
+        self.assertEqual(sorted(self.connection.upgrade_tables()), ["data.digest", "data.size", "ix_data_digest"])
+
+        # no typed table got a new name column, so there is nothing to copy
+        statements = []
+        event.listen(self.connection.engine, "before_cursor_execute",
+                     lambda *args: statements.append(args[2]))
+        self.assertEqual(self.connection.upgrade_tables(), [])
+        self.assertFalse([s for s in statements if s.startswith("UPDATE")])
+
+        index_names = [index["name"] for index in inspect(self.connection.engine).get_indexes("data")]
+        self.assertTrue("ix_data_digest" in index_names)
+
+    def test_upgrade_parameter_names(self):
+        mapper = Mapper(self.connection)
+        mapper.register(Recording)
+        mapper.save(Recording(name="r1"), Recording(name="r2"))
+
+        with self.connection.engine.begin() as connection:
+            connection.execute("DROP INDEX ix_parameters_string_name_value")
+            connection.execute("ALTER TABLE parameters_string DROP COLUMN name")
+
+        self.assertEqual(sorted(self.connection.upgrade_tables()),
+                         ["ix_parameters_string_name_value", "parameters_string.name"])
+        names = self.connection.engine.execute("SELECT name FROM parameters_string").fetchall()
+        self.assertEqual(names, [("name",), ("name",)])
+        self.assertEqual(len(mapper.find_all(Recording, {"name": "r2"})), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
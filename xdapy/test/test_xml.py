@@ -5,6 +5,8 @@ from xdapy.errors import AmbiguousObjectError, InvalidInputError
 from xdapy.io import XmlIO, UnregisteredTypesError
 from xdapy.utils.decorators import autoappend
 import unittest
+from StringIO import StringIO
+from xml.etree import ElementTree as ET
 
 objects = []
 
@@ -110,6 +112,71 @@ class TestXml(unittest.TestCase):
         self.assertEqual(len(objs), 7)
         self.assertEqual(len(roots), 6)
 
+    def test_write_and_read(self):
+        XmlIO(self.mapper).read(self.test_xml)
+        xml = ET.tostring(XmlIO(self.mapper).write())
+
+        connection = Connection.test()
+        connection.create_tables()
+        try:
+            mapper = Mapper(connection)
+            mapper.register(*objects)
+            XmlIO(mapper).read(xml)
+            self.assertEqual(len(mapper.find_all(Entity)), 7)
+            self.assertEqual(len(mapper.find_roots()), 6)
+            experiment = mapper.find_first(Experiment, {"project": "PPP0"})
+            self.assertEqual([o.params["name"] for o in experiment.context["Some Context"]], ["Susanne Sorgenfrei"])
+        finally:
+            connection.drop_tables()
+            connection.engine.dispose()
+
+    def test_streaming(self):
+        progress = []
+        xmlio = XmlIO(self.mapper)
+        references = xmlio.read_file_streaming(StringIO(self.test_xml), batch_size=2,
+                                               progress=lambda section, count: progress.append((section, count)))
+        objs = self.mapper.find_all(Entity)
+        roots = self.mapper.find_roots()
+        self.assertEqual(len(objs), 7)
+        self.assertEqual(len(roots), 6)
+        self.assertEqual(progress, [("objects", 2), ("objects", 4), ("objects", 6), ("objects", 7),
+                                    ("relations", 1)])
+        self.assertEqual(sorted(references.keys()), ["id:" + str(i) for i in range(1, 8)])
+
+        experiment = self.mapper.find_by_id(Experiment, references["id:1"])
+        self.assertEqual(experiment.params["project"], "PPP0")
+        self.assertEqual([o.params["name"] for o in experiment.children], ["Max Mustermann"])
+        self.assertEqual([o.params["name"] for o in experiment.context["Some Context"]], ["Susanne Sorgenfrei"])
+        self.assertEqual(experiment.data["hlkk"].get_string(), "lkjlkjkl#\xc3\xa4jkljysdsa")
+
+    def test_streaming_parent_reference(self):
+        test_xml = wrap_xml_values("""
+            <entity id="1" type="Experiment" />
+            <entity id="2" type="Experiment" />
+            <entity id="3" type="Observer" parent="id:1" />
+            <entity id="4" type="Observer" parent="id:2">
+                <entity id="5" type="Session" parent="id:4" />
+            </entity>""")
+        xmlio = XmlIO(self.mapper)
+        references = xmlio.read_file_streaming(StringIO(test_xml), batch_size=1)
+        observer = self.mapper.find_by_id(Observer, references["id:3"])
+        self.assertEqual(observer.parent.id, references["id:1"])
+        session = self.mapper.find_by_id(Session, references["id:5"])
+        self.assertEqual(session.parent.id, references["id:4"])
+        self.assertEqual(session.parent.parent.id, references["id:2"])
+
+        test_xml = wrap_xml_values("""
+            <entity id="1" type="Experiment" />
+            <entity id="2" type="Observer">
+                <entity id="3" type="Session" parent="id:1" />
+            </entity>""")
+        self.assertRaises(InvalidInputError, xmlio.read_file_streaming, StringIO(test_xml))
+
+        test_xml = """<xdapy><types>
+            <entity name="Experiment" />
+        </types></xdapy>"""
+        self.assertRaises(UnregisteredTypesError, xmlio.read_file_streaming, StringIO(test_xml))
+
     def test_unique_id(self):
         test_xml = wrap_xml_values("""<entity id="1" type="Experiment" unique_id="2" />""")
         xmlio = XmlIO(self.mapper)
@@ -89,6 +89,21 @@ def filter_none(a_dict):
     """Filters all elements from the dict with value is None."""
     return dict((k, v) for k, v in a_dict if v)
 
+def batches(iterable, batch_size):
+    """Splits an iterable into lists of at most `batch_size` elements.
+
+    >>> list(batches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
\ No newline at end of file